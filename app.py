@@ -9,36 +9,39 @@ import hashlib
 from functools import wraps
 from urllib.parse import quote, urlencode, urljoin, urlparse
 import uuid # Library to create unique tokens
+import socket
+import time
+import threading
+import queue
+import base64
+import click
 from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, session
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import (
     LoginManager, login_user, login_required, logout_user, UserMixin, current_user, AnonymousUserMixin
 )
 from dotenv import load_dotenv
-from sqlalchemy import func, extract, inspect, text, or_, case
-from sqlalchemy.orm import joinedload
-from collections import defaultdict
+from sqlalchemy import func, extract, inspect, text, or_, case, event
+from sqlalchemy.dialects.mysql import insert as mysql_insert, LONGTEXT
+from sqlalchemy.orm import joinedload, Session as OrmSession
+from sqlalchemy.exc import IntegrityError
+from collections import defaultdict, OrderedDict
+from bisect import bisect_left, bisect_right
 import calendar
-import pandas as pd
 import io
 import unicodedata
-import qrcode
-from email.message import EmailMessage
-from email.mime.multipart import MIMEMultipart
-from email.mime.text import MIMEText
-from email.mime.base import MIMEBase
-from email import encoders
 
 # Import SocketIO and necessary functions
 from flask_socketio import SocketIO, join_room
 from werkzeug.utils import secure_filename
 from werkzeug.middleware.proxy_fix import ProxyFix
-from apscheduler.schedulers.background import BackgroundScheduler
 import atexit
+from invoice_pdf import render_invoice_pdf, render_batch as render_invoice_batch
+from excel_export import StreamingWorkbook, Column as ExcelColumn, XLSX_MIMETYPE
 from werkzeug.security import generate_password_hash, check_password_hash
 
 from flask_caching import Cache
-from flask_migrate import Migrate
+from flask_migrate import Migrate, upgrade as flask_migrate_upgrade
 from flask_compress import Compress
 from authlib.integrations.flask_client import OAuth
 
@@ -415,12 +418,12 @@ LOYALTY_PERCENT_PER_POINT = 0.1  # 1 điểm = giảm 0.1%
 LOYALTY_MAX_DISCOUNT_PERCENT = 40.0
 
 # ==== CẤU HÌNH VOUCHER TOÀN CỤC ====
-@cache.memoize(timeout=300)  # Cache voucher config for 5 minutes
 def get_voucher_config():
-    discount = HeThongCauHinh.query.filter_by(key='voucher_discount').first()
-    expires = HeThongCauHinh.query.filter_by(key='voucher_expires').first()
-    discount_percent = float(discount.value) if discount and discount.value else 10.0
-    expires_days = int(expires.value) if expires and expires.value else 60
+    config = load_config_store()
+    discount = config.get('voucher_discount')
+    expires = config.get('voucher_expires')
+    discount_percent = float(discount) if discount else 10.0
+    expires_days = int(expires) if expires else 60
     return discount_percent, expires_days
 
 # ==== ROUTE CÀI ĐẶT VOUCHER ====
@@ -434,15 +437,7 @@ def cai_dat_voucher():
         if discount_percent < 0 or discount_percent > 100:
             raise ValueError("discount_percent_range")
         # Lưu vào bảng cấu hình
-        for key, value in [('voucher_discount', discount_percent), ('voucher_expires', expires_days)]:
-            cauhinh = HeThongCauHinh.query.filter_by(key=key).first()
-            if cauhinh:
-                cauhinh.value = str(value)
-            else:
-                cauhinh = HeThongCauHinh(key=key, value=str(value))
-                db.session.add(cauhinh)
-        db.session.commit()
-        cache.delete_memoized(get_voucher_config)
+        set_config_values({'voucher_discount': discount_percent, 'voucher_expires': expires_days})
         flash('Đã cập nhật cấu hình voucher. Các mã hiện có giữ nguyên thông tin; voucher mới sẽ dùng cấu hình mới.', 'success')
     except Exception:
         flash('Dữ liệu không hợp lệ!', 'danger')
@@ -457,12 +452,43 @@ BANK_ID = "970423"
 BANK_ACCOUNT_NO = "99992162001"
 
 # Initialize SocketIO
-# Force threading mode because eventlet currently breaks on Python 3.13
-socketio = SocketIO(app, async_mode="threading")
+# SOCKETIO_MESSAGE_QUEUE nối các worker qua một hàng đợi chung để emit/room hoạt động
+# khi chạy nhiều tiến trình: redis://, amqp://, kafka://... (Flask-SocketIO hỗ trợ sẵn)
+# hoặc localbus://host:port cho máy dev (chạy `python socket_bus.py`).
+SOCKETIO_MESSAGE_QUEUE = os.getenv('SOCKETIO_MESSAGE_QUEUE', '').strip()
+SOCKETIO_CHANNEL = os.getenv('SOCKETIO_CHANNEL', 'flask-socketio')
+socketio_options = {}
+if SOCKETIO_MESSAGE_QUEUE.startswith('localbus://'):
+    from socket_bus import LocalBusManager
+    socketio_options['client_manager'] = LocalBusManager(SOCKETIO_MESSAGE_QUEUE, channel=SOCKETIO_CHANNEL)
+elif SOCKETIO_MESSAGE_QUEUE:
+    socketio_options['message_queue'] = SOCKETIO_MESSAGE_QUEUE
+    socketio_options['channel'] = SOCKETIO_CHANNEL
+# Mặc định threading (eventlet currently breaks on Python 3.13); serve.py đặt
+# SOCKETIO_ASYNC_MODE=gevent để chạy trên event loop khi triển khai thật
+SOCKETIO_ASYNC_MODE = os.getenv('SOCKETIO_ASYNC_MODE', 'threading')
+socketio = SocketIO(app, async_mode=SOCKETIO_ASYNC_MODE, **socketio_options)
+
+
+def run_blocking(func, *args, **kwargs):
+    """Run CPU-bound work (PDF, QR rendering) off the event loop; a plain call in threading mode.
+
+    Under gevent/eventlet socket I/O (PyMySQL, smtplib) is already cooperative
+    through monkey patching, but pure-Python CPU work would stall every
+    connection of the process, so it goes to the native thread pool. ``func``
+    must not touch the database session.
+    """
+    if SOCKETIO_ASYNC_MODE == 'gevent':
+        import gevent
+        return gevent.get_hub().threadpool.apply(func, args, kwargs)
+    if SOCKETIO_ASYNC_MODE == 'eventlet':
+        from eventlet import tpool
+        return tpool.execute(func, *args, **kwargs)
+    return func(*args, **kwargs)
 
 # Initialize SQLAlchemy and Flask-Login
 db = SQLAlchemy(app)
-migrate = Migrate(app, db)
+migrate = Migrate(app, db, directory=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'migrations'))
 login_manager = LoginManager(app)
 login_manager.login_view = "login"
 
@@ -750,6 +776,13 @@ class DatPhong(db.Model):
     auto_confirmed_at = db.Column(db.DateTime)
     created_at = db.Column(db.DateTime, default=datetime.now)
     diem_loyalty_da_cong = db.Column(db.Integer, default=0)
+
+    __table_args__ = (
+        # Kiểm tra trùng lịch của một phòng; báo cáo theo khoảng ngày thanh toán
+        db.Index("ix_datphong_phong_trang_thai_ngay", "phong_id", "trang_thai", "ngay_nhan", "ngay_tra"),
+        db.Index("ix_datphong_trang_thai_thuc_te_tra", "trang_thai", "thuc_te_tra"),
+    )
+
     voucher = db.relationship("Voucher")
     khachhang = db.relationship("KhachHang")
     phong = db.relationship("Phong")
@@ -776,6 +809,11 @@ class SuDungDichVu(db.Model):
     so_luong = db.Column(db.Integer, default=1)
     thoi_gian = db.Column(db.DateTime, default=datetime.now)
     trang_thai = db.Column(db.String(20), default='chua_thanh_toan')
+
+    __table_args__ = (
+        db.Index("ix_sudungdv_datphong_trang_thai", "datphong_id", "trang_thai"),
+    )
+
     datphong = db.relationship("DatPhong")
     dichvu   = db.relationship("DichVu")
 
@@ -788,6 +826,12 @@ class TinNhan(db.Model):
     noi_dung = db.Column(db.Text, nullable=False)
     thoi_gian = db.Column(db.DateTime, default=datetime.now)
     trang_thai = db.Column(db.String(20), default='chua_doc')
+
+    __table_args__ = (
+        # Đếm/đánh dấu tin chưa đọc của khách theo booking
+        db.Index("ix_tinnhan_datphong_nguoi_gui_trang_thai", "datphong_id", "nguoi_gui", "trang_thai"),
+    )
+
     datphong = db.relationship("DatPhong")
     nguoidung = db.relationship("NguoiDung")
 
@@ -799,23 +843,321 @@ class PaymentSession(db.Model):
     kind = db.Column(db.String(20), nullable=False)
     payload = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.now)
+    # Tách khỏi payload để tra cứu/xóa theo booking và dọn phiên hết hạn bằng index
+    dat_id = db.Column(db.Integer, index=True)
+    expires_at = db.Column(db.DateTime, index=True)
+    status = db.Column(db.String(20), default='pending', nullable=False)  # pending, completed
+
+    @property
+    def data(self):
+        try:
+            return json.loads(self.payload) if self.payload else {}
+        except Exception:
+            return {}
+
+
+class BookingDeadline(db.Model):
+    """Persisted deadline queue: when a hold or a no-show window of a booking runs out."""
+    __tablename__ = "booking_deadline"
+    id = db.Column(db.Integer, primary_key=True)
+    datphong_id = db.Column(db.Integer, db.ForeignKey("datphong.id", ondelete="CASCADE"), nullable=False)
+    kind = db.Column(db.String(20), nullable=False)  # hold, no_show
+    due_at = db.Column(db.DateTime, nullable=False, index=True)
+    created_at = db.Column(db.DateTime, default=datetime.now)
+
+    __table_args__ = (
+        db.UniqueConstraint("datphong_id", "kind", name="uq_booking_deadline"),
+    )
+
+
+class DashboardCounter(db.Model):
+    """Materialized dashboard numbers, adjusted in the same transaction as the booking/room change."""
+    __tablename__ = "dashboard_counter"
+    # checkin:YYYY-MM-DD, checkout:YYYY-MM-DD, phong:dang_o, phong:total
+    key = db.Column(db.String(64), primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+
+class RevenueDaily(db.Model):
+    """Revenue rolled up per payment day, room type, room, staff member and final status."""
+    __tablename__ = "revenue_daily"
+    ngay = db.Column(db.Date, primary_key=True)
+    loai_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    phong_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    # 0 = booking chưa gán nhân viên (cột khóa chính không nhận NULL)
+    nhanvien_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    # da_thanh_toan hoặc huy (khách mất tiền cọc)
+    trang_thai = db.Column(db.String(20), primary_key=True)
+    so_booking = db.Column(db.Integer, nullable=False, default=0)
+    tien_phong = db.Column(db.BIGINT, nullable=False, default=0)
+    tien_dv = db.Column(db.BIGINT, nullable=False, default=0)
+    tien_phat = db.Column(db.BIGINT, nullable=False, default=0)
+    tien_coc = db.Column(db.BIGINT, nullable=False, default=0)
+    tong_thanh_toan = db.Column(db.BIGINT, nullable=False, default=0)
+
+
+# ==== BỘ ĐẾM DASHBOARD ====
+# Bộ đếm được cộng/trừ theo từng lần flush khi DatPhong/Phong đổi trạng thái hoặc
+# ngày; các câu UPDATE hàng loạt (không qua ORM) tự gọi bump_dashboard_counters.
+# Dòng meta:rebuilt đánh dấu bảng đã được dựng đầy đủ bởi rebuild_dashboard_counters.
+DASHBOARD_REBUILT_KEY = 'meta:rebuilt'
+
+
+def _counter_day(value):
+    return value.date().isoformat() if isinstance(value, datetime) else str(value)
+
+
+def _booking_counter_keys(trang_thai, ngay_nhan, ngay_tra):
+    if trang_thai == 'dat' and ngay_nhan:
+        return [f"checkin:{_counter_day(ngay_nhan)}"]
+    if trang_thai == 'nhan' and ngay_tra:
+        return [f"checkout:{_counter_day(ngay_tra)}"]
+    return []
+
+
+def _room_counter_keys(trang_thai):
+    if trang_thai == 'dang_o':
+        return ['phong:total', 'phong:dang_o']
+    return ['phong:total']
+
+
+DASHBOARD_COUNTER_SOURCES = {
+    DatPhong: (('trang_thai', 'ngay_nhan', 'ngay_tra'), _booking_counter_keys),
+    Phong: (('trang_thai',), _room_counter_keys),
+}
+
+
+def _load_previous_value(target, value, oldvalue, initiator):
+    return value
+
+
+# active_history: giữ giá trị cũ kể cả khi thuộc tính đã expire sau commit
+for _counter_attr in (DatPhong.trang_thai, DatPhong.ngay_nhan, DatPhong.ngay_tra, Phong.trang_thai):
+    event.listen(_counter_attr, 'set', _load_previous_value, active_history=True, retval=True)
+
+
+def _counter_values(obj, attrs, previous):
+    state = inspect(obj)
+    values = []
+    for name in attrs:
+        history = state.attrs[name].history
+        if previous and history.deleted:
+            value = history.deleted[0]
+        else:
+            value = getattr(obj, name)
+        if value is None and state.pending:
+            # Bản ghi mới chưa gán giá trị: dùng default của cột như lúc INSERT
+            default = obj.__table__.c[name].default
+            if default is not None and default.is_scalar:
+                value = default.arg
+        values.append(value)
+    return values
+
+
+@event.listens_for(OrmSession, 'before_flush')
+def _collect_dashboard_deltas(session, flush_context, instances):
+    deltas = defaultdict(int)
+    for objects, before, after in ((session.new, False, True), (session.dirty, True, True), (session.deleted, True, False)):
+        for obj in objects:
+            source = DASHBOARD_COUNTER_SOURCES.get(type(obj))
+            if not source:
+                continue
+            attrs, keys_for = source
+            if before and obj not in session.new:
+                for key in keys_for(*_counter_values(obj, attrs, True)):
+                    deltas[key] -= 1
+            if after:
+                for key in keys_for(*_counter_values(obj, attrs, False)):
+                    deltas[key] += 1
+    session.info['dashboard_deltas'] = deltas
+
+
+@event.listens_for(OrmSession, 'after_flush')
+def _apply_dashboard_deltas(session, flush_context):
+    deltas = session.info.pop('dashboard_deltas', None)
+    if deltas:
+        bump_dashboard_counters(deltas, session.connection())
+
+
+def bump_dashboard_counters(deltas, connection=None):
+    """Add ``{key: delta}`` to the counters with one upsert; runs in the caller's transaction."""
+    rows = [{'key': key, 'value': delta} for key, delta in deltas.items() if delta]
+    if not rows:
+        return
+    stmt = mysql_insert(DashboardCounter.__table__)
+    stmt = stmt.on_duplicate_key_update(value=DashboardCounter.__table__.c.value + stmt.inserted.value)
+    (connection or db.session.connection()).execute(stmt, rows)
+
+
+def compute_dashboard_counters(today=None):
+    """Count every counter from scratch (check-in/check-out days from ``today`` onwards)."""
+    today = today or date.today()
+    start = datetime.combine(today, datetime.min.time())
+    values = defaultdict(int)
+    for ngay, so_luong in db.session.query(func.date(DatPhong.ngay_nhan), func.count(DatPhong.id)).filter(
+        DatPhong.trang_thai == 'dat', DatPhong.ngay_nhan >= start
+    ).group_by(func.date(DatPhong.ngay_nhan)):
+        values[f"checkin:{_counter_day(ngay)}"] = so_luong
+    for ngay, so_luong in db.session.query(func.date(DatPhong.ngay_tra), func.count(DatPhong.id)).filter(
+        DatPhong.trang_thai == 'nhan', DatPhong.ngay_tra >= start
+    ).group_by(func.date(DatPhong.ngay_tra)):
+        values[f"checkout:{_counter_day(ngay)}"] = so_luong
+    for trang_thai, so_luong in db.session.query(Phong.trang_thai, func.count(Phong.id)).group_by(Phong.trang_thai):
+        for key in _room_counter_keys(trang_thai):
+            values[key] += so_luong
+    return values
+
+
+def rebuild_dashboard_counters():
+    """Replace the counters table with fresh counts; bootstraps it and repairs drift from raw SQL writes."""
+    # Xóa trước để khóa các dòng bộ đếm, sau đó mới đếm lại
+    DashboardCounter.query.delete(synchronize_session=False)
+    values = compute_dashboard_counters()
+    values[DASHBOARD_REBUILT_KEY] = 1
+    bump_dashboard_counters(values)
+    db.session.commit()
+
+
+def read_dashboard_counters(keys):
+    """Read ``keys`` in one query, counting live if the table has never been rebuilt."""
+    rows = dict(
+        db.session.query(DashboardCounter.key, DashboardCounter.value)
+        .filter(DashboardCounter.key.in_(list(keys) + [DASHBOARD_REBUILT_KEY]))
+        .all()
+    )
+    if DASHBOARD_REBUILT_KEY not in rows:
+        rows = compute_dashboard_counters()
+    return {key: max(0, rows.get(key, 0)) for key in keys}
+
+
+# ==== DOANH THU THEO NGÀY ====
+# revenue_daily được cộng trong cùng transaction khi booking chuyển sang
+# da_thanh_toan (thanh_toan, api_confirm_payment) hoặc bị hủy mất cọc
+# (cancel_booking_for_no_show, expire_no_shows). Báo cáo doanh thu và bảng lương
+# chỉ đọc bảng này; `flask --app app rebuild-revenue` dựng lại khi cần.
+REVENUE_AMOUNT_COLUMNS = ('tien_phong', 'tien_dv', 'tien_phat', 'tien_coc', 'tong_thanh_toan')
+
+
+def revenue_booking_filter():
+    """Booking có ghi nhận doanh thu: đã thanh toán, hoặc đã hủy nhưng giữ tiền cọc."""
+    return db.and_(
+        DatPhong.thuc_te_tra.isnot(None),
+        db.or_(
+            DatPhong.trang_thai == 'da_thanh_toan',
+            db.and_(DatPhong.trang_thai == 'huy', DatPhong.tong_thanh_toan > 0)
+        )
+    )
+
+
+def add_booking_revenue(*criteria):
+    """Add the revenue bookings matching ``criteria`` to revenue_daily with one INSERT ... SELECT.
+
+    Runs in the caller's transaction; each booking must be added exactly once,
+    when it reaches its final state, so callers load it with lock_booking before
+    checking that state.
+    """
+    table = RevenueDaily.__table__
+    ngay = func.date(DatPhong.thuc_te_tra).label('ngay_tt')
+    nhanvien = func.coalesce(DatPhong.nhanvien_id, 0).label('nv_id')
+    rows = db.select(
+        ngay, Phong.loai_id, DatPhong.phong_id, nhanvien, DatPhong.trang_thai,
+        func.count(DatPhong.id),
+        *[func.coalesce(func.sum(getattr(DatPhong, name)), 0) for name in REVENUE_AMOUNT_COLUMNS]
+    ).join(Phong, DatPhong.phong_id == Phong.id).where(revenue_booking_filter(), *criteria).group_by(
+        'ngay_tt', Phong.loai_id, DatPhong.phong_id, 'nv_id', DatPhong.trang_thai
+    )
+    measures = ('so_booking',) + REVENUE_AMOUNT_COLUMNS
+    stmt = mysql_insert(table).from_select(
+        ['ngay', 'loai_id', 'phong_id', 'nhanvien_id', 'trang_thai', *measures], rows
+    )
+    stmt = stmt.on_duplicate_key_update({name: table.c[name] + stmt.inserted[name] for name in measures})
+    db.session.execute(stmt)
+
+
+def lock_booking(dat_id):
+    """Reload a booking with SELECT ... FOR UPDATE; a second request for it waits until the first commits."""
+    return DatPhong.query.filter_by(id=dat_id).with_for_update().populate_existing().first_or_404()
+
+
+def record_booking_revenue(dp):
+    """Flush ``dp`` and add it to revenue_daily; the caller commits."""
+    db.session.flush()
+    add_booking_revenue(DatPhong.id == dp.id)
+
+
+def rebuild_revenue_daily(start=None, end=None):
+    """Recompute revenue_daily from datphong, for the whole table or the days in [start, end)."""
+    stale = RevenueDaily.query
+    criteria = []
+    if start is not None:
+        stale = stale.filter(RevenueDaily.ngay >= start)
+        criteria.append(DatPhong.thuc_te_tra >= datetime.combine(start, datetime.min.time()))
+    if end is not None:
+        stale = stale.filter(RevenueDaily.ngay < end)
+        criteria.append(DatPhong.thuc_te_tra < datetime.combine(end, datetime.min.time()))
+    stale.delete(synchronize_session=False)
+    add_booking_revenue(*criteria)
+    db.session.commit()
+
+
+@app.cli.command('rebuild-revenue')
+@click.option('--tu-ngay', 'tu_ngay', type=click.DateTime(formats=['%Y-%m-%d']), help='Ngày đầu (YYYY-MM-DD), mặc định từ đầu')
+@click.option('--den-ngay', 'den_ngay', type=click.DateTime(formats=['%Y-%m-%d']), help='Ngày cuối (YYYY-MM-DD), tính cả ngày này')
+def rebuild_revenue_command(tu_ngay, den_ngay):
+    """Dựng lại bảng revenue_daily từ datphong."""
+    start = tu_ngay.date() if tu_ngay else None
+    end = den_ngay.date() + timedelta(days=1) if den_ngay else None
+    started = time.perf_counter()
+    rebuild_revenue_daily(start, end)
+    rows = RevenueDaily.query.count()
+    click.echo(f"revenue_daily: {rows} dòng sau {time.perf_counter() - started:.2f}s")
+
+
+def _as_date(value):
+    return value.date() if isinstance(value, datetime) else value
+
+
+def revenue_daily_range(start, end):
+    """Điều kiện trên revenue_daily cho các ngày thanh toán trong [start, end)."""
+    return RevenueDaily.ngay >= _as_date(start), RevenueDaily.ngay < _as_date(end)
+
+
+def staff_revenue(start, end):
+    """``{nhanvien_id: doanh thu}`` of paid bookings in [start, end), for payroll and bonuses."""
+    rows = db.session.query(
+        RevenueDaily.nhanvien_id,
+        func.coalesce(func.sum(RevenueDaily.tong_thanh_toan), 0)
+    ).filter(
+        RevenueDaily.trang_thai == 'da_thanh_toan',
+        RevenueDaily.nhanvien_id != 0,
+        *revenue_daily_range(start, end)
+    ).group_by(RevenueDaily.nhanvien_id).all()
+    return {nv_id: int(doanh_thu) for nv_id, doanh_thu in rows}
+
+
+def top_revenue_staff_ids(revenues):
+    """Nhân viên có doanh thu cao nhất (có thể đồng hạng); rỗng nếu chưa ai có doanh thu."""
+    top_max = max(revenues.values(), default=0)
+    if top_max <= 0:
+        return set()
+    return {nv_id for nv_id, doanh_thu in revenues.items() if doanh_thu == top_max}
 
 
 def get_payment_timeout_minutes():
-    setting = HeThongCauHinh.query.filter_by(key='payment_timeout_minutes').first()
-    if setting and setting.value:
+    value = load_config_store().get('payment_timeout_minutes')
+    if value:
         try:
-            minutes = int(setting.value)
+            minutes = int(value)
             if 1 <= minutes <= 60:
                 return minutes
             app.logger.warning(
                 "payment_timeout_minutes out of range: %s",
-                setting.value,
+                value,
             )
         except (TypeError, ValueError):
             app.logger.warning(
                 "Invalid payment_timeout_minutes value: %s",
-                setting.value,
+                value,
             )
     return DEFAULT_PAYMENT_TIMEOUT_MINUTES
 
@@ -824,72 +1166,333 @@ def get_payment_session_ttl():
     return timedelta(minutes=get_payment_timeout_minutes())
 
 
-def payment_session_expired(created_at, ttl=None):
-    if not created_at:
-        return True
-    now = datetime.now()
-    ttl = ttl or get_payment_session_ttl()
-    diff = now - created_at
-    expired = diff > ttl
-    app.logger.info(
-        "Payment session check: created_at=%s, now=%s, diff=%s, ttl=%s, expired=%s",
-        created_at,
-        now,
-        diff,
-        ttl,
-        expired,
-    )
-    return expired
-
-
 def payment_session_expires_at(created_at, ttl=None):
     base = created_at or datetime.now()
     ttl = ttl or get_payment_session_ttl()
     return base + ttl
 
 
+class PaymentSessionRepository:
+    """All reads and writes of payment_session go through here.
+
+    Lookups hit the unique token index or the dat_id index, and deletes are
+    single DELETE statements instead of load-then-delete loops over payloads.
+    """
+
+    def create(self, token, kind, data, now=None):
+        now = now or datetime.now()
+        session = PaymentSession(
+            token=token,
+            kind=kind,
+            payload=json.dumps(data),
+            created_at=now,
+            dat_id=data.get('dat_id'),
+            expires_at=payment_session_expires_at(now),
+            status='completed' if data.get('completed') else 'pending',
+        )
+        db.session.add(session)
+        return session
+
+    def get(self, token):
+        if not token:
+            return None
+        return PaymentSession.query.filter_by(token=token).first()
+
+    def for_booking(self, dat_id, kind=None):
+        query = PaymentSession.query.filter_by(dat_id=dat_id)
+        if kind:
+            query = query.filter_by(kind=kind)
+        return query.all()
+
+    def pending(self, now=None):
+        now = now or datetime.now()
+        return PaymentSession.query.filter(
+            PaymentSession.status == 'pending',
+            PaymentSession.expires_at > now
+        ).all()
+
+    def mark_completed(self, session, data):
+        data['completed'] = True
+        session.payload = json.dumps(data)
+        session.status = 'completed'
+
+    def delete(self, token):
+        return PaymentSession.query.filter_by(token=token).delete(synchronize_session=False)
+
+    def delete_tokens(self, tokens):
+        if not tokens:
+            return 0
+        return PaymentSession.query.filter(PaymentSession.token.in_(tokens)).delete(synchronize_session=False)
+
+    def delete_for_booking(self, kind, dat_id):
+        """Remove a booking's sessions of one kind; returns their tokens for status pushes."""
+        tokens = [row.token for row in db.session.query(PaymentSession.token).filter_by(dat_id=dat_id, kind=kind)]
+        if tokens:
+            PaymentSession.query.filter_by(dat_id=dat_id, kind=kind).delete(synchronize_session=False)
+        return tokens
+
+    def delete_expired(self, now=None):
+        now = now or datetime.now()
+        return PaymentSession.query.filter(PaymentSession.expires_at < now).delete(synchronize_session=False)
+
+    def created_at_for(self, tokens):
+        """Map token -> created_at for the given tokens, in one query."""
+        if not tokens:
+            return {}
+        return dict(
+            db.session.query(PaymentSession.token, PaymentSession.created_at)
+            .filter(PaymentSession.token.in_(tokens))
+            .all()
+        )
+
+
+class PaymentSessionRecord:
+    """A payment session held in the key-value store; same attributes as PaymentSession."""
+
+    __slots__ = ('token', 'kind', 'data', 'created_at', 'expires_at', 'status', 'dat_id')
+
+    def __init__(self, token, kind, data, created_at, expires_at, status='pending', dat_id=None):
+        self.token = token
+        self.kind = kind
+        self.data = data
+        self.created_at = created_at
+        self.expires_at = expires_at
+        self.status = status
+        self.dat_id = dat_id
+
+    def dumps(self):
+        return json.dumps({
+            'kind': self.kind,
+            'data': self.data,
+            'created_at': self.created_at.isoformat(),
+            'expires_at': self.expires_at.isoformat(),
+            'status': self.status,
+            'dat_id': self.dat_id,
+        })
+
+    @classmethod
+    def loads(cls, token, raw):
+        value = json.loads(raw)
+        return cls(
+            token,
+            value['kind'],
+            value.get('data') or {},
+            datetime.fromisoformat(value['created_at']),
+            datetime.fromisoformat(value['expires_at']),
+            value.get('status', 'pending'),
+            value.get('dat_id'),
+        )
+
+
+# Khóa trong kho còn sống thêm một khoảng sau expires_at để trang cảm ơn và
+# thông báo "đã hết hạn" vẫn đọc được phiên; sau đó kho tự xóa, không cần job dọn
+PAYMENT_SESSION_GRACE = timedelta(minutes=10)
+PAYMENT_SESSION_KINDS = ('deposit', 'service', 'room')
+
+
+class KeyValuePaymentSessionRepository:
+    """PaymentSessionRepository on a TTL key-value store (see session_store.py).
+
+    Each session is one key that expires by itself, so delete_expired has
+    nothing to do. Creates and updates are queued on the SQLAlchemy session and
+    written after it commits, like the rows they replace; deletes apply at once.
+    """
+
+    PREFIX = 'payment:session:'
+    PENDING_KEY = 'payment:pending'
+
+    def __init__(self, store):
+        self.store = store
+
+    def _key(self, token):
+        return self.PREFIX + token
+
+    @staticmethod
+    def _booking_key(kind, dat_id):
+        return f'payment:booking:{kind}:{dat_id}'
+
+    def _defer(self, record):
+        db.session.info.setdefault('payment_session_writes', {})[record.token] = record
+
+    def write(self, record):
+        ttl = (record.expires_at + PAYMENT_SESSION_GRACE - datetime.now()).total_seconds()
+        if ttl <= 0:
+            return
+        self.store.set(self._key(record.token), record.dumps(), ttl)
+        if record.dat_id is not None:
+            booking_key = self._booking_key(record.kind, record.dat_id)
+            self.store.sadd(booking_key, record.token)
+            self.store.expire(booking_key, ttl)
+        if record.status == 'pending':
+            self.store.sadd(self.PENDING_KEY, record.token)
+        else:
+            self.store.srem(self.PENDING_KEY, record.token)
+
+    def _load(self, tokens):
+        tokens = list(tokens)
+        records = []
+        for token, raw in zip(tokens, self.store.mget([self._key(token) for token in tokens])):
+            if raw is not None:
+                records.append(PaymentSessionRecord.loads(token, raw))
+        return records
+
+    def create(self, token, kind, data, now=None):
+        now = now or datetime.now()
+        record = PaymentSessionRecord(
+            token,
+            kind,
+            data,
+            now,
+            payment_session_expires_at(now),
+            'completed' if data.get('completed') else 'pending',
+            data.get('dat_id'),
+        )
+        self._defer(record)
+        return record
+
+    def get(self, token):
+        if not token:
+            return None
+        raw = self.store.get(self._key(token))
+        return PaymentSessionRecord.loads(token, raw) if raw is not None else None
+
+    def for_booking(self, dat_id, kind=None):
+        tokens = set()
+        for session_kind in ((kind,) if kind else PAYMENT_SESSION_KINDS):
+            tokens |= self.store.smembers(self._booking_key(session_kind, dat_id))
+        return self._load(tokens)
+
+    def pending(self, now=None):
+        now = now or datetime.now()
+        tokens = self.store.smembers(self.PENDING_KEY)
+        records = self._load(tokens)
+        # Token của phiên đã bị kho xóa được bỏ khỏi tập ngay lúc đọc
+        stale = tokens - {record.token for record in records if record.status == 'pending'}
+        if stale:
+            self.store.srem(self.PENDING_KEY, *stale)
+        return [record for record in records if record.status == 'pending' and record.expires_at > now]
+
+    def mark_completed(self, session, data):
+        data['completed'] = True
+        session.data = data
+        session.status = 'completed'
+        self._defer(session)
+
+    def _remove(self, records):
+        if not records:
+            return 0
+        removed = self.store.delete(*(self._key(record.token) for record in records))
+        self.store.srem(self.PENDING_KEY, *(record.token for record in records))
+        for record in records:
+            if record.dat_id is not None:
+                self.store.srem(self._booking_key(record.kind, record.dat_id), record.token)
+        return removed
+
+    def delete(self, token):
+        record = self.get(token)
+        return self._remove([record] if record else [])
+
+    def delete_tokens(self, tokens):
+        return self._remove(self._load(token for token in tokens if token))
+
+    def delete_for_booking(self, kind, dat_id):
+        """Remove a booking's sessions of one kind; returns their tokens for status pushes."""
+        records = self.for_booking(dat_id, kind)
+        self._remove(records)
+        return [record.token for record in records]
+
+    def delete_expired(self, now=None):
+        return 0
+
+    def created_at_for(self, tokens):
+        return {record.token: record.created_at for record in self._load(tokens)}
+
+
+@event.listens_for(OrmSession, 'after_commit')
+def _write_payment_sessions(session):
+    records = session.info.pop('payment_session_writes', None)
+    if records and isinstance(payment_sessions, KeyValuePaymentSessionRepository):
+        for record in records.values():
+            payment_sessions.write(record)
+
+
+@event.listens_for(OrmSession, 'after_rollback')
+def _drop_payment_session_writes(session):
+    session.info.pop('payment_session_writes', None)
+
+
+# PAYMENT_SESSION_STORE: sql (bảng payment_session, mặc định), kv://host:port
+# (`python session_store.py`), redis://host:port/db hoặc memory. Mọi tiến trình (web lẫn
+# worker.py) phải dùng cùng một kho; memory chỉ hợp khi chạy đúng một tiến trình và mất
+# sạch phiên khi khởi động lại, nên phải đặt tường minh.
+PAYMENT_SESSION_STORE = os.getenv('PAYMENT_SESSION_STORE', '').strip() or 'sql'
+if PAYMENT_SESSION_STORE == 'sql':
+    payment_sessions = PaymentSessionRepository()
+else:
+    from session_store import open_store
+    payment_sessions = KeyValuePaymentSessionRepository(open_store(PAYMENT_SESSION_STORE))
+
+
+def session_expires_at(session):
+    return session.expires_at or payment_session_expires_at(session.created_at)
+
+
 def create_payment_session(token, kind, data_dict):
-    session = PaymentSession(token=token, kind=kind, payload=json.dumps(data_dict))
-    db.session.add(session)
+    session = payment_sessions.create(token, kind, data_dict)
     db.session.commit()
+    if session.status == 'pending':
+        qr_images.prerender(url_for('qr_confirm', token=token, _external=True))
     return session
 
 
 def get_payment_session(token):
-    session = PaymentSession.query.filter_by(token=token).first()
+    session = payment_sessions.get(token)
     if not session:
         return None
-    try:
-        data = json.loads(session.payload) if session.payload else {}
-    except Exception:
-        data = {}
-    return {'kind': session.kind, 'data': data, 'created_at': session.created_at}
+    expires_at = session_expires_at(session)
+    return {
+        'kind': session.kind,
+        'data': session.data,
+        'created_at': session.created_at,
+        'expires_at': expires_at,
+        'expired': expires_at <= datetime.now(),
+        'status': session.status,
+        'dat_id': session.dat_id,
+    }
 
 
 def pop_payment_session(token):
-    session = PaymentSession.query.filter_by(token=token).first()
-    if session:
-        db.session.delete(session)
-        db.session.commit()
-        return True
-    return False
+    removed = payment_sessions.delete(token)
+    db.session.commit()
+    return bool(removed)
 
 
 def invalidate_payment_sessions(kind, dat_id):
-    removed = []
-    for session in PaymentSession.query.filter_by(kind=kind).all():
-        try:
-            payload = json.loads(session.payload or "{}")
-        except Exception:
-            payload = {}
-        if payload.get('dat_id') == dat_id:
-            removed.append(session.token)
-            db.session.delete(session)
+    removed = payment_sessions.delete_for_booking(kind, dat_id)
     if removed:
         db.session.commit()
+        for token in removed:
+            push_payment_status(token)
     return removed
 
 
+def complete_payment_sessions(kind, dat_id, redirect_url):
+    """Mark a booking's pending sessions of one kind completed when staff took the payment.
+
+    ``redirect_url(token)`` builds where the guest's QR page goes next. The caller
+    commits, then pushes the returned tokens with push_payment_status.
+    """
+    tokens = []
+    for session in payment_sessions.for_booking(dat_id, kind):
+        if session.status != 'pending':
+            continue
+        data = session.data
+        data['redirect_url'] = redirect_url(session.token)
+        payment_sessions.mark_completed(session, data)
+        tokens.append(session.token)
+    return tokens
+
+
 def build_vietqr_url(amount, description):
     encoded_description = quote(description)
     return (
@@ -898,30 +1501,115 @@ def build_vietqr_url(amount, description):
     )
 
 
-def generate_qr_code(url):
+def _render_qr_png(content):
+    import qrcode
+
     qr = qrcode.QRCode(
         version=1,
         error_correction=qrcode.constants.ERROR_CORRECT_L,
         box_size=10,
         border=4,
     )
-    qr.add_data(url)
+    qr.add_data(content)
     qr.make(fit=True)
     img = qr.make_image(fill_color="black", back_color="white")
     buf = io.BytesIO()
     img.save(buf, format='PNG')
-    buf.seek(0)
-    return buf
+    return buf.getvalue()
+
+
+class BytesLru:
+    """Thread-safe LRU of rendered bytes, bounded by their total size."""
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self._items = OrderedDict()
+        self._size = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'evictions': 0, 'render_ms': 0.0}
+
+    def lookup(self, key):
+        with self._lock:
+            data = self._items.get(key)
+            if data is None:
+                self._stats['misses'] += 1
+                return None
+            self._items.move_to_end(key)
+            self._stats['hits'] += 1
+            return data
+
+    def store(self, key, data, render_ms=0.0):
+        with self._lock:
+            self._stats['render_ms'] += render_ms
+            if key in self._items or len(data) > self.max_bytes:
+                return
+            self._items[key] = data
+            self._size += len(data)
+            while self._size > self.max_bytes:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+                self._stats['evictions'] += 1
+
+    def stats(self):
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                **self._stats,
+                'entries': len(self._items),
+                'bytes': self._size,
+                'max_bytes': self.max_bytes,
+                'hit_rate': round(self._stats['hits'] / lookups, 3) if lookups else None,
+            }
+
+
+# Đổi khi đổi tham số vẽ ở _render_qr_png để ETag cũ không còn khớp
+QR_RENDER_VERSION = 'v1-L-10-4'
+QR_CACHE_MAX_BYTES = int(os.getenv('QR_CACHE_MAX_BYTES', str(4 * 1024 * 1024)))
+
+
+class QrImageCache:
+    """PNG QR codes keyed by their encoded content, LRU-bounded by total bytes.
+
+    The ETag depends only on the content, so a browser revalidating a QR page
+    gets a 304 without the image being rendered or even held in memory.
+    """
+
+    def __init__(self, max_bytes=QR_CACHE_MAX_BYTES):
+        self._images = BytesLru(max_bytes)
+
+    @staticmethod
+    def etag(content):
+        return hashlib.sha1(f'{QR_RENDER_VERSION}:{content}'.encode('utf-8')).hexdigest()
+
+    def lookup(self, content):
+        """Cached PNG for ``content`` or None; never renders."""
+        return self._images.lookup(content)
+
+    def render(self, content):
+        started = time.perf_counter()
+        png = _render_qr_png(content)
+        self._images.store(content, png, (time.perf_counter() - started) * 1000)
+        return png
+
+    def prerender(self, content):
+        """Render ``content`` in the background so the first page view is a cache hit."""
+        socketio.start_background_task(run_blocking, self.render, content)
+
+    def stats(self):
+        return self._images.stats()
+
+
+qr_images = QrImageCache()
 
 
 def _payment_session_common(token, expected_kind):
     session = get_payment_session(token)
     if not session or session['kind'] != expected_kind:
         return None, 'Phien thanh toan khong hop le hoac da het han.'
-    if payment_session_expired(session['created_at']):
+    if session['expired']:
         pop_payment_session(token)
         return None, 'Phien thanh toan da het han (qua 5 phut).'
-    expires_at = payment_session_expires_at(session['created_at'])
+    expires_at = session['expires_at']
     remaining = max(0, int((expires_at - datetime.now()).total_seconds()))
     return {
         'data': session['data'],
@@ -931,6 +1619,38 @@ def _payment_session_common(token, expected_kind):
     }, None
 
 
+def _hold_remaining_seconds(hold_started_at, ttl, now):
+    """Seconds left on a cho_xac_nhan hold, or None once the hold has lapsed."""
+    if not hold_started_at:
+        return None
+    remaining = (hold_started_at + ttl - now).total_seconds()
+    return remaining if remaining >= 0 else None
+
+
+def load_hold_session_starts(bookings):
+    """Map payment_token -> session created_at for the pending holds, in one lookup."""
+    tokens = {b.payment_token for b in bookings if b.trang_thai == 'cho_xac_nhan' and b.payment_token}
+    if not tokens:
+        return {}
+    return payment_sessions.created_at_for(tokens)
+
+
+def hold_started_at(booking, session_started):
+    """When the hold began: its payment session if it has a token, else the booking itself."""
+    if booking.payment_token:
+        return session_started.get(booking.payment_token)
+    return booking.created_at
+
+
+def hold_remaining_seconds(booking, session_started, ttl, now):
+    return _hold_remaining_seconds(hold_started_at(booking, session_started), ttl, now)
+
+
+def hold_is_expired(booking, session_started, ttl, now):
+    """Pure check used by read paths; only expire_lapsed_holds writes the transition."""
+    return booking.trang_thai == 'cho_xac_nhan' and hold_remaining_seconds(booking, session_started, ttl, now) is None
+
+
 class LuongThuongCauHinh(db.Model):
     __tablename__ = "luongthuongcauhinh"
     id = db.Column(db.Integer, primary_key=True)
@@ -993,6 +1713,17 @@ class EmailLog(db.Model):
     sent_by = db.Column(db.Integer, db.ForeignKey("nguoidung.id"))
     datphong_id = db.Column(db.Integer, db.ForeignKey("datphong.id"))
     khachhang_id = db.Column(db.Integer, db.ForeignKey("khachhang.id"))
+    # Hàng đợi gửi (outbox): số lần đã thử, thời điểm được thử tiếp, file đính kèm (JSON base64)
+    attempts = db.Column(db.Integer, default=0)
+    next_attempt_at = db.Column(db.DateTime)
+    attachments = db.Column(db.Text().with_variant(LONGTEXT, 'mysql'))
+
+    __table_args__ = (
+        db.Index("ix_email_log_outbox", "status", "next_attempt_at"),
+        # Trang lịch sử email: lọc theo trạng thái hoặc không, mới nhất trước
+        db.Index("ix_email_log_status_sent_at", "status", "sent_at"),
+        db.Index("ix_email_log_sent_at", "sent_at"),
+    )
     
     # Relationships
     sender = db.relationship("NguoiDung", foreign_keys=[sent_by])
@@ -1009,6 +1740,12 @@ class Attendance(db.Model):
     note = db.Column(db.String(255))
     approved_by = db.Column(db.Integer, db.ForeignKey("nguoidung.id"))
     approved_time = db.Column(db.DateTime)
+
+    __table_args__ = (
+        # Số ngày công đã duyệt của một nhân viên trong tháng
+        db.Index("ix_attendance_user_status_checkin", "user_id", "status", "checkin_time"),
+    )
+
     user = db.relationship("NguoiDung", foreign_keys=[user_id])
     approver = db.relationship("NguoiDung", foreign_keys=[approved_by])
 
@@ -1196,6 +1933,9 @@ def persist_message(datphong_id, sender, content_dict_or_text, user_id=None):
     )
     db.session.add(msg)
     db.session.commit()
+    if sender == 'khach':
+        refresh_badge_counts()
+    push_chat_message(msg)
     return msg
 
 
@@ -1407,28 +2147,134 @@ def api_attendance_list():
         'search_query': search_query
     })
 
+# ==== KÊNH SOCKET.IO ====
+# staff: mọi nhân viên đã đăng nhập (tự vào khi kết nối);
+# staff:<quyền>: nhân viên có quyền tương ứng trong SOCKET_PERMISSION_ROOMS;
+# <chat_token>: phiên chat của một booking (khách/tab giữ token);
+# payment:<token>: trang QR đang chờ kết quả một phiên thanh toán.
+# Không emit broadcast: mọi sự kiện phải đi qua một trong các phòng trên.
+STAFF_SOCKET_ROOM = 'staff'
+SOCKET_PERMISSION_ROOMS = (
+    'communications.chat',
+    'bookings.manage_online',
+    'bookings.manage_waiting',
+    'bookings.cancel',
+    'payments.process',
+)
+
+
+def staff_socket_room(permission=None):
+    return f"{STAFF_SOCKET_ROOM}:{permission}" if permission else STAFF_SOCKET_ROOM
+
+
+def booking_socket_room(chat_token):
+    return chat_token
+
+
+def payment_socket_room(token):
+    return f"payment:{token}"
+
+
+def staff_socket_rooms_for(user):
+    """Rooms a staff socket joins on connect: the shared room plus one per realtime permission held."""
+    return [STAFF_SOCKET_ROOM] + [
+        staff_socket_room(permission)
+        for permission in SOCKET_PERMISSION_ROOMS
+        if user.has_permission(permission)
+    ]
+
+
+def emit_to_staff(event, data, permission=None):
+    socketio.emit(event, data, to=staff_socket_room(permission))
+
+
+def emit_to_booking(event, data, chat_token):
+    if chat_token:
+        socketio.emit(event, data, to=booking_socket_room(chat_token))
+
+
+def push_chat_message(msg):
+    """Send a persisted message to the booking's chat room so open chat pages append it."""
+    dp = msg.datphong
+    if not dp or not dp.chat_token:
+        return
+    try:
+        emit_to_booking('chat_message', serialize_message(msg), dp.chat_token)
+    except Exception as exc:
+        app.logger.warning(f"Không thể đẩy tin nhắn {msg.id}: {exc}")
+
+
+def push_payment_status(token):
+    """Push the current /api/payment/status payload to pages waiting on ``token``."""
+    try:
+        payload = payment_status_payload(token)
+    except Exception as exc:
+        app.logger.warning(f"Không thể đẩy trạng thái thanh toán: {exc}")
+        return
+    socketio.emit('payment_status', {'token': token, **payload}, to=payment_socket_room(token))
+
+
+# ==== BADGE MENU NHÂN VIÊN ====
+# Số tin nhắn chưa đọc và số đặt phòng online chờ xác nhận giống nhau với mọi
+# nhân viên nên chỉ tính một lần cho cả tiến trình; khi dữ liệu đổi thì tính lại
+# và đẩy qua Socket.IO tới phòng STAFF_SOCKET_ROOM.
+BADGE_COUNT_TTL_SECONDS = 15
+_badge_counts = {'values': None, 'expires_at': 0.0}
+
+
+def compute_badge_counts():
+    unread_messages = TinNhan.query.join(DatPhong).filter(
+        TinNhan.trang_thai == 'chua_doc',
+        TinNhan.nguoi_gui == 'khach',
+        DatPhong.trang_thai == 'nhan'
+    ).count()
+    pending_online = DatPhong.query.join(
+        TinNhan,
+        db.and_(
+            TinNhan.datphong_id == DatPhong.id,
+            TinNhan.nguoi_gui == 'khach',
+            TinNhan.noi_dung == ONLINE_DEPOSIT_REQUEST_MESSAGE
+        )
+    ).filter(
+        DatPhong.trang_thai == 'cho_xac_nhan'
+    ).distinct().count()
+    return {'unread_messages': unread_messages, 'pending_online': pending_online}
+
+
+def get_badge_counts():
+    """Badge counts shared by every staff session, recomputed at most every BADGE_COUNT_TTL_SECONDS."""
+    values = _badge_counts['values']
+    if values is None or time.monotonic() >= _badge_counts['expires_at']:
+        values = compute_badge_counts()
+        _badge_counts['values'] = values
+        _badge_counts['expires_at'] = time.monotonic() + BADGE_COUNT_TTL_SECONDS
+    return values
+
+
+def refresh_badge_counts():
+    """Recompute after a committed change and push the new counts to connected staff."""
+    _badge_counts['values'] = None
+    try:
+        counts = get_badge_counts()
+    except Exception as exc:
+        app.logger.warning(f"Không thể cập nhật badge: {exc}")
+        return
+    emit_to_staff('badge_counts', counts)
+
+
 @app.context_processor
 def inject_globals():
     unread_count = 0
     pending_online_count = 0
     if current_user.is_authenticated:
-        if current_user.has_permission('communications.chat'):
-            unread_count = TinNhan.query.join(DatPhong).filter(
-                TinNhan.trang_thai == 'chua_doc',
-                TinNhan.nguoi_gui == 'khach',
-                DatPhong.trang_thai == 'nhan'
-            ).count()
-        if current_user.has_permission('bookings.manage_online'):
-            pending_online_count = DatPhong.query.join(
-                TinNhan,
-                db.and_(
-                    TinNhan.datphong_id == DatPhong.id,
-                    TinNhan.nguoi_gui == 'khach',
-                    TinNhan.noi_dung == ONLINE_DEPOSIT_REQUEST_MESSAGE
-                )
-            ).filter(
-                DatPhong.trang_thai == 'cho_xac_nhan'
-            ).distinct().count()
+        can_chat = current_user.has_permission('communications.chat')
+        can_manage_online = current_user.has_permission('bookings.manage_online')
+        if can_chat or can_manage_online:
+            counts = get_badge_counts()
+            if can_chat:
+                unread_count = counts['unread_messages']
+            if can_manage_online:
+                pending_online_count = counts['pending_online']
     return dict(
         now=datetime.now,
         unread_messages=unread_count,
@@ -1438,67 +2284,8 @@ def inject_globals():
     )
 
 
-def ensure_tables_exist():
-    try:
-        db.create_all()
-        try:
-            inspector = inspect(db.engine)
-            user_columns = {col['name'] for col in inspector.get_columns('nguoidung')}
-            if 'role_id' not in user_columns:
-                with db.engine.connect() as conn:
-                    conn.execute(text('ALTER TABLE nguoidung ADD COLUMN role_id INT NULL'))
-            columns = {col['name'] for col in inspector.get_columns('khachhang')}
-            if 'email' not in columns:
-                with db.engine.connect() as conn:
-                    conn.execute(text('ALTER TABLE khachhang ADD COLUMN email VARCHAR(120)'))
-            if 'mat_khau_hash' not in columns:
-                with db.engine.connect() as conn:
-                    conn.execute(text('ALTER TABLE khachhang ADD COLUMN mat_khau_hash VARCHAR(255)'))
-            if 'diem_tich_luy' not in columns:
-                with db.engine.connect() as conn:
-                    conn.execute(text('ALTER TABLE khachhang ADD COLUMN diem_tich_luy INT DEFAULT 0'))
-            if 'ngay_dang_ky' not in columns:
-                with db.engine.connect() as conn:
-                    conn.execute(text('ALTER TABLE khachhang ADD COLUMN ngay_dang_ky DATETIME NULL'))
-            if 'ngay_cap_nhat' not in columns:
-                with db.engine.connect() as conn:
-                    conn.execute(text('ALTER TABLE khachhang ADD COLUMN ngay_cap_nhat DATETIME NULL'))
-            if 'lan_dang_nhap_cuoi' not in columns:
-                with db.engine.connect() as conn:
-                    conn.execute(text('ALTER TABLE khachhang ADD COLUMN lan_dang_nhap_cuoi DATETIME NULL'))
-            if 'trang_thai_tai_khoan' not in columns:
-                with db.engine.connect() as conn:
-                    conn.execute(text("ALTER TABLE khachhang ADD COLUMN trang_thai_tai_khoan VARCHAR(20) DEFAULT 'hoat_dong'"))
-            if 'deleted_at' not in columns:
-                with db.engine.connect() as conn:
-                    conn.execute(text('ALTER TABLE khachhang ADD COLUMN deleted_at DATETIME NULL'))
-            if 'deleted_reason' not in columns:
-                with db.engine.connect() as conn:
-                    conn.execute(text('ALTER TABLE khachhang ADD COLUMN deleted_reason VARCHAR(255) NULL'))
-            if 'deleted_by' not in columns:
-                with db.engine.connect() as conn:
-                    conn.execute(text('ALTER TABLE khachhang ADD COLUMN deleted_by INT NULL'))
-            columns_datphong = {col['name'] for col in inspector.get_columns('datphong')}
-            if 'created_at' not in columns_datphong:
-                with db.engine.connect() as conn:
-                    conn.execute(text('ALTER TABLE datphong ADD COLUMN created_at DATETIME DEFAULT CURRENT_TIMESTAMP'))
-            if 'diem_loyalty_da_cong' not in columns_datphong:
-                with db.engine.connect() as conn:
-                    conn.execute(text('ALTER TABLE datphong ADD COLUMN diem_loyalty_da_cong INT DEFAULT 0'))
-            voucher_columns = inspector.get_columns('voucher')
-            discount_column = next((col for col in voucher_columns if col['name'] == 'discount_percent'), None)
-            if discount_column and discount_column['type'].__class__.__name__.lower() in {'integer', 'smallinteger', 'bigint'}:
-                with db.engine.connect() as conn:
-                    conn.execute(text('ALTER TABLE voucher MODIFY COLUMN discount_percent FLOAT DEFAULT 10'))
-        except Exception as exc:
-            app.logger.warning("Không thể đảm bảo cột cho bảng: %s", exc)
-        ensure_default_roles()
-    except Exception as exc:
-        app.logger.warning("Không thể tạo bảng tự động: %s", exc)
-
-
-def ensure_customer_email_templates():
-    templates = {
+def customer_email_template_defaults():
+    return {
         'customer_welcome': {
             'subject': 'Chào mừng {{ ho_ten }} trở thành thành viên {{ ten_khach_san }}',
             'body': """<!DOCTYPE html>
@@ -1748,9 +2535,14 @@ def ensure_customer_email_templates():
 </html>"""
         }
     }
+
+
+def ensure_customer_email_templates():
+    templates = customer_email_template_defaults()
+    rows = {tpl.key: tpl for tpl in EmailTemplate.query.filter(EmailTemplate.key.in_(list(templates))).all()}
     changed = False
     for key, tpl in templates.items():
-        existing = EmailTemplate.query.filter_by(key=key).first()
+        existing = rows.get(key)
         if existing:
             if existing.subject != tpl['subject'] or existing.body != tpl['body']:
                 existing.subject = tpl['subject']
@@ -1763,11 +2555,6 @@ def ensure_customer_email_templates():
         db.session.commit()
 
 
-with app.app_context():
-    ensure_tables_exist()
-    ensure_customer_email_templates()
-
-
 def tinh_thuong_doanh_thu(doanh_thu, tiers):
     applicable = None
     sorted_tiers = sorted(tiers, key=lambda t: (t.moc_duoi or 0))
@@ -1787,10 +2574,44 @@ def tinh_thuong_doanh_thu(doanh_thu, tiers):
 TOP_REVENUE_BONUS_DEFAULT = 500_000
 
 
+# ==== BỘ NHỚ ĐỆM CẤU HÌNH ====
+# Toàn bộ bảng hethongcauhinh được nạp vào bộ nhớ; mỗi lần ghi cấu hình sẽ đổi
+# dòng config_version để các worker khác nạp lại. Việc kiểm tra phiên bản chỉ
+# chạy tối đa mỗi CONFIG_VERSION_CHECK_SECONDS giây.
+CONFIG_VERSION_KEY = 'config_version'
+CONFIG_VERSION_CHECK_SECONDS = float(os.getenv('CONFIG_VERSION_CHECK_SECONDS', '5'))
+_config_store = {'values': None, 'version': None, 'checked_at': 0.0}
+
+
+def load_config_store():
+    """Return the in-memory ``{key: value}`` snapshot of hethongcauhinh, reloading if another worker changed it."""
+    values = _config_store['values']
+    now = time.monotonic()
+    if values is not None and now - _config_store['checked_at'] < CONFIG_VERSION_CHECK_SECONDS:
+        return values
+    version = db.session.query(HeThongCauHinh.value).filter_by(key=CONFIG_VERSION_KEY).scalar()
+    if values is None or version != _config_store['version']:
+        values = dict(db.session.query(HeThongCauHinh.key, HeThongCauHinh.value).all())
+        _config_store['values'] = values
+        _config_store['version'] = version
+    _config_store['checked_at'] = now
+    return values
+
+
+def mark_config_changed():
+    """Stamp a new config version in the caller's transaction and drop the local snapshot."""
+    version = HeThongCauHinh.query.filter_by(key=CONFIG_VERSION_KEY).first()
+    if not version:
+        version = HeThongCauHinh(key=CONFIG_VERSION_KEY)
+        db.session.add(version)
+    version.value = uuid.uuid4().hex
+    _config_store['values'] = None
+
+
 def get_config_value(key, default=''):
-    setting = HeThongCauHinh.query.filter_by(key=key).first()
-    if setting and setting.value is not None:
-        return setting.value
+    value = load_config_store().get(key)
+    if value is not None:
+        return value
     return default
 
 
@@ -1829,6 +2650,7 @@ def resolve_public_base_url():
 
 
 def set_config_values(pairs):
+    """Upsert several config keys in one commit, skipping unchanged values."""
     dirty = False
     for key, value in pairs.items():
         setting = HeThongCauHinh.query.filter_by(key=key).first()
@@ -1840,14 +2662,15 @@ def set_config_values(pairs):
             setting.value = new_value
             dirty = True
     if dirty:
+        mark_config_changed()
         db.session.commit()
 
 
 def get_config_int(key, default):
-    setting = HeThongCauHinh.query.filter_by(key=key).first()
-    if setting:
+    value = load_config_store().get(key)
+    if value is not None:
         try:
-            return max(0, int(setting.value))
+            return max(0, int(value))
         except (ValueError, TypeError):
             pass
     return default
@@ -1859,8 +2682,78 @@ def set_config_int(key, value):
         setting = HeThongCauHinh(key=key)
         db.session.add(setting)
     setting.value = str(value)
+    mark_config_changed()
     db.session.commit()
 
+
+# ==== PHIÊN BẢN SCHEMA ====
+# Revision mới nhất trong migrations/versions - tăng cùng lúc khi thêm revision mới
+SCHEMA_REVISION = '0005_hot_query_indexes'
+SCHEMA_VERSION_KEY = 'schema_version'
+SCHEMA_UPGRADE_LOCK = 'btl_internet_schema_upgrade'
+AUTO_MIGRATE = os.getenv('AUTO_MIGRATE', '1').strip().lower() not in {'0', 'false', 'no'}
+
+
+def schema_fingerprint():
+    """Revision schema + mã băm dữ liệu mặc định (quyền admin, mẫu email khách hàng)."""
+    seed = json.dumps({
+        'admin_permissions': sorted(DEFAULT_ROLE_PERMISSIONS['admin']),
+        'customer_email_templates': customer_email_template_defaults(),
+    }, sort_keys=True)
+    return f"{SCHEMA_REVISION}:{hashlib.sha1(seed.encode('utf-8')).hexdigest()[:12]}"
+
+
+def read_schema_version():
+    try:
+        return db.session.query(HeThongCauHinh.value).filter_by(key=SCHEMA_VERSION_KEY).scalar()
+    except Exception:
+        # Bảng cấu hình chưa có (CSDL trống) hoặc chưa kết nối được
+        db.session.rollback()
+        return None
+
+
+def ensure_database_ready():
+    """Startup check: one indexed read of the schema_version row.
+
+    When it already matches this build nothing else runs. Otherwise one process
+    takes a MySQL named lock, applies the Alembic revisions (only with
+    AUTO_MIGRATE; else they must already be applied via `flask db upgrade`),
+    re-seeds roles/templates and records the new version. Workers booting at
+    the same time wait on the lock and then see the row up to date.
+    """
+    expected = schema_fingerprint()
+    if read_schema_version() == expected:
+        return True
+    try:
+        with db.engine.connect() as lock_conn:
+            if not lock_conn.execute(text('SELECT GET_LOCK(:name, 300)'), {'name': SCHEMA_UPGRADE_LOCK}).scalar():
+                app.logger.warning("Không lấy được khóa nâng cấp schema, bỏ qua")
+                return False
+            try:
+                if read_schema_version() == expected:
+                    return True
+                if AUTO_MIGRATE:
+                    flask_migrate_upgrade()
+                elif db.session.execute(text('SELECT version_num FROM alembic_version')).scalar() != SCHEMA_REVISION:
+                    app.logger.warning("Schema CSDL chưa cập nhật, hãy chạy `flask --app app db upgrade` (AUTO_MIGRATE=0)")
+                    return False
+                ensure_default_roles()
+                ensure_customer_email_templates()
+                set_config_values({SCHEMA_VERSION_KEY: expected})
+                app.logger.info(f"Đã nâng cấp schema CSDL lên {expected}")
+                return True
+            finally:
+                lock_conn.execute(text('SELECT RELEASE_LOCK(:name)'), {'name': SCHEMA_UPGRADE_LOCK})
+    except Exception as exc:
+        db.session.rollback()
+        app.logger.warning(f"Không thể nâng cấp schema CSDL: {exc}")
+        return False
+
+
+with app.app_context():
+    ensure_database_ready()
+
+
 def get_top_bonus():
     return get_config_int('TOP_REVENUE_BONUS', TOP_REVENUE_BONUS_DEFAULT)
 
@@ -2555,26 +3448,42 @@ def _pdf_safe_text(value):
         return ''.join(ch for ch in normalized if not unicodedata.combining(ch))
 
 
-def generate_invoice_pdf(dp, dich_vu_su_dung):
+class _PdfTextRecorder:
+    """Collects setFont/textLine calls so the reportlab rendering can run without the DB session."""
+
+    def __init__(self):
+        self.ops = []
+
+    def setFont(self, name, size):
+        self.ops.append(('font', name, size))
+
+    def textLine(self, line=''):
+        self.ops.append(('line', line))
+
+
+def _require_reportlab():
     try:
-        from reportlab.lib.pagesizes import A4
-        from reportlab.pdfgen import canvas
+        import reportlab  # noqa: F401
     except ImportError as exc:
         raise RuntimeError('Chưa cài đặt thư viện reportlab để tạo file PDF hóa đơn.') from exc
 
-    so_dem, tien_phong, tong_tien_dv, tien_phat, tong, checkin, checkout, don_vi_tinh, so_luong_tinh = snapshot_and_bill(dp)
+
+def build_invoice_pdf_ops(dp, dich_vu_su_dung, hotel=None):
+    """Record the invoice text of ``dp``; ``dich_vu_su_dung`` are its paid service rows."""
+    so_dem, tien_phong, tong_tien_dv, tien_phat, tong, checkin, checkout, don_vi_tinh, so_luong_tinh = snapshot_and_bill(
+        dp, dich_vu_da_thanh_toan=dich_vu_su_dung
+    )
     tong_thanh_toan = dp.tong_thanh_toan or tong
     tien_coc = dp.tien_coc or 0
     tien_dv_da_thanh_toan = sum((dv.dichvu.gia * dv.so_luong) for dv in dich_vu_su_dung)
     tien_con_lai = max(0, tong_thanh_toan - tien_coc - tien_dv_da_thanh_toan)
 
-    hotel = get_hotel_profile()
-
-    buffer = io.BytesIO()
-    pdf = canvas.Canvas(buffer, pagesize=A4)
-    width, height = A4
+    hotel = hotel or get_hotel_profile()
+    # Hóa đơn đã thanh toán ghi ngày hoàn tất để file PDF giống hệt nhau giữa các lần tạo
+    ngay_lap = dp.thuc_te_tra if dp.trang_thai == 'da_thanh_toan' and dp.thuc_te_tra else datetime.now()
 
-    text = pdf.beginText(40, height - 50)
+    # Đọc dữ liệu ở đây (cần DB session), phần vẽ PDF chạy qua run_blocking
+    text = _PdfTextRecorder()
     text.setFont('Helvetica-Bold', 16)
     text.textLine(_pdf_safe_text(hotel.get('name') or 'Hoa don khach san'))
     text.setFont('Helvetica', 10)
@@ -2588,7 +3497,7 @@ def generate_invoice_pdf(dp, dich_vu_su_dung):
     text.setFont('Helvetica-Bold', 13)
     text.textLine(_pdf_safe_text(f"Hoa don dat phong #{dp.id}"))
     text.setFont('Helvetica', 10)
-    text.textLine(_pdf_safe_text(f"Ngay lap: {fmt_dt(datetime.now())}"))
+    text.textLine(_pdf_safe_text(f"Ngay lap: {fmt_dt(ngay_lap)}"))
 
     text.textLine('')
     text.setFont('Helvetica-Bold', 11)
@@ -2644,24 +3553,180 @@ def generate_invoice_pdf(dp, dich_vu_su_dung):
     text.textLine('')
     text.setFont('Helvetica', 9)
     text.textLine(_pdf_safe_text('Xin cam on quy khach da lua chon khach san cua chung toi!'))
+    return text.ops
+
+
+INVOICE_PDF_CACHE_MAX_BYTES = int(os.getenv('INVOICE_PDF_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+INVOICE_PDF_PROCESSES = max(1, int(os.getenv('INVOICE_PDF_PROCESSES', str(min(4, os.cpu_count() or 1)))))
+
+
+class InvoicePdfService:
+    """Invoice PDFs per booking; bytes of paid bookings are cached by their billing state.
+
+    The state key hashes everything the invoice prints (booking amounts and
+    dates, paid service rows, customer, room, voucher, hotel profile), so any
+    later edit produces a new key instead of a stale PDF.
+    """
+
+    def __init__(self, max_bytes=INVOICE_PDF_CACHE_MAX_BYTES):
+        self._pdfs = BytesLru(max_bytes)
+
+    @staticmethod
+    def state_key(dp, dich_vu_su_dung, hotel):
+        kh, phong, voucher = dp.khachhang, dp.phong, dp.voucher
+        state = [
+            dp.id, dp.trang_thai, dp.hinh_thuc_thue, dp.ngay_nhan, dp.ngay_tra, dp.thuc_te_nhan, dp.thuc_te_tra,
+            dp.tien_coc, dp.tien_phong, dp.tien_dv, dp.tien_phat, dp.tong_thanh_toan,
+            kh.ho_ten, kh.cmnd, kh.sdt, kh.email, kh.dia_chi,
+            phong.ten, phong.loai.ten, phong.loai.gia,
+            [voucher.code, voucher.discount_percent] if voucher else None,
+            sorted([dv.id, dv.so_luong, dv.dichvu.ten, dv.dichvu.gia] for dv in dich_vu_su_dung),
+            hotel,
+        ]
+        return hashlib.sha1(json.dumps(state, default=str).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def cacheable(dp):
+        return dp.trang_thai == 'da_thanh_toan'
+
+    def render(self, dp, dich_vu_su_dung, hotel=None):
+        """Return ``(pdf_bytes, state_key)`` for one booking."""
+        _require_reportlab()
+        hotel = hotel or get_hotel_profile()
+        key = self.state_key(dp, dich_vu_su_dung, hotel)
+        pdf = self._pdfs.lookup(key) if self.cacheable(dp) else None
+        if pdf is None:
+            started = time.perf_counter()
+            pdf = run_blocking(render_invoice_pdf, build_invoice_pdf_ops(dp, dich_vu_su_dung, hotel))
+            if self.cacheable(dp):
+                self._pdfs.store(key, pdf, (time.perf_counter() - started) * 1000)
+        return pdf, key
+
+    def render_many(self, bookings, services_by_booking):
+        """Yield ``(booking, pdf_bytes)`` in order; cache misses are drawn by child processes.
+
+        Everything that needs the DB session happens before the first yield,
+        so the generator can be streamed after the request's session is gone.
+        """
+        _require_reportlab()
+        hotel = get_hotel_profile()
+        entries, jobs = [], []
+        for dp in bookings:
+            services = services_by_booking.get(dp.id, [])
+            key = self.state_key(dp, services, hotel)
+            pdf = self._pdfs.lookup(key) if self.cacheable(dp) else None
+            if pdf is None:
+                jobs.append(build_invoice_pdf_ops(dp, services, hotel))
+            entries.append((dp, key, pdf))
+        return self._stream_many(entries, jobs)
+
+    def _stream_many(self, entries, jobs):
+        rendered = render_invoice_batch(jobs, INVOICE_PDF_PROCESSES)
+        try:
+            for dp, key, pdf in entries:
+                if pdf is None:
+                    pdf = next(rendered)
+                    if self.cacheable(dp):
+                        self._pdfs.store(key, pdf)
+                yield dp, pdf
+        finally:
+            # Client ngắt giữa chừng: dừng các tiến trình vẽ còn lại
+            rendered.close()
+
+    def stats(self):
+        return self._pdfs.stats()
+
+
+invoice_pdfs = InvoicePdfService()
+
+
+def generate_invoice_pdf(dp, dich_vu_su_dung):
+    return invoice_pdfs.render(dp, dich_vu_su_dung)[0]
+
+
+class EmailTemplateRegistry:
+    """Compiled Jinja templates for EmailTemplate rows, keyed by (key, updated_at).
+
+    Each render only probes the row's updated_at; the subject/body are loaded and
+    compiled again only when that version changes, so every worker picks up an
+    edit from cai_dat_email without an explicit broadcast.
+    """
+
+    def __init__(self):
+        self._compiled = {}
+        self._stats = defaultdict(lambda: {'renders': 0, 'compiles': 0, 'compile_ms': 0.0, 'render_ms': 0.0})
+        self._lock = threading.Lock()
+
+    def get(self, template_key):
+        version = db.session.query(EmailTemplate.updated_at).filter_by(key=template_key).first()
+        if version is None:
+            raise ValueError(f'Không tìm thấy mẫu email với khóa "{template_key}".')
+        cached = self._compiled.get(template_key)
+        if cached and cached[0] == version[0]:
+            return cached[1], cached[2]
+
+        tpl = EmailTemplate.query.filter_by(key=template_key).first()
+        if not tpl:
+            raise ValueError(f'Không tìm thấy mẫu email với khóa "{template_key}".')
+        started = time.perf_counter()
+        subject_tpl = app.jinja_env.from_string(tpl.subject or '')
+        body_tpl = app.jinja_env.from_string(tpl.body or '')
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            self._compiled[template_key] = (tpl.updated_at, subject_tpl, body_tpl)
+            stats = self._stats[template_key]
+            stats['compiles'] += 1
+            stats['compile_ms'] += elapsed_ms
+        return subject_tpl, body_tpl
+
+    def render(self, template_key, context):
+        subject_tpl, body_tpl = self.get(template_key)
+        started = time.perf_counter()
+        subject = subject_tpl.render(**context)
+        body = body_tpl.render(**context)
+        elapsed_ms = (time.perf_counter() - started) * 1000
+        with self._lock:
+            stats = self._stats[template_key]
+            stats['renders'] += 1
+            stats['render_ms'] += elapsed_ms
+        return subject.strip(), body
+
+    def invalidate(self, template_key=None):
+        with self._lock:
+            if template_key is None:
+                self._compiled.clear()
+            else:
+                self._compiled.pop(template_key, None)
+
+    def stats(self):
+        with self._lock:
+            result = {}
+            for key, stats in self._stats.items():
+                renders, compiles = stats['renders'], stats['compiles']
+                result[key] = {
+                    'renders': renders,
+                    'compiles': compiles,
+                    'cache_hits': max(0, renders - compiles),
+                    'avg_compile_ms': round(stats['compile_ms'] / compiles, 3) if compiles else 0.0,
+                    'avg_render_ms': round(stats['render_ms'] / renders, 3) if renders else 0.0,
+                    'cached_version': self._compiled[key][0].isoformat() if key in self._compiled and self._compiled[key][0] else None,
+                }
+            return result
 
-    pdf.drawText(text)
-    pdf.showPage()
-    pdf.save()
 
-    buffer.seek(0)
-    return buffer.read()
+email_template_registry = EmailTemplateRegistry()
+
+
+def touch_email_template(tpl):
+    """Đổi updated_at sau khi sửa mẫu; DATETIME chỉ lưu tới giây nên luôn tăng ít nhất 1 giây."""
+    now = datetime.now().replace(microsecond=0)
+    if tpl.updated_at and tpl.updated_at >= now:
+        now = tpl.updated_at.replace(microsecond=0) + timedelta(seconds=1)
+    tpl.updated_at = now
 
 
 def render_email_content(template_key, context):
-    tpl = EmailTemplate.query.filter_by(key=template_key).first()
-    if not tpl:
-        raise ValueError(f'Không tìm thấy mẫu email với khóa "{template_key}".')
-    subject_tpl = app.jinja_env.from_string(tpl.subject or '')
-    body_tpl = app.jinja_env.from_string(tpl.body or '')
-    subject = subject_tpl.render(**context)
-    body = body_tpl.render(**context)
-    return subject.strip(), body
+    return email_template_registry.render(template_key, context)
 
 
 def send_email_with_template(template_key, recipient_email, context, attachments=None, datphong_id=None, khachhang_id=None):
@@ -2676,8 +3741,11 @@ def send_email_with_template(template_key, recipient_email, context, attachments
         datphong_id: ID của đặt phòng liên quan (optional)
         khachhang_id: ID của khách hàng (optional)
     
+    Email không được gửi ngay trong request: bản ghi EmailLog 'pending' là hàng đợi
+    (outbox), các luồng gửi nền của tiến trình leader sẽ gửi và cập nhật trạng thái.
+
     Returns:
-        True nếu gửi thành công
+        True nếu email đã được đưa vào hàng đợi
     
     Raises:
         ValueError: Nếu email không hợp lệ
@@ -2694,7 +3762,7 @@ def send_email_with_template(template_key, recipient_email, context, attachments
     # Lấy tên người nhận từ context nếu có
     recipient_name = context.get('ten_khach') or context.get('ho_ten') or None
     
-    # Tạo email log với status pending
+    # Tạo email log với status pending - outbox sẽ gửi nền
     email_log = EmailLog(
         recipient_email=recipient_email,
         recipient_name=recipient_name,
@@ -2702,13 +3770,26 @@ def send_email_with_template(template_key, recipient_email, context, attachments
         subject=subject,
         body=body,
         status='pending',
+        attempts=0,
+        next_attempt_at=datetime.now(),
+        attachments=_encode_email_attachments(attachments),
         sent_by=current_user.id if current_user.is_authenticated else None,
         datphong_id=datphong_id,
         khachhang_id=khachhang_id
     )
     db.session.add(email_log)
     db.session.commit()
-    
+    email_outbox.wake()
+    return True
+
+
+def build_email_message(sender_email, recipient_email, subject, body, attachments=None):
+    """Dựng MIME message (mixed/alternative) từ nội dung đã render."""
+    from email.mime.multipart import MIMEMultipart
+    from email.mime.text import MIMEText
+    from email.mime.base import MIMEBase
+    from email import encoders
+
     # Check if body is HTML - improved detection
     is_html = (
         '<!DOCTYPE html>' in body or 
@@ -2726,7 +3807,7 @@ def send_email_with_template(template_key, recipient_email, context, attachments
         # Root message is 'mixed' to hold both content and attachments
         msg = MIMEMultipart('mixed')
         msg['Subject'] = subject
-        msg['From'] = settings['sender_email']
+        msg['From'] = sender_email
         msg['To'] = recipient_email
         
         if is_html:
@@ -2755,7 +3836,7 @@ def send_email_with_template(template_key, recipient_email, context, attachments
             # Use 'alternative' for HTML emails without attachments
             msg = MIMEMultipart('alternative')
             msg['Subject'] = subject
-            msg['From'] = settings['sender_email']
+            msg['From'] = sender_email
             msg['To'] = recipient_email
             
             # Add plain text version first (fallback)
@@ -2770,7 +3851,7 @@ def send_email_with_template(template_key, recipient_email, context, attachments
             # Plain text email without attachments
             msg = MIMEMultipart()
             msg['Subject'] = subject
-            msg['From'] = settings['sender_email']
+            msg['From'] = sender_email
             msg['To'] = recipient_email
             text_part = MIMEText(body, 'plain', 'utf-8')
             msg.attach(text_part)
@@ -2792,50 +3873,249 @@ def send_email_with_template(template_key, recipient_email, context, attachments
             part.add_header('Content-Disposition', f'attachment; filename="{filename}"')
             msg.attach(part)
 
-    smtp_port = settings['smtp_port'] or '587'
+    return msg
+
+
+def _encode_email_attachments(attachments):
+    items = []
+    for attachment in attachments or []:
+        filename = attachment.get('filename')
+        content = attachment.get('content')
+        if not filename or content is None:
+            continue
+        if isinstance(content, str):
+            content = content.encode('utf-8')
+        items.append({
+            'filename': filename,
+            'mime_type': attachment.get('mime_type', 'application/octet-stream'),
+            'content': base64.b64encode(content).decode('ascii'),
+        })
+    return json.dumps(items) if items else None
+
+
+def _decode_email_attachments(raw):
+    if not raw:
+        return None
+    return [dict(item, content=base64.b64decode(item['content'])) for item in json.loads(raw)]
+
+
+# ========================= EMAIL OUTBOX =========================
+EMAIL_OUTBOX_WORKERS = max(1, int(os.getenv('EMAIL_OUTBOX_WORKERS', '2')))
+EMAIL_OUTBOX_BATCH_SIZE = max(1, int(os.getenv('EMAIL_OUTBOX_BATCH_SIZE', '20')))
+EMAIL_OUTBOX_POLL_SECONDS = 5
+EMAIL_MAX_ATTEMPTS = max(1, int(os.getenv('EMAIL_MAX_ATTEMPTS', '5')))
+EMAIL_RETRY_BASE_SECONDS = 60          # 1, 2, 4, 8... phút giữa các lần thử
+EMAIL_CLAIM_SECONDS = 600              # thời gian giữ một lô đã nhận; quá hạn thì lô quay lại hàng đợi
+EMAIL_SMTP_IDLE_SECONDS = 60           # đóng kết nối SMTP rảnh trước khi máy chủ tự ngắt
+
+
+def _smtp_port(settings):
     try:
-        port = int(smtp_port)
+        return int(settings['smtp_port'] or '587')
     except (TypeError, ValueError):
-        port = 587
+        return 587
 
-    try:
-        server = None
+
+def _is_permanent_smtp_error(exc):
+    """5xx từ máy chủ (sai địa chỉ, bị từ chối) thì không thử lại; lỗi đăng nhập vẫn thử vì có thể sửa cấu hình."""
+    if isinstance(exc, smtplib.SMTPRecipientsRefused):
+        return True
+    if isinstance(exc, smtplib.SMTPAuthenticationError):
+        return False
+    return isinstance(exc, smtplib.SMTPResponseException) and exc.smtp_code >= 500
+
+
+class SmtpConnection:
+    """An authenticated SMTP session reused for many messages until it idles out or the settings change."""
+
+    def __init__(self):
+        self.server = None
+        self.signature = None
+        self.last_used = 0.0
+
+    def _open(self, settings):
+        port = _smtp_port(settings)
         if settings['smtp_use_ssl']:
             server = smtplib.SMTP_SSL(settings['smtp_host'], port, timeout=30)
         else:
             server = smtplib.SMTP(settings['smtp_host'], port, timeout=30)
             if settings['smtp_use_tls']:
                 server.starttls()
-
         username = settings['smtp_username'] or settings['sender_email']
         password = settings['smtp_password']
         if username and password:
             server.login(username, password)
-
-        # Send email as string for MIME messages  
-        server.sendmail(settings['sender_email'], recipient_email, msg.as_string())
-        
-        # Cập nhật log: gửi thành công
-        email_log.status = 'success'
-        email_log.error_message = None
-        db.session.commit()
-        
-    except Exception as e:
-        # Cập nhật log: gửi thất bại
-        email_log.status = 'failed'
-        email_log.error_message = str(e)
-        db.session.commit()
-        raise
-    finally:
-        if 'server' in locals() and server:
+        return server
+
+    def send(self, settings, recipient_email, message):
+        signature = tuple(sorted(settings.items()))
+        if self.server is not None and (
+            signature != self.signature or time.monotonic() - self.last_used > EMAIL_SMTP_IDLE_SECONDS
+        ):
+            self.close()
+        for attempt in range(2):
+            if self.server is None:
+                self.server = self._open(settings)
+                self.signature = signature
             try:
-                server.quit()
+                self.server.sendmail(settings['sender_email'], recipient_email, message)
+                self.last_used = time.monotonic()
+                return
+            except smtplib.SMTPServerDisconnected:
+                # Máy chủ đã đóng phiên cũ: mở lại và gửi lại đúng một lần
+                self.close()
+                if attempt:
+                    raise
+
+    def close(self):
+        if self.server is not None:
+            try:
+                self.server.quit()
             except Exception:
                 pass
+        self.server = None
+
+
+class EmailOutbox:
+    """Background senders for EmailLog rows waiting in status 'pending'.
+
+    Only the scheduler leader drains the outbox, so web requests just insert a
+    row and return. A dispatcher thread claims due rows by pushing their
+    next_attempt_at past EMAIL_CLAIM_SECONDS (status stays 'pending', which the
+    email_log CHECK constraint requires, and a crashed sender's rows simply
+    become due again) and spreads them over a pool of sender threads; each sender keeps its own
+    SMTP connection open across batches. Failures are retried with exponential
+    backoff until EMAIL_MAX_ATTEMPTS, then the row is marked 'failed'.
+    """
+
+    def __init__(self, workers=EMAIL_OUTBOX_WORKERS):
+        self.workers = workers
+        self.batches = queue.Queue()
+        self.wakeup = threading.Event()
+        self.stopping = threading.Event()
+        self.threads = []
+
+    def start(self):
+        if self.threads:
+            return
+        self.stopping.clear()
+        self.threads.append(threading.Thread(target=self._dispatch_loop, name='email-outbox', daemon=True))
+        for index in range(self.workers):
+            self.threads.append(threading.Thread(target=self._sender_loop, name=f'email-sender-{index}', daemon=True))
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self, timeout=5):
+        if not self.threads:
+            return
+        self.stopping.set()
+        self.wakeup.set()
+        for _ in range(self.workers):
+            self.batches.put(None)
+        for thread in self.threads:
+            thread.join(timeout)
+        self.threads = []
+
+    def wake(self):
+        """Gửi ngay nếu tiến trình này là leader; nếu không leader sẽ nhận trong lần quét kế tiếp."""
+        self.wakeup.set()
+
+    def claim_due(self, limit):
+        now = datetime.now()
+        ids = [row.id for row in db.session.query(EmailLog.id).filter(
+            EmailLog.status == 'pending',
+            EmailLog.next_attempt_at <= now
+        ).order_by(EmailLog.next_attempt_at, EmailLog.id).limit(limit)]
+        if ids:
+            EmailLog.query.filter(
+                EmailLog.id.in_(ids),
+                EmailLog.status == 'pending',
+                EmailLog.next_attempt_at <= now
+            ).update({'next_attempt_at': now + timedelta(seconds=EMAIL_CLAIM_SECONDS)}, synchronize_session=False)
+        db.session.commit()
+        return ids
+
+    def send_batch(self, ids, connection):
+        settings = get_email_settings()
+        logs = EmailLog.query.filter(EmailLog.id.in_(ids), EmailLog.status == 'pending').order_by(EmailLog.id).all()
+        for email_log in logs:
+            try:
+                if not settings['smtp_host'] or not settings['sender_email']:
+                    raise RuntimeError('Chưa cấu hình SMTP hoặc địa chỉ gửi đi.')
+                msg = build_email_message(
+                    settings['sender_email'], email_log.recipient_email, email_log.subject,
+                    email_log.body or '', _decode_email_attachments(email_log.attachments)
+                )
+                connection.send(settings, email_log.recipient_email, msg.as_string())
+            except Exception as exc:
+                if not isinstance(exc, smtplib.SMTPResponseException):
+                    connection.close()
+                self._record_failure(email_log, exc)
+            else:
+                email_log.status = 'success'
+                email_log.error_message = None
+                email_log.sent_at = datetime.now()
+                email_log.attachments = None
+            # Commit từng thư để sự cố giữa lô không làm gửi lại thư đã đi
+            db.session.commit()
+
+    def _record_failure(self, email_log, exc):
+        email_log.attempts = (email_log.attempts or 0) + 1
+        email_log.error_message = str(exc)
+        if email_log.attempts >= EMAIL_MAX_ATTEMPTS or _is_permanent_smtp_error(exc):
+            email_log.status = 'failed'
+            app.logger.warning(f"Gửi email #{email_log.id} tới {email_log.recipient_email} thất bại: {exc}")
+        else:
+            email_log.status = 'pending'
+            delay = EMAIL_RETRY_BASE_SECONDS * 2 ** (email_log.attempts - 1)
+            email_log.next_attempt_at = datetime.now() + timedelta(seconds=delay)
+
+    def _dispatch_loop(self):
+        while not self.stopping.is_set():
+            claimed = []
+            if scheduler_is_leader():
+                try:
+                    with app.app_context():
+                        claimed = self.claim_due(self.workers * EMAIL_OUTBOX_BATCH_SIZE)
+                except Exception as exc:
+                    app.logger.warning(f"Không lấy được email trong outbox: {exc}")
+            if claimed:
+                for index in range(self.workers):
+                    batch = claimed[index::self.workers]
+                    if batch:
+                        self.batches.put(batch)
+                self.batches.join()
+                continue
+            self.wakeup.wait(EMAIL_OUTBOX_POLL_SECONDS)
+            self.wakeup.clear()
+
+    def _sender_loop(self):
+        connection = SmtpConnection()
+        try:
+            while True:
+                try:
+                    ids = self.batches.get(timeout=EMAIL_SMTP_IDLE_SECONDS)
+                except queue.Empty:
+                    connection.close()
+                    continue
+                try:
+                    if ids is None:
+                        return
+                    with app.app_context():
+                        self.send_batch(ids, connection)
+                except Exception as exc:
+                    app.logger.exception(f"Luồng gửi email gặp lỗi: {exc}")
+                    connection.close()
+                finally:
+                    self.batches.task_done()
+        finally:
+            connection.close()
+
+
+email_outbox = EmailOutbox()
 
-    return True
 
-def snapshot_and_bill(dp, now=None):
+def snapshot_and_bill(dp, now=None, dich_vu_da_thanh_toan=None):
     if now is None: now = datetime.now()
     checkin = dp.thuc_te_nhan or dp.ngay_nhan
     actual_checkout = dp.thuc_te_tra or now
@@ -2862,10 +4142,11 @@ def snapshot_and_bill(dp, now=None):
     
     # Tính TỔNG tiền dịch vụ CHỈ từ các dịch vụ ĐÃ THANH TOÁN
     # Không tính các dịch vụ: chua_thanh_toan, cho_xac_nhan (chưa xác nhận)
-    dich_vu_da_thanh_toan = SuDungDichVu.query.filter_by(
-        datphong_id=dp.id, 
-        trang_thai='da_thanh_toan'
-    ).all()
+    if dich_vu_da_thanh_toan is None:
+        dich_vu_da_thanh_toan = SuDungDichVu.query.filter_by(
+            datphong_id=dp.id, 
+            trang_thai='da_thanh_toan'
+        ).all()
     tong_tien_dv = sum(r.dichvu.gia * r.so_luong for r in dich_vu_da_thanh_toan)
 
     tong = tien_phong + tong_tien_dv + tien_phat
@@ -3007,40 +4288,145 @@ def cancel_booking_for_no_show(dp, auto_cancel_minutes=None):
     ).first()
 
     dp.phong.trang_thai = 'trong' if not other_booking else 'da_dat'
+    record_booking_revenue(dp)
     return True
 
 
+def no_show_reference_time(dp):
+    return dp.auto_confirmed_at or dp.created_at or dp.ngay_nhan
+
+
+def release_rooms_after_cancel(cancelled):
+    """Recompute phong.trang_thai for rooms freed by a batch of cancelled bookings.
+
+    ``cancelled`` holds rows with id/phong_id/ngay_nhan/ngay_tra. A room stays
+    'da_dat' if another blocking booking still overlaps the cancelled window.
+    """
+    if not cancelled:
+        return
+    phong_ids = {c.phong_id for c in cancelled}
+    cancelled_ids = {c.id for c in cancelled}
+    others = defaultdict(list)
+    for row in db.session.query(DatPhong.phong_id, DatPhong.ngay_nhan, DatPhong.ngay_tra).filter(
+        DatPhong.phong_id.in_(phong_ids),
+        DatPhong.id.notin_(cancelled_ids),
+        DatPhong.trang_thai.in_(BOOKING_BLOCKING_STATUSES)
+    ):
+        others[row.phong_id].append(row)
+    still_booked = {
+        c.phong_id for c in cancelled
+        if any(o.ngay_tra > c.ngay_nhan and o.ngay_nhan < c.ngay_tra for o in others[c.phong_id])
+    }
+    free = phong_ids - still_booked
+    # Không đụng tới phòng đang có khách ở
+    if free:
+        Phong.query.filter(Phong.id.in_(free), Phong.trang_thai != 'dang_o').update(
+            {'trang_thai': 'trong'}, synchronize_session=False
+        )
+    if still_booked:
+        Phong.query.filter(Phong.id.in_(still_booked), Phong.trang_thai != 'dang_o').update(
+            {'trang_thai': 'da_dat'}, synchronize_session=False
+        )
+
+
+def expire_no_shows(now=None, booking_ids=None, minutes=None):
+    """Cancel confirmed bookings nobody checked in for, in one batched UPDATE.
+
+    Returns the ids that were cancelled. ``booking_ids`` restricts the check to
+    the bookings whose deadline came due; without it every 'dat' booking is scanned.
+    """
+    now = now or datetime.now()
+    minutes = minutes if minutes is not None else get_config_int('auto_cancel_minutes', 5)
+    if minutes <= 0:
+        return []
+    query = db.session.query(
+        DatPhong.id,
+        DatPhong.phong_id,
+        DatPhong.ngay_nhan,
+        DatPhong.ngay_tra,
+        DatPhong.auto_confirmed_at,
+        DatPhong.created_at,
+    ).filter(
+        DatPhong.trang_thai == 'dat',
+        DatPhong.thuc_te_nhan.is_(None)
+    )
+    if booking_ids is not None:
+        if not booking_ids:
+            return []
+        query = query.filter(DatPhong.id.in_(booking_ids))
+    window = timedelta(minutes=minutes)
+    due = [
+        row for row in query.all()
+        if no_show_reference_time(row) and no_show_reference_time(row) + window <= now
+    ]
+    if not due:
+        return []
+
+    # Nếu phòng vẫn đang có khách ở (quá hạn trả), không tự động hủy
+    blocked_rooms = {
+        row.phong_id for row in db.session.query(DatPhong.phong_id)
+        .join(Phong, DatPhong.phong_id == Phong.id)
+        .filter(
+            DatPhong.phong_id.in_({row.phong_id for row in due}),
+            DatPhong.trang_thai == 'nhan',
+            Phong.trang_thai == 'dang_o'
+        )
+    }
+    due = [row for row in due if row.phong_id not in blocked_rooms]
+    if not due:
+        return []
+
+    ids = [row.id for row in due]
+    # Cột DATETIME không giữ phần micro giây; dùng lại đúng giá trị này khi ghi doanh thu
+    cancelled_at = now.replace(microsecond=0)
+    # MySQL gán giá trị từ trái sang phải: phải chép tien_coc sang tien_phat/
+    # tong_thanh_toan trước khi đặt tien_coc = 0
+    db.session.execute(
+        db.update(DatPhong)
+        .where(DatPhong.id.in_(ids), DatPhong.trang_thai == 'dat')
+        .ordered_values(
+            (DatPhong.trang_thai, 'huy'),
+            (DatPhong.tong_thanh_toan, DatPhong.tien_coc),
+            (DatPhong.tien_phat, DatPhong.tien_coc),
+            (DatPhong.tien_phong, 0),
+            (DatPhong.tien_coc, 0),
+            (DatPhong.thuc_te_tra, cancelled_at),
+            (DatPhong.phuong_thuc_thanh_toan, 'qr'),
+            (DatPhong.coc_da_thanh_toan, True),
+        ),
+        execution_options={'synchronize_session': False}
+    )
+    # UPDATE hàng loạt không qua ORM nên tự trừ bộ đếm check-in
+    counter_deltas = defaultdict(int)
+    for row in due:
+        for key in _booking_counter_keys('dat', row.ngay_nhan, row.ngay_tra):
+            counter_deltas[key] -= 1
+    bump_dashboard_counters(counter_deltas)
+    # Tiền cọc bị giữ lại là doanh thu; thuc_te_tra loại các booking mà UPDATE đã bỏ qua
+    add_booking_revenue(DatPhong.id.in_(ids), DatPhong.trang_thai == 'huy', DatPhong.thuc_te_tra == cancelled_at)
+    release_rooms_after_cancel(due)
+    db.session.commit()
+    app.logger.info(
+        f'Đã tự động hủy {len(ids)} đặt phòng không đến trong {minutes} phút. '
+        'Doanh thu từ tiền cọc đã được ghi nhận.'
+    )
+    return ids
+
+
 def huy_dat_phong_khong_den():
     with app.app_context():
-        minutes = get_config_int('auto_cancel_minutes', 5)
-        bookings = DatPhong.query.filter(
-            DatPhong.trang_thai == 'dat',
-            DatPhong.thuc_te_nhan.is_(None)
-        ).all()
-        if not bookings:
-            return
-        count = 0
-        for dp in bookings:
-            if cancel_booking_for_no_show(dp, minutes):
-                db.session.commit()
-                count += 1
-        if count > 0:
-            app.logger.info(
-                f'Đã tự động hủy {count} đặt phòng không đến trong {minutes} phút. '
-                'Doanh thu từ tiền cọc đã được ghi nhận.'
-            )
-            # flash(f'Đã tự động hủy {count} đặt phòng không đến trong 5 phút. Doanh thu từ tiền cọc đã được ghi nhận.', 'success')
+        expire_no_shows()
 
 
 @app.route('/api/bookings/<int:dat_id>/auto-cancel', methods=['POST'])
 @login_required
 @permission_required('bookings.cancel')
 def api_auto_cancel_booking(dat_id):
-    dp = DatPhong.query.get_or_404(dat_id)
+    dp = lock_booking(dat_id)
     minutes = get_config_int('auto_cancel_minutes', 5)
     if cancel_booking_for_no_show(dp, minutes):
         db.session.commit()
-        socketio.emit('booking_auto_cancelled', {'booking_id': dp.id})
+        emit_to_staff('booking_auto_cancelled', {'booking_id': dp.id}, 'bookings.cancel')
         return jsonify({'status': 'cancelled'})
     return jsonify({'status': 'pending'})
 
@@ -3109,164 +4495,381 @@ def api_refund_overstay_booking(dat_id):
     return jsonify({'status': 'ok'})
 
 
-def clean_expired_payment_sessions():
-    with app.app_context():
-        ttl = get_payment_session_ttl()
-        cutoff = datetime.now() - ttl
-        expired = PaymentSession.query.filter(PaymentSession.created_at < cutoff).all()
-        if not expired:
-            return
-
-        deposit_tokens = [ps.token for ps in expired if ps.kind == 'deposit']
-        for ps in expired:
-            db.session.delete(ps)
-
-        if deposit_tokens:
-            DatPhong.query.filter(DatPhong.payment_token.in_(deposit_tokens)).update(
-                {'payment_token': None},
-                synchronize_session=False
-            )
-
-        db.session.commit()
-        print(f"Cleaned {len(expired)} expired payment sessions")
-
-
-
 def cleanup_expired_data():
     """Cleanup expired payment sessions and vouchers."""
     now = datetime.now()
-    ttl = get_payment_session_ttl()
-    expired_sessions = PaymentSession.query.filter(
-        PaymentSession.created_at < now - ttl
-    ).all()
-    for session in expired_sessions:
-        db.session.delete(session)
+    expired_sessions = payment_sessions.delete_expired(now)
     
     expired_vouchers = Voucher.query.filter(Voucher.expires_at < now, Voucher.is_used == False).all()
     for voucher in expired_vouchers:
         db.session.delete(voucher)
     
     db.session.commit()
-    app.logger.info(f"Cleaned up {len(expired_sessions)} expired sessions and {len(expired_vouchers)} expired vouchers")
+    app.logger.info(f"Cleaned up {expired_sessions} expired sessions and {len(expired_vouchers)} expired vouchers")
+
+def expire_lapsed_holds(now=None, booking_ids=None):
+    """Cancel cho_xac_nhan bookings whose payment hold has lapsed.
+
+    This is the single owner of the hold-expiry transition; availability and
+    room-map reads only skip lapsed holds through hold_is_expired. Returns the
+    ids that were cancelled.
+    """
+    now = now or datetime.now()
+    ttl = get_payment_session_ttl()
+    query = db.session.query(
+        DatPhong.id,
+        DatPhong.phong_id,
+        DatPhong.ngay_nhan,
+        DatPhong.ngay_tra,
+        DatPhong.trang_thai,
+        DatPhong.payment_token,
+        DatPhong.created_at,
+    ).filter(DatPhong.trang_thai == 'cho_xac_nhan')
+    if booking_ids is not None:
+        if not booking_ids:
+            return []
+        query = query.filter(DatPhong.id.in_(booking_ids))
+    pending_bookings = query.all()
+    session_started = load_hold_session_starts(pending_bookings)
+    expired = [dp for dp in pending_bookings if hold_is_expired(dp, session_started, ttl, now)]
+    if not expired:
+        return []
+
+    ids = [dp.id for dp in expired]
+    app.logger.info(f"Cancelling expired bookings {ids}")
+    # Hủy booking với trạng thái đặc biệt để không hiển thị trong quản lý hóa đơn,
+    # không ghi nhận doanh thu vì chưa thanh toán
+    db.session.execute(
+        db.update(DatPhong)
+        .where(DatPhong.id.in_(ids), DatPhong.trang_thai == 'cho_xac_nhan')
+        .values(
+            trang_thai='huy_timeout',
+            thuc_te_tra=now,
+            tong_thanh_toan=0,
+            tien_phat=0,
+            tien_phong=0,
+            tien_coc=0,
+            phuong_thuc_thanh_toan=None,
+            coc_da_thanh_toan=False,
+        ),
+        execution_options={'synchronize_session': False}
+    )
+    release_rooms_after_cancel(expired)
+
+    # Xóa payment session nếu có
+    payment_sessions.delete_tokens([dp.payment_token for dp in expired if dp.payment_token])
+
+    db.session.commit()
+    app.logger.info(f'Đã tự động hủy {len(ids)} đặt phòng do hết thời gian thanh toán.')
+    return ids
+
 
 def huy_dat_phong_timeout():
     """Tự động hủy các booking có payment session đã hết thời gian."""
     with app.app_context():
-        # Lấy thời gian timeout từ cấu hình
-        timeout_setting = HeThongCauHinh.query.filter_by(key='payment_timeout_minutes').first()
-        timeout_minutes = int(timeout_setting.value) if timeout_setting and timeout_setting.value else 5
-        timeout_minutes = max(1, timeout_minutes)
-        timeout_timedelta = timedelta(minutes=timeout_minutes)
+        expire_lapsed_holds()
 
-        now = datetime.now()
-        cutoff = now - timeout_timedelta
-        
-        # Tìm các booking đang chờ xác nhận
-        pending_bookings = DatPhong.query.filter_by(trang_thai='cho_xac_nhan').all()
-        
-        cancelled_count = 0
-        for dp in pending_bookings:
-            should_cancel = False
-            
-            if dp.payment_token:
-                # Có payment token, kiểm tra session có expired không
-                session = PaymentSession.query.filter_by(token=dp.payment_token).first()
-                if not session or session.created_at < cutoff:
-                    should_cancel = True
-            else:
-                # Không có payment token, kiểm tra thời gian tạo booking
-                if dp.created_at < cutoff:
-                    should_cancel = True
-            
-            if should_cancel:
-                app.logger.info(f"Cancelling expired booking ID {dp.id}, created at {dp.created_at}")
-                
-                # Hủy booking với trạng thái đặc biệt để không hiển thị trong quản lý hóa đơn
-                dp.trang_thai = 'huy_timeout'
-                dp.thuc_te_tra = now
-                dp.tong_thanh_toan = 0  # Không ghi nhận doanh thu vì chưa thanh toán
-                dp.tien_phat = 0
-                dp.tien_phong = 0
-                dp.tien_coc = 0
-                dp.phuong_thuc_thanh_toan = None
-                dp.coc_da_thanh_toan = False
-                
-                # Cập nhật trạng thái phòng
-                other_booking = DatPhong.query.filter(
-                    DatPhong.phong_id == dp.phong_id,
-                    DatPhong.id != dp.id,
-                    DatPhong.trang_thai.in_(BOOKING_BLOCKING_STATUSES),
-                    ~db.or_(DatPhong.ngay_tra <= dp.ngay_nhan, DatPhong.ngay_nhan >= dp.ngay_tra)
-                ).first()
-                if not other_booking:
-                    dp.phong.trang_thai = 'trong'
-                else:
-                    dp.phong.trang_thai = 'da_dat'
-                
-                # Xóa payment session nếu có
-                if dp.payment_token:
-                    session = PaymentSession.query.filter_by(token=dp.payment_token).first()
-                    if session:
-                        db.session.delete(session)
-                
-                cancelled_count += 1
-        
-        if cancelled_count > 0:
-            db.session.commit()
-            app.logger.info(f'Đã tự động hủy {cancelled_count} đặt phòng do hết thời gian thanh toán.')
 
-# Initialize Background Scheduler after function definition
-scheduler = BackgroundScheduler()
-scheduler.add_job(func=huy_dat_phong_khong_den, trigger="interval", minutes=1)
-scheduler.add_job(func=huy_dat_phong_timeout, trigger="interval", minutes=1)
-scheduler.add_job(func=cleanup_expired_data, trigger="interval", hours=1)  # Run every hour
-scheduler.start()
+# ========================= DEADLINE QUEUE =========================
+BOOKING_DEADLINE_JOB_ID = 'booking_deadlines'
+BOOKING_DEADLINE_BATCH_SIZE = 500
+# Hạn đã tới nhưng booking chưa hủy được (phòng còn khách ở quá giờ trả): thử lại sau
+BOOKING_DEADLINE_RETRY = timedelta(minutes=1)
 
-# Ensure scheduler shuts down properly on exit
-atexit.register(lambda: scheduler.shutdown() if scheduler.running else None)
 
-# ========================= MAIN ROUTES =========================
-@app.route('/')
-def index():
-    return redirect(url_for('dashboard')) if current_user.is_authenticated else redirect(url_for('login'))
+def arm_deadline_timer(due_at=None):
+    """Point the single deadline job at ``due_at`` or, by default, the earliest queued deadline."""
+    if scheduler is None or not scheduler.running or not scheduler_is_leader():
+        # Tiến trình không giữ lease: leader sẽ nhận hạn mới ở lần gia hạn lease kế tiếp
+        return
+    if due_at is None:
+        due_at = db.session.query(func.min(BookingDeadline.due_at)).scalar()
+        if due_at is None:
+            return
+    job = scheduler.get_job(BOOKING_DEADLINE_JOB_ID)
+    if job and job.next_run_time and job.next_run_time.replace(tzinfo=None) <= due_at:
+        return
+    scheduler.add_job(
+        func=leader_only(run_due_deadlines),
+        trigger='date',
+        run_date=max(due_at, datetime.now()),
+        id=BOOKING_DEADLINE_JOB_ID,
+        replace_existing=True,
+        misfire_grace_time=None,
+    )
 
-@app.route('/test-timeout-cleanup')
-@login_required
-@permission_required('system.maintenance')
-def test_timeout_cleanup():
-    """Route để test việc dọn dẹp timeout thủ công"""
-    huy_dat_phong_timeout()
-    flash('Đã chạy cleanup timeout thủ công', 'info')
-    return redirect(url_for('thanh_toan_chua_hoan_tat'))
 
-@app.route('/khach-hang/dang-ky', methods=['GET', 'POST'])
-def khach_hang_dang_ky():
-    if current_user.is_authenticated:
-        if getattr(current_user, 'is_customer', False):
-            return redirect(url_for('khach_hang_tai_khoan'))
-        flash('Bạn đang đăng nhập bằng tài khoản nhân viên.', 'info')
-        return redirect(url_for('dashboard'))
+def _put_deadline(datphong_id, kind, due_at):
+    row = BookingDeadline.query.filter_by(datphong_id=datphong_id, kind=kind).first()
+    if row:
+        row.due_at = due_at
+    else:
+        db.session.add(BookingDeadline(datphong_id=datphong_id, kind=kind, due_at=due_at))
+    arm_deadline_timer(due_at)
 
-    form = {
-        'ho_ten': '',
-        'cmnd': '',
-        'email': '',
-        'sdt': '',
-        'dia_chi': ''
-    }
-    errors = {}
 
-    prefill = None
-    if request.method != 'POST':
-        prefill = session.pop('google_registration', None)
-        if prefill:
-            form['ho_ten'] = prefill.get('name') or form['ho_ten']
-            form['email'] = prefill.get('email') or form['email']
+def schedule_booking_deadline(dp, hold_started=None):
+    """Queue the expiry implied by the booking's current state; the caller commits.
 
-    if request.method == 'POST':
-        ho_ten = (request.form.get('ho_ten') or '').strip()
-        cmnd = (request.form.get('cmnd') or '').strip()
-        email_raw = (request.form.get('email') or '').strip()
+    cho_xac_nhan -> payment hold runs out ``payment_timeout_minutes`` after
+    ``hold_started`` (default: booking creation); dat -> no-show cancellation
+    ``auto_cancel_minutes`` after confirmation.
+    """
+    if dp.trang_thai == 'cho_xac_nhan':
+        started = hold_started or dp.created_at or datetime.now()
+        _put_deadline(dp.id, 'hold', started + get_payment_session_ttl())
+    elif dp.trang_thai == 'dat' and dp.thuc_te_nhan is None:
+        minutes = get_config_int('auto_cancel_minutes', 5)
+        reference_time = no_show_reference_time(dp) or datetime.now()
+        if minutes > 0:
+            _put_deadline(dp.id, 'no_show', reference_time + timedelta(minutes=minutes))
+
+
+def sync_booking_deadlines(booking_ids=None, now=None):
+    """Recompute queue rows from booking state; a full rebuild when ``booking_ids`` is None."""
+    now = now or datetime.now()
+    query = DatPhong.query.filter(db.or_(
+        DatPhong.trang_thai == 'cho_xac_nhan',
+        db.and_(DatPhong.trang_thai == 'dat', DatPhong.thuc_te_nhan.is_(None))
+    ))
+    existing_query = BookingDeadline.query
+    if booking_ids is not None:
+        booking_ids = list(booking_ids)
+        if not booking_ids:
+            return
+        query = query.filter(DatPhong.id.in_(booking_ids))
+        existing_query = existing_query.filter(BookingDeadline.datphong_id.in_(booking_ids))
+    bookings = query.all()
+
+    ttl = get_payment_session_ttl()
+    minutes = get_config_int('auto_cancel_minutes', 5)
+    session_started = load_hold_session_starts(bookings)
+    desired = {}
+    for dp in bookings:
+        if dp.trang_thai == 'cho_xac_nhan':
+            started = hold_started_at(dp, session_started)
+            desired[(dp.id, 'hold')] = started + ttl if started else now
+        elif minutes > 0 and no_show_reference_time(dp):
+            desired[(dp.id, 'no_show')] = no_show_reference_time(dp) + timedelta(minutes=minutes)
+
+    for row in existing_query.all():
+        due_at = desired.pop((row.datphong_id, row.kind), None)
+        if due_at is None:
+            db.session.delete(row)
+        elif row.due_at != due_at:
+            row.due_at = due_at
+    for (datphong_id, kind), due_at in desired.items():
+        db.session.add(BookingDeadline(datphong_id=datphong_id, kind=kind, due_at=due_at))
+
+
+def run_due_deadlines():
+    """Timer callback: expire only the bookings whose deadline has come, then re-arm."""
+    with app.app_context():
+        now = datetime.now()
+        due = (
+            BookingDeadline.query
+            .filter(BookingDeadline.due_at <= now)
+            .order_by(BookingDeadline.due_at)
+            .limit(BOOKING_DEADLINE_BATCH_SIZE)
+            .all()
+        )
+        if due:
+            expire_lapsed_holds(now, [row.datphong_id for row in due if row.kind == 'hold'])
+            expire_no_shows(now, [row.datphong_id for row in due if row.kind == 'no_show'])
+            # Booking đã hủy sẽ bị xóa khỏi hàng đợi; booking được gia hạn (đổi cấu
+            # hình, phiên thanh toán mới) được xếp lại với hạn mới
+            due_ids = {row.datphong_id for row in due}
+            sync_booking_deadlines(due_ids, now)
+            # Hạn vẫn nằm trong quá khứ nghĩa là booking bị bỏ qua lần này; đẩy lùi
+            # để timer không bắn lại ngay lập tức
+            BookingDeadline.query.filter(
+                BookingDeadline.datphong_id.in_(due_ids),
+                BookingDeadline.due_at <= now
+            ).update({'due_at': now + BOOKING_DEADLINE_RETRY}, synchronize_session=False)
+            db.session.commit()
+        arm_deadline_timer()
+
+
+def reconcile_booking_deadlines():
+    """Rebuild the queue from scratch; runs at startup, hourly, and after timeout settings change."""
+    with app.app_context():
+        sync_booking_deadlines()
+        db.session.commit()
+        arm_deadline_timer()
+
+
+# ========================= SCHEDULER LEADER =========================
+# embedded: mỗi tiến trình web chạy scheduler nhưng chỉ tiến trình giữ lease mới chạy job;
+# external: tiến trình web không chạy scheduler, job chạy trong `python worker.py`
+SCHEDULER_MODE = os.getenv('SCHEDULER_MODE', 'embedded').strip().lower()
+SCHEDULER_LEASE_KEY = 'scheduler_leader'
+SCHEDULER_LEASE_SECONDS = max(int(os.getenv('SCHEDULER_LEASE_SECONDS', '90')), 15)
+SCHEDULER_INSTANCE_ID = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+_scheduler_lease = {'valid_until': 0.0}
+
+
+def scheduler_is_leader():
+    """True while this process holds an unexpired scheduler lease."""
+    return time.monotonic() < _scheduler_lease['valid_until']
+
+
+def leader_only(job):
+    """Wrap a scheduler job so it runs inside an app context and only on the leader."""
+    @wraps(job)
+    def wrapper(*args, **kwargs):
+        if not scheduler_is_leader():
+            return None
+        with app.app_context():
+            return job(*args, **kwargs)
+    return wrapper
+
+
+def renew_scheduler_lease():
+    """Take or extend the leader lease stored in hethongcauhinh.
+
+    The row's value is the holder's instance id and updated_at its last
+    heartbeat, both compared against the database clock so hosts with skewed
+    clocks agree. A single conditional UPDATE decides the race between workers.
+    """
+    with app.app_context():
+        was_leader = scheduler_is_leader()
+        try:
+            now = db.session.query(func.now()).scalar()
+            stale_before = now - timedelta(seconds=SCHEDULER_LEASE_SECONDS)
+            acquired = HeThongCauHinh.query.filter(
+                HeThongCauHinh.key == SCHEDULER_LEASE_KEY,
+                or_(
+                    HeThongCauHinh.value == SCHEDULER_INSTANCE_ID,
+                    HeThongCauHinh.updated_at.is_(None),
+                    HeThongCauHinh.updated_at < stale_before,
+                )
+            ).update({'value': SCHEDULER_INSTANCE_ID, 'updated_at': now}, synchronize_session=False)
+            if not acquired and not HeThongCauHinh.query.filter_by(key=SCHEDULER_LEASE_KEY).count():
+                db.session.add(HeThongCauHinh(key=SCHEDULER_LEASE_KEY, value=SCHEDULER_INSTANCE_ID, updated_at=now))
+                acquired = 1
+            db.session.commit()
+        except IntegrityError:
+            # Tiến trình khác vừa tạo dòng lease trước
+            db.session.rollback()
+            acquired = 0
+        except Exception as exc:
+            db.session.rollback()
+            app.logger.warning(f"Không gia hạn được scheduler lease: {exc}")
+            acquired = 0
+
+        if not acquired:
+            if was_leader:
+                app.logger.info(f"Scheduler {SCHEDULER_INSTANCE_ID} mất quyền leader")
+            _scheduler_lease['valid_until'] = 0.0
+            return False
+
+        # Hết hạn cục bộ sớm hơn lease trong DB để không có hai leader cùng lúc
+        _scheduler_lease['valid_until'] = time.monotonic() + SCHEDULER_LEASE_SECONDS * 2 / 3
+        if not was_leader:
+            app.logger.info(f"Scheduler {SCHEDULER_INSTANCE_ID} trở thành leader")
+            reconcile_booking_deadlines()
+            rebuild_dashboard_counters()
+            email_outbox.wake()
+        else:
+            arm_deadline_timer()
+        return True
+
+
+def release_scheduler_lease():
+    """Hand the lease back on shutdown so another process can take over at once."""
+    if not scheduler_is_leader():
+        return
+    _scheduler_lease['valid_until'] = 0.0
+    with app.app_context():
+        try:
+            HeThongCauHinh.query.filter_by(key=SCHEDULER_LEASE_KEY, value=SCHEDULER_INSTANCE_ID).update(
+                {'updated_at': None}, synchronize_session=False
+            )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+
+
+def shutdown_scheduler():
+    if scheduler is not None and scheduler.running:
+        scheduler.shutdown()
+    email_outbox.stop()
+    release_scheduler_lease()
+
+
+def create_scheduler():
+    # APScheduler chỉ được nạp ở tiến trình chạy job nền (web worker ở chế độ external không cần)
+    from apscheduler.schedulers.background import BackgroundScheduler
+
+    jobs = BackgroundScheduler()
+    jobs.add_job(
+        func=renew_scheduler_lease,
+        trigger="interval",
+        seconds=SCHEDULER_LEASE_SECONDS // 3,
+        next_run_time=datetime.now(),
+        max_instances=1,
+    )
+    # Hủy giữ chỗ/không đến do hàng đợi hạn xử lý đảm nhận (run_due_deadlines);
+    # đồng bộ lại hàng đợi mỗi giờ (và khi vừa nhận quyền leader) để phòng trường hợp lệch
+    jobs.add_job(func=leader_only(reconcile_booking_deadlines), trigger="interval", hours=1)
+    jobs.add_job(func=leader_only(cleanup_expired_data), trigger="interval", hours=1)  # Run every hour
+    # Dựng lại bộ đếm dashboard để sửa sai lệch do các câu SQL thô
+    jobs.add_job(func=leader_only(rebuild_dashboard_counters), trigger="interval", hours=1)
+    return jobs
+
+
+# Initialize Background Scheduler after function definition
+scheduler = None
+if SCHEDULER_MODE != 'external':
+    scheduler = create_scheduler()
+    scheduler.start()
+    email_outbox.start()
+
+# Ensure scheduler shuts down properly on exit
+atexit.register(shutdown_scheduler)
+
+# ========================= MAIN ROUTES =========================
+@app.route('/')
+def index():
+    return redirect(url_for('dashboard')) if current_user.is_authenticated else redirect(url_for('login'))
+
+@app.route('/test-timeout-cleanup')
+@login_required
+@permission_required('system.maintenance')
+def test_timeout_cleanup():
+    """Route để test việc dọn dẹp timeout thủ công"""
+    huy_dat_phong_timeout()
+    flash('Đã chạy cleanup timeout thủ công', 'info')
+    return redirect(url_for('thanh_toan_chua_hoan_tat'))
+
+@app.route('/khach-hang/dang-ky', methods=['GET', 'POST'])
+def khach_hang_dang_ky():
+    if current_user.is_authenticated:
+        if getattr(current_user, 'is_customer', False):
+            return redirect(url_for('khach_hang_tai_khoan'))
+        flash('Bạn đang đăng nhập bằng tài khoản nhân viên.', 'info')
+        return redirect(url_for('dashboard'))
+
+    form = {
+        'ho_ten': '',
+        'cmnd': '',
+        'email': '',
+        'sdt': '',
+        'dia_chi': ''
+    }
+    errors = {}
+
+    prefill = None
+    if request.method != 'POST':
+        prefill = session.pop('google_registration', None)
+        if prefill:
+            form['ho_ten'] = prefill.get('name') or form['ho_ten']
+            form['email'] = prefill.get('email') or form['email']
+
+    if request.method == 'POST':
+        ho_ten = (request.form.get('ho_ten') or '').strip()
+        cmnd = (request.form.get('cmnd') or '').strip()
+        email_raw = (request.form.get('email') or '').strip()
         email_normalized = normalize_email(email_raw)
         sdt = (request.form.get('sdt') or '').strip()
         dia_chi = (request.form.get('dia_chi') or '').strip()
@@ -3809,20 +5412,14 @@ def logout():
 # @cache.cached(timeout=300)  # Cache for 5 minutes
 @permission_required('dashboard.view')
 def dashboard():
-    today = date.today()
-
-    checkins_today = DatPhong.query.filter(
-        DatPhong.trang_thai == 'dat',
-        func.date(DatPhong.ngay_nhan) == today
-    ).count()
-
-    checkouts_today = DatPhong.query.filter(
-        DatPhong.trang_thai == 'nhan',
-        func.date(DatPhong.ngay_tra) == today
-    ).count()
-
-    occupied_rooms = Phong.query.filter_by(trang_thai='dang_o').count()
-    total_rooms = Phong.query.count()
+    today = date.today().isoformat()
+    counters = read_dashboard_counters([
+        f"checkin:{today}", f"checkout:{today}", 'phong:dang_o', 'phong:total'
+    ])
+    checkins_today = counters[f"checkin:{today}"]
+    checkouts_today = counters[f"checkout:{today}"]
+    occupied_rooms = counters['phong:dang_o']
+    total_rooms = counters['phong:total']
 
     unread_query = TinNhan.query.join(DatPhong).filter(
         TinNhan.trang_thai == 'chua_doc',
@@ -3844,13 +5441,8 @@ def dashboard():
 @login_required
 @permission_required('payments.process')
 def thanh_toan_chua_hoan_tat():
-    # Chạy cleanup timeout trước khi hiển thị
-    huy_dat_phong_timeout()
-
     # Lấy thời gian timeout từ cấu hình
-    timeout_setting = HeThongCauHinh.query.filter_by(key='payment_timeout_minutes').first()
-    timeout_minutes = int(timeout_setting.value) if timeout_setting and timeout_setting.value else 5
-    timeout_minutes = max(1, timeout_minutes)
+    timeout_minutes = max(1, get_config_int('payment_timeout_minutes', 5))
     payment_session_ttl = timedelta(minutes=timeout_minutes)
 
     now = datetime.now()
@@ -3858,16 +5450,13 @@ def thanh_toan_chua_hoan_tat():
     
     # 1. Lấy các booking chưa thanh toán (cho_xac_nhan)
     pending_bookings = DatPhong.query.filter_by(trang_thai='cho_xac_nhan').all()
+    session_started = load_hold_session_starts(pending_bookings)
     for dp in pending_bookings:
-        # Kiểm tra xem booking có payment session active không
-        has_active_session = False
-        if dp.payment_token:
-            session = PaymentSession.query.filter_by(token=dp.payment_token).first()
-            if session and not payment_session_expired(session.created_at, ttl=payment_session_ttl):
-                has_active_session = True
-        
-        # Nếu không có payment session hoặc session đã expired, hiển thị booking này
-        if not has_active_session:
+        # Booking hết hạn giữ chỗ sẽ do expire_lapsed_holds hủy, không hiển thị ở đây
+        if hold_is_expired(dp, session_started, payment_session_ttl, now):
+            continue
+        # Booking có payment session active được hiển thị ở phần phiên thanh toán bên dưới
+        if not dp.payment_token:
             expires_at = dp.created_at + payment_session_ttl
             remaining_seconds = max(0, int((expires_at - now).total_seconds()))
             
@@ -3886,46 +5475,43 @@ def thanh_toan_chua_hoan_tat():
             pending_sessions.append(info)
     
     # 2. Lấy các payment sessions đang pending
-    sessions = PaymentSession.query.filter(
-        PaymentSession.created_at > now - payment_session_ttl
-    ).all()
+    sessions = payment_sessions.pending(now)
     
     for sess in sessions:
         try:
-            data = json.loads(sess.payload or '{}')
-            if not data.get('completed'):
-                # Lấy thông tin khách hàng và số tiền
-                info = {
-                    'type': 'payment_session',
-                    'token': sess.token, 
-                    'kind': sess.kind, 
-                    'created_at': sess.created_at
-                }
-                if sess.kind == 'deposit':
-                    dp = DatPhong.query.get(data.get('dat_id'))
-                    if dp:
-                        info['khach_hang'] = dp.khachhang.ho_ten
-                        info['so_tien'] = data.get('amount', dp.tien_coc or 0)
-                        info['phong'] = dp.phong.ten
-                        info['dat_id'] = dp.id
-                elif sess.kind == 'service':
-                    dp = DatPhong.query.get(data.get('dat_id'))
-                    if dp:
-                        info['khach_hang'] = dp.khachhang.ho_ten
-                        info['so_tien'] = data.get('tong', 0)
-                        info['phong'] = dp.phong.ten
-                        info['dat_id'] = dp.id
-                elif sess.kind == 'room':
-                    dp = DatPhong.query.get(data.get('dat_id'))
-                    if dp:
-                        info['khach_hang'] = dp.khachhang.ho_ten
-                        info['so_tien'] = data.get('amount_due', 0)
-                        info['phong'] = dp.phong.ten
-                        info['dat_id'] = dp.id
-                expires_at = sess.created_at + timedelta(minutes=timeout_minutes)
-                info['expires_at'] = expires_at
-                info['remaining_seconds'] = max(0, int((expires_at - now).total_seconds()))
-                pending_sessions.append(info)
+            data = sess.data
+            # Lấy thông tin khách hàng và số tiền
+            info = {
+                'type': 'payment_session',
+                'token': sess.token, 
+                'kind': sess.kind, 
+                'created_at': sess.created_at
+            }
+            if sess.kind == 'deposit':
+                dp = DatPhong.query.get(sess.dat_id)
+                if dp:
+                    info['khach_hang'] = dp.khachhang.ho_ten
+                    info['so_tien'] = data.get('amount', dp.tien_coc or 0)
+                    info['phong'] = dp.phong.ten
+                    info['dat_id'] = dp.id
+            elif sess.kind == 'service':
+                dp = DatPhong.query.get(sess.dat_id)
+                if dp:
+                    info['khach_hang'] = dp.khachhang.ho_ten
+                    info['so_tien'] = data.get('tong', 0)
+                    info['phong'] = dp.phong.ten
+                    info['dat_id'] = dp.id
+            elif sess.kind == 'room':
+                dp = DatPhong.query.get(sess.dat_id)
+                if dp:
+                    info['khach_hang'] = dp.khachhang.ho_ten
+                    info['so_tien'] = data.get('amount_due', 0)
+                    info['phong'] = dp.phong.ten
+                    info['dat_id'] = dp.id
+            expires_at = session_expires_at(sess)
+            info['expires_at'] = expires_at
+            info['remaining_seconds'] = max(0, int((expires_at - now).total_seconds()))
+            pending_sessions.append(info)
         except Exception as e:
             app.logger.warning(f'Error parsing session {sess.token}: {e}')
     
@@ -3948,14 +5534,8 @@ def cap_nhat_timeout_thanh_toan():
             return redirect(url_for('thanh_toan_chua_hoan_tat'))
 
         # Lưu vào database
-        setting = HeThongCauHinh.query.filter_by(key='payment_timeout_minutes').first()
-        if setting:
-            setting.value = str(timeout_minutes)
-        else:
-            setting = HeThongCauHinh(key='payment_timeout_minutes', value=str(timeout_minutes))
-            db.session.add(setting)
-
-        db.session.commit()
+        set_config_int('payment_timeout_minutes', timeout_minutes)
+        reconcile_booking_deadlines()
         flash(f'Đã cập nhật thời gian timeout thanh toán thành {timeout_minutes} phút', 'success')
 
     except ValueError:
@@ -3983,9 +5563,7 @@ def huy_dat_phong(dat_id):
     
     # Xóa payment session nếu có
     if dp.payment_token:
-        session = PaymentSession.query.filter_by(token=dp.payment_token).first()
-        if session:
-            db.session.delete(session)
+        payment_sessions.delete(dp.payment_token)
     
     # Xóa booking
     db.session.delete(dp)
@@ -3998,9 +5576,7 @@ def huy_dat_phong(dat_id):
 @login_required
 @permission_required('payments.process')
 def huy_thanh_toan(token):
-    sess = PaymentSession.query.filter_by(token=token).first()
-    if sess:
-        db.session.delete(sess)
+    if payment_sessions.delete(token):
         db.session.commit()
         flash('Đã hủy phiên thanh toán thành công.', 'success')
     else:
@@ -4103,6 +5679,7 @@ def dat_phong():
         db.session.add(dp)
         # Không set phong.trang_thai = 'da_dat' ở đây - chỉ set khi thanh toán thành công
         db.session.flush()
+        schedule_booking_deadline(dp)
 
         booking_email_context = None
         if kh.email:
@@ -4118,11 +5695,11 @@ def dat_phong():
             except Exception as exc:
                 app.logger.warning('Không thể gửi email xác nhận booking: %s', exc)
 
-        socketio.emit('new_booking_notification', {
+        emit_to_staff('new_booking_notification', {
             'phong': dp.phong.ten,
             'khach': dp.khachhang.ho_ten,
             'message': f'Phòng {dp.phong.ten} vừa được đặt bởi khách {dp.khachhang.ho_ten}.'
-        })
+        }, 'bookings.manage_online')
         
         if is_waiting:
             flash('Đặt phòng của bạn đã được chuyển sang trạng thái "Đang chờ" và sẽ được xử lý khi phòng trống.', 'warning')
@@ -4258,6 +5835,8 @@ def dat_phong_online():
             voucher_id=voucher_id
         )
         db.session.add(dp)
+        db.session.flush()
+        schedule_booking_deadline(dp)
         db.session.commit()
 
         if requires_waiting_after_confirm:
@@ -4357,11 +5936,12 @@ def dat_phong_online_request_confirmation(token):
                          thoi_gian=datetime.now(), trang_thai='chua_doc')
             db.session.add(tn)
             db.session.commit()
-            socketio.emit('online_booking_deposit_request', {
+            refresh_badge_counts()
+            emit_to_staff('online_booking_deposit_request', {
                 'booking_id': dp.id,
                 'phong': dp.phong.ten,
                 'khach': dp.khachhang.ho_ten
-            })
+            }, 'bookings.manage_online')
             message = CUSTOMER_PENDING_CONFIRMATION_MESSAGE
             status = 'success'
     if wants_json:
@@ -4416,11 +5996,17 @@ def quan_ly_dat_phong_online_xac_nhan(dat_id):
         dp.auto_confirmed_at = datetime.now()
         if dp.phong.trang_thai == 'trong':
             dp.phong.trang_thai = 'da_dat'
+        schedule_booking_deadline(dp)
     tn = TinNhan(datphong_id=dp.id, nguoi_gui='he_thong',
                  noi_dung='Đã xác nhận tiền cọc đặt phòng online.',
                  thoi_gian=datetime.now(), trang_thai='chua_doc')
     db.session.add(tn)
+    completed_tokens = complete_payment_sessions(
+        'deposit', dp.id, lambda token: url_for('in_hoa_don_coc', dat_id=dp.id)
+    )
     db.session.commit()
+    for token in completed_tokens:
+        push_payment_status(token)
 
     if dp.khachhang.email:
         try:
@@ -4431,11 +6017,12 @@ def quan_ly_dat_phong_online_xac_nhan(dat_id):
         except Exception as exc:
             app.logger.warning('Không thể gửi email xác nhận đặt phòng online: %s', exc)
 
-    socketio.emit('online_booking_confirmed', {
+    refresh_badge_counts()
+    emit_to_staff('online_booking_confirmed', {
         'booking_id': dp.id,
         'phong': dp.phong.ten,
         'khach': dp.khachhang.ho_ten
-    })
+    }, 'bookings.manage_online')
     flash('Đã xác nhận tiền cọc và giữ phòng cho khách.', 'success')
     return redirect(url_for('quan_ly_dat_phong_online'))
 
@@ -4456,11 +6043,12 @@ def quan_ly_dat_phong_online_tu_choi(dat_id):
                  thoi_gian=datetime.now(), trang_thai='chua_doc')
     db.session.add(tn)
     db.session.commit()
-    socketio.emit('online_booking_rejected', {
+    refresh_badge_counts()
+    emit_to_staff('online_booking_rejected', {
         'booking_id': dp.id,
         'phong': dp.phong.ten,
         'khach': dp.khachhang.ho_ten
-    })
+    }, 'bookings.manage_online')
     flash('Đã từ chối yêu cầu đặt phòng.', 'info')
     return redirect(url_for('quan_ly_dat_phong_online'))
 
@@ -4506,7 +6094,6 @@ def quan_ly_booking_cho_tu_choi(dat_id):
 @login_required
 @permission_required('bookings.checkin_checkout')
 def nhan_phong():
-    huy_dat_phong_khong_den()
     # Lấy tab từ query parameter (mặc định là checkin)
     active_tab = request.args.get('tab', 'checkin')
     
@@ -4589,11 +6176,7 @@ def nhan_phong():
     else:
         voucher_room_label = ''
     voucher_rooms_enabled = bool(voucher_room_names)
-    cancel_setting = HeThongCauHinh.query.filter_by(key='auto_cancel_minutes').first()
-    try:
-        auto_cancel_minutes = int(cancel_setting.value) if cancel_setting and cancel_setting.value else 5
-    except ValueError:
-        auto_cancel_minutes = 5
+    auto_cancel_minutes = get_config_int('auto_cancel_minutes', 5)
     # Use raw SQL to avoid SQLAlchemy model attribute issues after schema changes
     ds_nhan_query = db.text("""
         SELECT * FROM datphong 
@@ -4724,19 +6307,7 @@ def build_salary_settings_context(selected_id=None):
     now = datetime.now()
     start_month = datetime(now.year, now.month, 1)
     next_month = (start_month + timedelta(days=32)).replace(day=1)
-    month_rows = db.session.query(
-        DatPhong.nhanvien_id.label('nv_id'),
-        func.coalesce(func.sum(DatPhong.tong_thanh_toan), 0).label('doanh_thu')
-    ).filter(
-        DatPhong.trang_thai == 'da_thanh_toan',
-        DatPhong.thuc_te_tra >= start_month,
-        DatPhong.thuc_te_tra < next_month
-    ).group_by(DatPhong.nhanvien_id).all()
-    top_staff_ids = set()
-    if month_rows:
-        top_max = max(int(row.doanh_thu or 0) for row in month_rows)
-        if top_max > 0:
-            top_staff_ids = {row.nv_id for row in month_rows if int(row.doanh_thu or 0) == top_max}
+    top_staff_ids = top_revenue_staff_ids(staff_revenue(start_month, next_month))
 
     salary_records = {item.nguoidung_id: item for item in LuongNhanVien.query.all()}
     tiers = LuongThuongCauHinh.query.order_by(LuongThuongCauHinh.moc_duoi.asc()).all()
@@ -4935,6 +6506,7 @@ def thanh_toan_coc(dat_id):
                 dp.auto_confirmed_at = datetime.now()
                 if dp.phong.trang_thai == 'trong':
                     dp.phong.trang_thai = 'da_dat'
+                schedule_booking_deadline(dp)
             db.session.commit()
             flash('Da ghi nhan thanh toan tien coc bang tien mat.', 'success')
             return redirect(url_for('in_hoa_don_coc', dat_id=dat_id))
@@ -4946,12 +6518,13 @@ def thanh_toan_coc(dat_id):
         dp.payment_token = payment_token
         dp.phuong_thuc_coc = 'qr'
         dp.coc_da_thanh_toan = False
-        create_payment_session(payment_token, 'deposit', {
+        deposit_session = create_payment_session(payment_token, 'deposit', {
             'dat_id': dat_id,
             'amount': int(dp.tien_coc or 0),
             'customer_name': dp.khachhang.ho_ten,
             'booking_code': dp.id
         })
+        schedule_booking_deadline(dp, hold_started=deposit_session.created_at)
         db.session.commit()
         return redirect(url_for('show_qr_deposit', token=payment_token))
 
@@ -5004,11 +6577,11 @@ def process_waiting_bookings(phong_id, previous_checkout_time=None):
             db.session.add(tn)
             updated = True
 
-            socketio.emit('booking_confirmed', {
+            emit_to_staff('booking_confirmed', {
                 'booking_id': wb.id,
                 'phong': wb.phong.ten,
                 'khach': wb.khachhang.ho_ten
-            })
+            }, 'bookings.manage_waiting')
             break
 
     if updated:
@@ -5029,6 +6602,8 @@ def thanh_toan(dat_id):
     selected_method = request.form.get('payment_method') or dp.phuong_thuc_thanh_toan or 'qr'
 
     if request.method == 'POST':
+        # Khóa dòng trước khi kiểm tra để hai lần bấm không cộng doanh thu hai lần
+        dp = lock_booking(dat_id)
         if dp.trang_thai == 'da_thanh_toan':
             flash('Dat phong nay da duoc thanh toan truoc do.', 'info')
             return redirect(url_for('thanh_toan', dat_id=dat_id))
@@ -5050,6 +6625,7 @@ def thanh_toan(dat_id):
             dp.trang_thai = 'da_thanh_toan'
             dp.nhanvien_id = current_user.id
             diem_moi = award_loyalty_points_for_booking(dp)
+            record_booking_revenue(dp)
             db.session.commit()
             
             # Kiểm tra và chuyển waiting bookings
@@ -5103,7 +6679,7 @@ def qr_confirm(token):
     ttl = get_payment_session_ttl()
     timeout_minutes = max(1, int(ttl.total_seconds() // 60))
 
-    if payment_session_expired(session['created_at'], ttl=ttl):
+    if session['expired']:
         pop_payment_session(token)
         return render_template(
             'payment_confirm.html',
@@ -5131,7 +6707,7 @@ def qr_confirm(token):
     else:
         return render_template('payment_confirm.html', error='Loại thanh toán không được hỗ trợ.')
 
-    expires_at = payment_session_expires_at(session['created_at'], ttl=ttl)
+    expires_at = session['expires_at']
     remaining = max(0, int((expires_at - datetime.now()).total_seconds()))
 
     return render_template(
@@ -5150,12 +6726,25 @@ def qr_confirm(token):
 @app.route('/qr-image/<token>')
 def qr_image(token):
     session = get_payment_session(token)
-    if not session or payment_session_expired(session['created_at']):
-        return send_file(io.BytesIO(b'Invalid or expired session'), mimetype='image/png')
-    
+    if not session or session['expired']:
+        response = send_file(io.BytesIO(b'Invalid or expired session'), mimetype='image/png')
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+
     confirm_url = url_for('qr_confirm', token=token, _external=True)
-    qr_buf = generate_qr_code(confirm_url)
-    return send_file(qr_buf, mimetype='image/png')
+    etag = qr_images.etag(confirm_url)
+    # Ảnh của một token không bao giờ đổi; trình duyệt giữ tới khi phiên hết hạn
+    max_age = max(0, int((session['expires_at'] - datetime.now()).total_seconds()))
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        png = qr_images.lookup(confirm_url)
+        if png is None:
+            png = run_blocking(qr_images.render, confirm_url)
+        response = app.response_class(png, mimetype='image/png')
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f'private, max-age={max_age}'
+    return response
 
 
 @app.route('/cam-on/<token>')
@@ -5188,7 +6777,7 @@ def show_qr_deposit(token):
     ttl = get_payment_session_ttl()
     timeout_minutes = max(1, int(ttl.total_seconds() // 60))
 
-    if payment_session_expired(session['created_at'], ttl=ttl):
+    if session['expired']:
         pop_payment_session(token)
         flash(
             f'Phiên thanh toán đã hết hạn (quá {timeout_minutes} phút).',
@@ -5206,12 +6795,13 @@ def show_qr_deposit(token):
     if data.get('completed'):
         flash('Phiên thanh toán đã được xác nhận. Vui lòng tạo mã QR mới nếu cần.', 'info')
         return redirect(invoice_url)
-    expires_at = payment_session_expires_at(session['created_at'], ttl=ttl)
+    expires_at = session['expires_at']
     remaining = max(0, int((expires_at - datetime.now()).total_seconds()))
 
     return render_template(
         'qr_deposit.html',
         dp=dp,
+        payment_token=token,
         amount=amount,
         qr_url=qr_url,
         confirm_url=confirm_url,
@@ -5232,7 +6822,7 @@ def show_qr_service(token):
     ttl = get_payment_session_ttl()
     timeout_minutes = max(1, int(ttl.total_seconds() // 60))
 
-    if payment_session_expired(session['created_at'], ttl=ttl):
+    if session['expired']:
         pop_payment_session(token)
         flash(
             f'Phiên thanh toán đã hết hạn (quá {timeout_minutes} phút).',
@@ -5250,12 +6840,13 @@ def show_qr_service(token):
     if data.get('completed'):
         flash('Phiên thanh toán đã được xác nhận. Vui lòng tạo mã QR mới nếu cần.', 'info')
         return redirect(invoice_url)
-    expires_at = payment_session_expires_at(session['created_at'], ttl=ttl)
+    expires_at = session['expires_at']
     remaining = max(0, int((expires_at - datetime.now()).total_seconds()))
 
     return render_template(
         'qr_service.html',
         dp=dp,
+        payment_token=token,
         amount=amount,
         qr_url=qr_url,
         confirm_url=confirm_url,
@@ -5277,7 +6868,7 @@ def show_qr_room(token):
     ttl = get_payment_session_ttl()
     timeout_minutes = max(1, int(ttl.total_seconds() // 60))
 
-    if payment_session_expired(session['created_at'], ttl=ttl):
+    if session['expired']:
         pop_payment_session(token)
         flash(
             f'Phiên thanh toán đã hết hạn (quá {timeout_minutes} phút).',
@@ -5296,13 +6887,14 @@ def show_qr_room(token):
     if data.get('completed'):
         flash('Phiên thanh toán đã được xác nhận. Vui lòng tạo mã QR mới nếu cần.', 'info')
         return redirect(invoice_url)
-    expires_at = payment_session_expires_at(session['created_at'], ttl=ttl)
+    expires_at = session['expires_at']
     remaining = max(0, int((expires_at - datetime.now()).total_seconds()))
     calc_values = data.get('calc_values', {})
 
     return render_template(
         'qr_room.html',
         dp=dp,
+        payment_token=token,
         amount_due=amount,
         tien_da_tra_truoc=tien_da_tra_truoc,
         qr_url=qr_url,
@@ -5317,18 +6909,15 @@ def show_qr_room(token):
 
 @app.route('/api/payment/confirm/<token>', methods=['POST'])
 def api_confirm_payment(token):
-    session_model = PaymentSession.query.filter_by(token=token).first()
+    session_model = payment_sessions.get(token)
     if not session_model:
         return jsonify({'success': False, 'message': 'Phiên thanh toán không hợp lệ.'}), 404
 
-    if payment_session_expired(session_model.created_at):
+    if session_expires_at(session_model) <= datetime.now():
         pop_payment_session(token)
         return jsonify({'success': False, 'message': 'Phiên thanh toán đã hết hạn.'})
 
-    try:
-        data = json.loads(session_model.payload or '{}')
-    except Exception:
-        data = {}
+    data = session_model.data
 
     if data.get('completed'):
         return jsonify({'success': True, 'redirect_url': data.get('redirect_url')})
@@ -5341,7 +6930,6 @@ def api_confirm_payment(token):
             dp = DatPhong.query.get_or_404(dat_id)
             data['redirect_url'] = url_for('cam_on', token=token)
             data['message'] = 'Cảm ơn bạn đã thanh toán tiền cọc. Đặt phòng của bạn đã được xác nhận.'
-            data['completed'] = True
             dp.coc_da_thanh_toan = True
             dp.phuong_thuc_coc = 'qr'
             dp.payment_token = None
@@ -5358,9 +6946,11 @@ def api_confirm_payment(token):
                 dp.auto_confirmed_at = datetime.now()
                 if dp.phong.trang_thai == 'trong':
                     dp.phong.trang_thai = 'da_dat'
-            session_model.payload = json.dumps(data)
+                schedule_booking_deadline(dp)
+            payment_sessions.mark_completed(session_model, data)
             db.session.commit()
-            socketio.emit('deposit_payment_confirmed', {'dat_id': dat_id})
+            push_payment_status(token)
+            emit_to_staff('deposit_payment_confirmed', {'dat_id': dat_id}, 'payments.process')
             return jsonify({'success': True, 'redirect_url': data['redirect_url']})
 
         if kind == 'service':
@@ -5383,22 +6973,23 @@ def api_confirm_payment(token):
             dp.tien_dv = (dp.tien_dv or 0) + amount_total
             data['redirect_url'] = url_for('cam_on', token=token)
             data['message'] = 'Cảm ơn bạn đã thanh toán dịch vụ. Dịch vụ của bạn đã được xác nhận.'
-            data['completed'] = True
-            session_model.payload = json.dumps(data)
+            payment_sessions.mark_completed(session_model, data)
             db.session.commit()
-            socketio.emit('service_payment_confirmed', {'dat_id': dat_id})
+            push_payment_status(token)
+            emit_to_staff('service_payment_confirmed', {'dat_id': dat_id}, 'payments.process')
             return jsonify({'success': True, 'redirect_url': data['redirect_url']})
 
         if kind == 'room':
             dat_id = data['dat_id']
             calc_values = data.get('calc_values', {})
-            dp = DatPhong.query.get_or_404(dat_id)
+            # Khách có thể bấm xác nhận hai lần: khóa dòng để chỉ một request ghi doanh thu
+            dp = lock_booking(dat_id)
             if dp.trang_thai == 'da_thanh_toan':
                 data['redirect_url'] = url_for('cam_on', token=token)
                 data['message'] = 'Cảm ơn bạn đã hoàn tất thanh toán. Thủ tục trả phòng đã được hoàn tất.'
-                data['completed'] = True
-                session_model.payload = json.dumps(data)
+                payment_sessions.mark_completed(session_model, data)
                 db.session.commit()
+                push_payment_status(token)
                 return jsonify({'success': True, 'redirect_url': data['redirect_url']})
             dp.thuc_te_tra = dp.thuc_te_tra or datetime.now()
             dp.tien_phong = calc_values.get('tien_phong', dp.tien_phong or 0)
@@ -5411,15 +7002,16 @@ def api_confirm_payment(token):
             if current_user.is_authenticated:
                 dp.nhanvien_id = current_user.id
             diem_moi = award_loyalty_points_for_booking(dp)
+            record_booking_revenue(dp)
             data['redirect_url'] = url_for('cam_on', token=token)
             if diem_moi:
                 data['message'] = f'Cảm ơn bạn đã hoàn tất thanh toán. Bạn vừa được cộng {diem_moi} điểm tích lũy.'
             else:
                 data['message'] = 'Cảm ơn bạn đã hoàn tất thanh toán. Thủ tục trả phòng đã được hoàn tất.'
-            data['completed'] = True
-            session_model.payload = json.dumps(data)
+            payment_sessions.mark_completed(session_model, data)
             db.session.commit()
-            socketio.emit('room_payment_confirmed', {'dat_id': dat_id})
+            push_payment_status(token)
+            emit_to_staff('room_payment_confirmed', {'dat_id': dat_id}, 'payments.process')
             return jsonify({'success': True, 'redirect_url': data['redirect_url']})
 
         return jsonify({'success': False, 'message': 'Loại thanh toán không được hỗ trợ.'}), 400
@@ -5428,41 +7020,29 @@ def api_confirm_payment(token):
         return jsonify({'success': False, 'message': str(exc)}), 500
 
 
+def payment_status_payload(token):
+    """Status of a payment session: pending, completed, expired or invalid.
+
+    Polled every few seconds by static/payments.js, so it only reads the session
+    store: cash payments drop the QR sessions, while QR confirmations and staff
+    confirmations (complete_payment_sessions) mark them completed, so there is
+    no booking state left to re-check here.
+    """
+    session = get_payment_session(token)
+    if not session:
+        return {'status': 'invalid'}
+    data = session['data']
+    if data.get('completed'):
+        # Không pop session để /cam-on có thể truy cập
+        return {'status': 'completed', 'redirect_url': data.get('redirect_url')}
+    if session['expired']:
+        return {'status': 'expired'}
+    return {'status': 'pending', 'expires_at': session['expires_at'].isoformat()}
+
+
 @app.route('/api/payment/status/<token>')
 def api_payment_status(token):
-    session = get_payment_session(token)
-    if session:
-        data = session['data']
-        if data.get('completed'):
-            redirect_url = data.get('redirect_url')
-            # Không pop session để /cam-on có thể truy cập
-            return jsonify({'status': 'completed', 'redirect_url': redirect_url})
-        if payment_session_expired(session['created_at']):
-            pop_payment_session(token)
-            return jsonify({'status': 'expired'})
-        kind = session['kind']
-        if kind == 'deposit':
-            dp = DatPhong.query.get(data['dat_id'])
-            if dp and dp.coc_da_thanh_toan:
-                pop_payment_session(token)
-                return jsonify({'status': 'completed', 'redirect_url': url_for('in_hoa_don_coc', dat_id=dp.id)})
-        elif kind == 'service':
-            remaining = SuDungDichVu.query.filter_by(datphong_id=data['dat_id'], trang_thai='chua_thanh_toan').count()
-            if remaining == 0:
-                pop_payment_session(token)
-                return jsonify({'status': 'completed', 'redirect_url': url_for('in_hoa_don_dv', token=token)})
-        elif kind == 'room':
-            dp = DatPhong.query.get(data['dat_id'])
-            if dp and dp.trang_thai == 'da_thanh_toan':
-                pop_payment_session(token)
-                return jsonify({'status': 'completed', 'redirect_url': url_for('in_hoa_don', dat_id=dp.id)})
-        expires_at = payment_session_expires_at(session['created_at'])
-        return jsonify({'status': 'pending', 'expires_at': expires_at.isoformat()})
-
-    dp = DatPhong.query.filter_by(payment_token=token).first()
-    if dp and dp.coc_da_thanh_toan:
-        return jsonify({'status': 'completed', 'redirect_url': url_for('in_hoa_don_coc', dat_id=dp.id)})
-    return jsonify({'status': 'invalid'})
+    return jsonify(payment_status_payload(token))
 
 
 @app.route('/gui-hoa-don-email/<int:dat_id>', methods=['POST'])
@@ -5519,12 +7099,9 @@ def gui_hoa_don_email(dat_id):
     try:
         send_email_with_template('invoice_notice', email_to, context, attachments=None,
                                 datphong_id=dp.id, khachhang_id=dp.khachhang_id)
-        flash(f'Đã gửi hóa đơn tới {email_to}.', 'success')
+        flash(f'Đã xếp hàng gửi hóa đơn tới {email_to}.', 'success')
     except (RuntimeError, ValueError) as exc:
         flash(str(exc), 'danger')
-    except (smtplib.SMTPException, OSError) as exc:
-        app.logger.exception('Không thể gửi email hóa đơn: %s', exc)
-        flash('Không thể gửi email hóa đơn. Vui lòng kiểm tra cấu hình SMTP và thử lại.', 'danger')
     except Exception as exc:
         app.logger.exception('Lỗi không xác định khi gửi hóa đơn: %s', exc)
         flash('Hệ thống gặp lỗi khi gửi email. Vui lòng thử lại sau.', 'danger')
@@ -5552,7 +7129,7 @@ def in_hoa_don_coc(dat_id):
     # Get actual payment time from payment session if available
     payment_time = dp.created_at  # Default to booking creation time
     if dp.payment_token:
-        session = PaymentSession.query.filter_by(token=dp.payment_token).first()
+        session = payment_sessions.get(dp.payment_token)
         if session:
             payment_time = session.created_at
     
@@ -5641,7 +7218,7 @@ def in_hoa_don(dat_id):
     
     # Try to get actual payment time from payment session
     if dp.payment_token:
-        session = PaymentSession.query.filter_by(token=dp.payment_token).first()
+        session = payment_sessions.get(dp.payment_token)
         if session:
             payment_time = session.created_at
     
@@ -5766,22 +7343,7 @@ def gia_han_phong(dat_id):
             if dp.chat_token:
                 try:
                     msg = f"Phòng của bạn đã được gia hạn đến {ngay_tra_moi.strftime('%d/%m/%Y %H:%M')}. Thêm {so_dem_them} đêm, tiền phòng thêm: {vnd(tien_phong_them)}."
-                    tn = TinNhan(
-                        datphong_id=dat_id,
-                        nguoi_gui='he_thong',
-                        noi_dung=msg,
-                        thoi_gian=datetime.now(),
-                        trang_thai='chua_doc'
-                    )
-                    db.session.add(tn)
-                    db.session.commit()
-                    
-                    # Emit SocketIO event
-                    socketio.emit('new_message', {
-                        'booking_id': dat_id,
-                        'message': msg,
-                        'sender': 'system'
-                    })
+                    persist_message(dat_id, 'he_thong', msg)
                 except Exception as e:
                     app.logger.warning(f'Không thể gửi thông báo gia hạn: {e}')
             
@@ -6090,13 +7652,8 @@ def luong_thuong():
     start_month = datetime(now.year, now.month, 1)
     next_month = (start_month + timedelta(days=32)).replace(day=1)
 
-    doanh_thu = db.session.query(func.coalesce(func.sum(DatPhong.tong_thanh_toan), 0)).filter(
-        DatPhong.nhanvien_id == current_user.id,
-        DatPhong.trang_thai == 'da_thanh_toan',
-        DatPhong.thuc_te_tra >= start_month,
-        DatPhong.thuc_te_tra < next_month
-    ).scalar()
-    doanh_thu = int(doanh_thu or 0)
+    revenues = staff_revenue(start_month, next_month)
+    doanh_thu = revenues.get(current_user.id, 0)
 
     tiers = LuongThuongCauHinh.query.order_by(LuongThuongCauHinh.moc_duoi.asc()).all()
     thuong, ty_le = tinh_thuong_doanh_thu(doanh_thu, tiers)
@@ -6106,19 +7663,7 @@ def luong_thuong():
 
     bonus_amount = get_top_bonus()
 
-    top_rows = db.session.query(
-        DatPhong.nhanvien_id.label('nv_id'),
-        func.coalesce(func.sum(DatPhong.tong_thanh_toan), 0).label('doanh_thu')
-    ).filter(
-        DatPhong.trang_thai == 'da_thanh_toan',
-        DatPhong.thuc_te_tra >= start_month,
-        DatPhong.thuc_te_tra < next_month
-    ).group_by(DatPhong.nhanvien_id).all()
-    top_bonus = 0
-    if top_rows:
-        top_max = max(int(row.doanh_thu or 0) for row in top_rows)
-        if top_max > 0 and any(int(row.nv_id) == current_user.id and int(row.doanh_thu or 0) == top_max for row in top_rows):
-            top_bonus = bonus_amount
+    top_bonus = bonus_amount if current_user.id in top_revenue_staff_ids(revenues) else 0
 
     salary_info = {
         'luong_co_ban': base_effective,
@@ -6179,31 +7724,14 @@ def tai_xuong_luong_excel():
     start_month = datetime(now.year, now.month, 1)
     next_month = (start_month + timedelta(days=32)).replace(day=1)
 
-    doanh_thu = db.session.query(func.coalesce(func.sum(DatPhong.tong_thanh_toan), 0)).filter(
-        DatPhong.nhanvien_id == current_user.id,
-        DatPhong.trang_thai == 'da_thanh_toan',
-        DatPhong.thuc_te_tra >= start_month,
-        DatPhong.thuc_te_tra < next_month
-    ).scalar()
-    doanh_thu = int(doanh_thu or 0)
+    revenues = staff_revenue(start_month, next_month)
+    doanh_thu = revenues.get(current_user.id, 0)
 
     tiers = LuongThuongCauHinh.query.order_by(LuongThuongCauHinh.moc_duoi.asc()).all()
     thuong, ty_le = tinh_thuong_doanh_thu(doanh_thu, tiers)
     bonus_amount = get_top_bonus()
 
-    top_rows = db.session.query(
-        DatPhong.nhanvien_id.label('nv_id'),
-        func.coalesce(func.sum(DatPhong.tong_thanh_toan), 0).label('doanh_thu')
-    ).filter(
-        DatPhong.trang_thai == 'da_thanh_toan',
-        DatPhong.thuc_te_tra >= start_month,
-        DatPhong.thuc_te_tra < next_month
-    ).group_by(DatPhong.nhanvien_id).all()
-    top_bonus = 0
-    if top_rows:
-        top_max = max(int(row.doanh_thu or 0) for row in top_rows)
-        if top_max > 0 and any(int(row.nv_id) == current_user.id and int(row.doanh_thu or 0) == top_max for row in top_rows):
-            top_bonus = bonus_amount
+    top_bonus = bonus_amount if current_user.id in top_revenue_staff_ids(revenues) else 0
 
     tong_luong = base_effective + phu_cap + thuong + top_bonus
 
@@ -6403,31 +7931,14 @@ def so_do_phong():
             .all()
         )
         
-        # Filter out expired cho_xac_nhan bookings
-        valid_upcoming_bookings = []
-        for booking in upcoming_bookings:
-            if booking.trang_thai == 'dat':
-                valid_upcoming_bookings.append(booking)
-            elif booking.trang_thai == 'cho_xac_nhan':
-                # Check if booking has active payment session or is within 5 minutes of creation
-                is_valid = False
-                if booking.payment_token:
-                    session = PaymentSession.query.filter_by(token=booking.payment_token).first()
-                    if session and not payment_session_expired(session.created_at):
-                        is_valid = True
-                else:
-                    # No payment session yet, check if booking is within 5 minutes
-                    if not payment_session_expired(booking.created_at):
-                        is_valid = True
-                
-                if is_valid:
-                    valid_upcoming_bookings.append(booking)
-                else:
-                    # Mark expired cho_xac_nhan as cancelled
-                    booking.trang_thai = 'huy'
-                    db.session.commit()
-        
-        upcoming_bookings = valid_upcoming_bookings
+        # Bỏ qua các booking cho_xac_nhan đã hết hạn giữ chỗ (chỉ đọc, việc hủy
+        # do expire_lapsed_holds đảm nhận)
+        session_started = load_hold_session_starts(upcoming_bookings)
+        ttl = get_payment_session_ttl()
+        upcoming_bookings = [
+            booking for booking in upcoming_bookings
+            if not hold_is_expired(booking, session_started, ttl, now)
+        ]
         for booking in upcoming_bookings:
             upcoming_by_room.setdefault(booking.phong_id, booking)
 
@@ -7119,19 +8630,7 @@ def nhan_vien_chi_tiet(nhanvien_id):
 
     bonus_amount = get_top_bonus()
 
-    top_rows = db.session.query(
-        DatPhong.nhanvien_id.label('nv_id'),
-        func.coalesce(func.sum(DatPhong.tong_thanh_toan), 0).label('doanh_thu')
-    ).filter(
-        DatPhong.trang_thai == 'da_thanh_toan',
-        DatPhong.thuc_te_tra >= start_month,
-        DatPhong.thuc_te_tra < next_month
-    ).group_by(DatPhong.nhanvien_id).all()
-    top_bonus = 0
-    if top_rows:
-        top_max = max(int(row.doanh_thu or 0) for row in top_rows)
-        if top_max > 0 and any(int(row.nv_id) == nv.id and int(row.doanh_thu or 0) == top_max for row in top_rows):
-            top_bonus = bonus_amount
+    top_bonus = bonus_amount if nv.id in top_revenue_staff_ids(staff_revenue(start_month, next_month)) else 0
 
     salary_mode = get_salary_mode()
     luong_record = LuongNhanVien.query.filter_by(nguoidung_id=nv.id).first()
@@ -7544,6 +9043,7 @@ def cai_dat_luong_thuong():
                 if minutes < 1:
                     minutes = 5
                 set_config_int('auto_cancel_minutes', minutes)
+                reconcile_booking_deadlines()
                 message = 'Đã cập nhật thời gian tự động hủy đặt phòng.'
             except ValueError:
                 status = 'danger'
@@ -7613,7 +9113,9 @@ def cai_dat_email():
             else:
                 tpl.subject = subject
                 tpl.body = body
+                touch_email_template(tpl)
                 db.session.commit()
+                email_template_registry.invalidate(template_key)
                 flash('Đã lưu mẫu email.', 'success')
         elif form_name == 'reset_template':
             template_key = request.form.get('template_key')
@@ -7624,7 +9126,9 @@ def cai_dat_email():
             else:
                 tpl.subject = defaults['subject']
                 tpl.body = defaults['body']
+                touch_email_template(tpl)
                 db.session.commit()
+                email_template_registry.invalidate(template_key)
                 flash('Đã khôi phục mẫu email về mặc định.', 'success')
         else:
             flash('Yêu cầu không hợp lệ.', 'warning')
@@ -7649,6 +9153,22 @@ def cai_dat_email():
     )
 
 
+@app.route('/api/email-template-stats')
+@login_required
+@permission_required('email.settings')
+def api_email_template_stats():
+    """Thống kê biên dịch/render mẫu email của tiến trình hiện tại"""
+    return jsonify(email_template_registry.stats())
+
+
+@app.route('/api/qr-cache-stats')
+@login_required
+@permission_required('payments.process')
+def api_qr_cache_stats():
+    """Thống kê cache ảnh QR của tiến trình hiện tại"""
+    return jsonify(qr_images.stats())
+
+
 @app.route('/lich-su-email')
 @login_required
 @permission_required('email.logs')
@@ -7698,6 +9218,129 @@ def chi_tiet_email(log_id):
     return render_template('chi_tiet_email.html', log=log)
 
 
+REVENUE_DETAIL_PER_PAGE = 50
+
+
+def add_months(dt, months):
+    """Ngày 1 của tháng cách ``dt`` ``months`` tháng."""
+    index = dt.year * 12 + dt.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+
+class RevenuePeriod:
+    """Kỳ thống kê [start, end), kỳ so sánh và các cột của biểu đồ."""
+
+    def __init__(self, view_type, year, month, quarter):
+        if view_type == 'year':
+            self.start, self.end = datetime(year, 1, 1), datetime(year + 1, 1, 1)
+            self.prev_start, self.prev_end = datetime(year - 1, 1, 1), self.start
+            self.bucket = 'month'
+            self.keys = list(range(1, 13))
+            self.labels = [f"T{m}" for m in self.keys]
+        elif view_type == 'quarter':
+            start_month = (quarter - 1) * 3 + 1
+            self.start = datetime(year, start_month, 1)
+            self.end = add_months(self.start, 3)
+            # Quý so với cả năm trước, như trước đây
+            self.prev_start, self.prev_end = datetime(year - 1, 1, 1), datetime(year, 1, 1)
+            self.bucket = 'month'
+            self.keys = list(range(start_month, start_month + 3))
+            self.labels = [f"Tháng {m}" for m in self.keys]
+        else:
+            self.start = datetime(year, month, 1)
+            self.end = add_months(self.start, 1)
+            self.prev_start, self.prev_end = add_months(self.start, -1), self.start
+            self.bucket = 'day'
+            self.keys = list(range(1, calendar.monthrange(year, month)[1] + 1))
+            self.labels = [f"{d:02d}" for d in self.keys]
+
+
+class RevenueReport:
+    """Số liệu doanh thu của các ngày thanh toán trong [start, end).
+
+    Biểu đồ, tổng, kỳ trước, top phòng và tỉ trọng loại phòng cộng từ
+    revenue_daily (vài nghìn dòng cho nhiều năm); top khách hàng và bảng chi
+    tiết đọc datphong theo khoảng thuc_te_tra. Số câu truy vấn không phụ thuộc
+    số booking.
+    """
+
+    def __init__(self, start, end):
+        self.start, self.end = start, end
+
+    def filters(self):
+        return (
+            revenue_booking_filter(),
+            DatPhong.thuc_te_tra >= self.start,
+            DatPhong.thuc_te_tra < self.end,
+        )
+
+    def buckets(self, unit):
+        """``{day|month: {'tong', 'phong', 'dv', 'phat', 'coc', 'so_booking'}}``"""
+        bucket = extract(unit, RevenueDaily.ngay).label('bucket')
+        rows = db.session.query(
+            bucket,
+            func.coalesce(func.sum(RevenueDaily.tong_thanh_toan), 0).label('tong'),
+            func.coalesce(func.sum(RevenueDaily.tien_phong), 0).label('phong'),
+            func.coalesce(func.sum(RevenueDaily.tien_dv), 0).label('dv'),
+            func.coalesce(func.sum(RevenueDaily.tien_phat), 0).label('phat'),
+            func.coalesce(func.sum(RevenueDaily.tien_coc), 0).label('coc'),
+            func.coalesce(func.sum(RevenueDaily.so_booking), 0).label('so_booking'),
+        ).filter(*revenue_daily_range(self.start, self.end)).group_by('bucket').all()
+        return {
+            int(row.bucket): {
+                'tong': int(row.tong), 'phong': int(row.phong), 'dv': int(row.dv),
+                'phat': int(row.phat), 'coc': int(row.coc), 'so_booking': int(row.so_booking),
+            }
+            for row in rows
+        }
+
+    def total(self):
+        value = db.session.query(func.coalesce(func.sum(RevenueDaily.tong_thanh_toan), 0)).filter(
+            *revenue_daily_range(self.start, self.end)
+        ).scalar()
+        return int(value or 0)
+
+    def top_customers(self, limit=5):
+        total = func.coalesce(func.sum(DatPhong.tong_thanh_toan), 0)
+        rows = db.session.query(
+            KhachHang.id, KhachHang.ho_ten, total.label('total'), func.count(DatPhong.id).label('count')
+        ).join(DatPhong, DatPhong.khachhang_id == KhachHang.id).filter(*self.filters()).group_by(
+            KhachHang.id, KhachHang.ho_ten
+        ).order_by(total.desc(), KhachHang.id).limit(limit).all()
+        return [{'id': row.id, 'name': row.ho_ten, 'total': int(row.total), 'count': row.count} for row in rows]
+
+    def top_rooms(self, limit=5):
+        total = func.coalesce(func.sum(RevenueDaily.tong_thanh_toan), 0)
+        rows = db.session.query(
+            Phong.id, Phong.ten, LoaiPhong.ten.label('loai'), total.label('total'),
+            func.coalesce(func.sum(RevenueDaily.so_booking), 0).label('count')
+        ).select_from(RevenueDaily).join(Phong, RevenueDaily.phong_id == Phong.id).join(
+            LoaiPhong, Phong.loai_id == LoaiPhong.id
+        ).filter(*revenue_daily_range(self.start, self.end)).group_by(
+            Phong.id, Phong.ten, LoaiPhong.ten
+        ).order_by(total.desc(), Phong.id).limit(limit).all()
+        return [{'name': row.ten, 'type': row.loai, 'total': int(row.total), 'count': int(row.count)} for row in rows]
+
+    def room_types(self):
+        """``[(tên loại phòng, doanh thu)]`` theo loại phòng lúc thanh toán, doanh thu giảm dần."""
+        total = func.coalesce(func.sum(RevenueDaily.tong_thanh_toan), 0)
+        rows = db.session.query(LoaiPhong.ten, total.label('total')).select_from(RevenueDaily).join(
+            LoaiPhong, RevenueDaily.loai_id == LoaiPhong.id
+        ).filter(*revenue_daily_range(self.start, self.end)).group_by(
+            LoaiPhong.id, LoaiPhong.ten
+        ).order_by(total.desc()).all()
+        return [(row.ten, int(row.total)) for row in rows]
+
+    def bookings(self, page, per_page=REVENUE_DETAIL_PER_PAGE):
+        """Một trang chi tiết hóa đơn, khách hàng/phòng/loại phòng nạp cùng câu truy vấn."""
+        return DatPhong.query.options(
+            joinedload(DatPhong.khachhang),
+            joinedload(DatPhong.phong).joinedload(Phong.loai),
+        ).filter(*self.filters()).order_by(DatPhong.thuc_te_tra.asc(), DatPhong.id).paginate(
+            page=page, per_page=per_page, error_out=False
+        )
+
+
 @app.route('/thong-ke-doanh-thu')
 @login_required
 @permission_required('analytics.revenue')
@@ -7707,141 +9350,46 @@ def thong_ke_doanh_thu():
     month = int(request.args.get('thang', now.month))
     year = int(request.args.get('nam', now.year))
     quarter = int(request.args.get('quy', 1))
-    
-    # === LẤY DỮ LIỆU THEO LOẠI VIEW ===
-    if view_type == 'year':
-        # Thống kê cả năm
-        ds_doanh_thu = DatPhong.query.filter(
-            db.or_(DatPhong.trang_thai == 'da_thanh_toan', DatPhong.trang_thai == 'huy'),
-            extract('year', DatPhong.thuc_te_tra) == year
-        ).order_by(DatPhong.thuc_te_tra.asc()).all()
-        
-        # Doanh thu theo tháng
-        revenue_by_month = defaultdict(float)
-        room_revenue_by_month = defaultdict(float)
-        service_revenue_by_month = defaultdict(float)
-        for d in ds_doanh_thu:
-            if d.thuc_te_tra:
-                m = d.thuc_te_tra.month
-                revenue_by_month[m] += d.tong_thanh_toan
-                room_revenue_by_month[m] += d.tien_phong
-                service_revenue_by_month[m] += d.tien_dv
-        
-        chart_labels = [f"T{m}" for m in range(1, 13)]
-        chart_data = [revenue_by_month.get(m, 0) for m in range(1, 13)]
-        chart_room_data = [room_revenue_by_month.get(m, 0) for m in range(1, 13)]
-        chart_service_data = [service_revenue_by_month.get(m, 0) for m in range(1, 13)]
-        
-    elif view_type == 'quarter':
-        # Thống kê theo quý
-        start_month = (quarter - 1) * 3 + 1
-        end_month = start_month + 2
-        ds_doanh_thu = DatPhong.query.filter(
-            db.or_(DatPhong.trang_thai == 'da_thanh_toan', DatPhong.trang_thai == 'huy'),
-            extract('year', DatPhong.thuc_te_tra) == year,
-            extract('month', DatPhong.thuc_te_tra).between(start_month, end_month)
-        ).order_by(DatPhong.thuc_te_tra.asc()).all()
-        
-        revenue_by_month = defaultdict(float)
-        room_revenue_by_month = defaultdict(float)
-        service_revenue_by_month = defaultdict(float)
-        for d in ds_doanh_thu:
-            if d.thuc_te_tra:
-                m = d.thuc_te_tra.month
-                revenue_by_month[m] += d.tong_thanh_toan
-                room_revenue_by_month[m] += d.tien_phong
-                service_revenue_by_month[m] += d.tien_dv
-        
-        chart_labels = [f"Tháng {m}" for m in range(start_month, end_month + 1)]
-        chart_data = [revenue_by_month.get(m, 0) for m in range(start_month, end_month + 1)]
-        chart_room_data = [room_revenue_by_month.get(m, 0) for m in range(start_month, end_month + 1)]
-        chart_service_data = [service_revenue_by_month.get(m, 0) for m in range(start_month, end_month + 1)]
-        
-    else:  # month (default)
-        ds_doanh_thu = DatPhong.query.filter(
-            db.or_(DatPhong.trang_thai == 'da_thanh_toan', DatPhong.trang_thai == 'huy'),
-            extract('year', DatPhong.thuc_te_tra) == year,
-            extract('month', DatPhong.thuc_te_tra) == month
-        ).order_by(DatPhong.thuc_te_tra.asc()).all()
-        
-        days_in_month = calendar.monthrange(year, month)[1]
-        chart_labels = [f"{d:02d}" for d in range(1, days_in_month + 1)]
-        revenue_by_day = defaultdict(float)
-        room_revenue_by_day = defaultdict(float)
-        service_revenue_by_day = defaultdict(float)
-        for d in ds_doanh_thu:
-            if d.thuc_te_tra:
-                day = d.thuc_te_tra.day
-                revenue_by_day[day] += d.tong_thanh_toan
-                room_revenue_by_day[day] += d.tien_phong
-                service_revenue_by_day[day] += d.tien_dv
-        
-        chart_data = [revenue_by_day.get(d, 0) for d in range(1, days_in_month + 1)]
-        chart_room_data = [room_revenue_by_day.get(d, 0) for d in range(1, days_in_month + 1)]
-        chart_service_data = [service_revenue_by_day.get(d, 0) for d in range(1, days_in_month + 1)]
-    
-    # === TÍNH TỔNG ===
+    page = request.args.get('page', 1, type=int)
+
+    period = RevenuePeriod(view_type, year, month, quarter)
+    report = RevenueReport(period.start, period.end)
+
+    # === DOANH THU THEO NGÀY/THÁNG ===
+    buckets = report.buckets(period.bucket)
+    chart_labels = period.labels
+    chart_data = [buckets.get(k, {}).get('tong', 0) for k in period.keys]
+    chart_room_data = [buckets.get(k, {}).get('phong', 0) for k in period.keys]
+    chart_service_data = [buckets.get(k, {}).get('dv', 0) for k in period.keys]
+
+    # === TÍNH TỔNG === (tối đa 31 nhóm, cộng trong Python)
     tong_cong = {
-        'phong': sum(d.tien_phong for d in ds_doanh_thu),
-        'dv': sum(d.tien_dv for d in ds_doanh_thu),
-        'phat': sum(d.tien_phat for d in ds_doanh_thu),
-        'coc': sum(d.tien_coc for d in ds_doanh_thu),
-        'tong': sum(d.tong_thanh_toan for d in ds_doanh_thu),
-        'so_booking': len(ds_doanh_thu)
+        key: sum(b[key] for b in buckets.values())
+        for key in ('phong', 'dv', 'phat', 'coc', 'tong', 'so_booking')
     }
-    
+
     # === SO SÁNH VỚI KỲ TRƯỚC ===
-    if view_type == 'month':
-        prev_month = month - 1 if month > 1 else 12
-        prev_year = year if month > 1 else year - 1
-        prev_data = DatPhong.query.filter(
-            db.or_(DatPhong.trang_thai == 'da_thanh_toan', DatPhong.trang_thai == 'huy'),
-            extract('year', DatPhong.thuc_te_tra) == prev_year,
-            extract('month', DatPhong.thuc_te_tra) == prev_month
-        ).all()
-    else:
-        prev_year = year - 1
-        prev_data = DatPhong.query.filter(
-            db.or_(DatPhong.trang_thai == 'da_thanh_toan', DatPhong.trang_thai == 'huy'),
-            extract('year', DatPhong.thuc_te_tra) == prev_year
-        ).all()
-    
-    prev_total = sum(d.tong_thanh_toan for d in prev_data)
+    prev_total = RevenueReport(period.prev_start, period.prev_end).total()
     growth_rate = ((tong_cong['tong'] - prev_total) / prev_total * 100) if prev_total > 0 else 0
-    
-    # === TOP KHÁCH HÀNG ===
-    customer_revenue = defaultdict(lambda: {'total': 0, 'count': 0, 'name': '', 'id': 0})
-    for d in ds_doanh_thu:
-        customer_revenue[d.khachhang_id]['total'] += d.tong_thanh_toan
-        customer_revenue[d.khachhang_id]['count'] += 1
-        customer_revenue[d.khachhang_id]['name'] = d.khachhang.ho_ten
-        customer_revenue[d.khachhang_id]['id'] = d.khachhang_id
-    
-    top_customers = sorted(customer_revenue.values(), key=lambda x: x['total'], reverse=True)[:5]
-    
-    # === TOP PHÒNG ===
-    room_revenue = defaultdict(lambda: {'total': 0, 'count': 0, 'name': '', 'type': ''})
-    for d in ds_doanh_thu:
-        room_revenue[d.phong_id]['total'] += d.tong_thanh_toan
-        room_revenue[d.phong_id]['count'] += 1
-        room_revenue[d.phong_id]['name'] = d.phong.ten
-        room_revenue[d.phong_id]['type'] = d.phong.loai.ten
-    
-    top_rooms = sorted(room_revenue.values(), key=lambda x: x['total'], reverse=True)[:5]
-    
+
+    # === TOP KHÁCH HÀNG / TOP PHÒNG ===
+    top_customers = report.top_customers()
+    top_rooms = report.top_rooms()
+
     # === DOANH THU THEO LOẠI PHÒNG ===
-    room_type_revenue = defaultdict(float)
-    for d in ds_doanh_thu:
-        room_type_revenue[d.phong.loai.ten] += d.tong_thanh_toan
-    
-    pie_labels = list(room_type_revenue.keys())
-    pie_data = list(room_type_revenue.values())
-    
+    room_type_revenue = report.room_types()
+    pie_labels = [name for name, _ in room_type_revenue]
+    pie_data = [value for _, value in room_type_revenue]
+
     # === TRUNG BÌNH ===
     avg_revenue_per_booking = tong_cong['tong'] / tong_cong['so_booking'] if tong_cong['so_booking'] > 0 else 0
-    
+
+    # === CHI TIẾT HÓA ĐƠN (phân trang) ===
+    pagination = report.bookings(page)
+
     return render_template('thong_ke_doanh_thu.html',
-        ds_doanh_thu=ds_doanh_thu,
+        ds_doanh_thu=pagination.items,
+        pagination=pagination,
         tong_cong=tong_cong,
         current_month=month,
         current_year=year,
@@ -7860,18 +9408,16 @@ def thong_ke_doanh_thu():
         avg_revenue_per_booking=avg_revenue_per_booking
     )
 
-@app.route('/quan-li-hoa-don')
-@login_required
-@permission_required('payments.invoices')
-def quan_li_hoa_don():
+def invoice_list_query(args):
+    """Hóa đơn đã hoàn tất theo bộ lọc của trang quản lí hóa đơn (khach_hang, phong, tu_ngay, den_ngay)."""
     query = DatPhong.query.filter(
         db.or_(
             DatPhong.trang_thai == 'da_thanh_toan',
             db.and_(DatPhong.trang_thai == 'huy', DatPhong.tong_thanh_toan > 0)
         )
     )
-    search_kh, search_phong = request.args.get('khach_hang', ''), request.args.get('phong', '')
-    tu_ngay_str, den_ngay_str = request.args.get('tu_ngay', ''), request.args.get('den_ngay', '')
+    search_kh, search_phong = args.get('khach_hang', ''), args.get('phong', '')
+    tu_ngay_str, den_ngay_str = args.get('tu_ngay', ''), args.get('den_ngay', '')
     if search_kh:
         query = query.join(KhachHang).filter(db.or_(KhachHang.ho_ten.ilike(f'%{search_kh}%'), KhachHang.cmnd.ilike(f'%{search_kh}%')))
     if search_phong:
@@ -7880,514 +9426,449 @@ def quan_li_hoa_don():
         query = query.filter(DatPhong.thuc_te_tra >= datetime.strptime(tu_ngay_str, '%Y-%m-%d'))
     if den_ngay_str:
         query = query.filter(DatPhong.thuc_te_tra <= datetime.strptime(den_ngay_str, '%Y-%m-%d').replace(hour=23, minute=59, second=59))
+    return query
+
+
+@app.route('/quan-li-hoa-don')
+@login_required
+@permission_required('payments.invoices')
+def quan_li_hoa_don():
+    query = invoice_list_query(request.args)
     ds_hoa_don = query.order_by(DatPhong.thuc_te_tra.desc()).all()
     return render_template('quan_li_hoa_don.html', ds_hoa_don=ds_hoa_don, search_values=request.args)
 
-@app.route('/xuat-excel-hoa-don')
+
+class _ZipChunks(io.RawIOBase):
+    """Write target for zipfile that hands the written bytes out chunk by chunk."""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def stream_zip(files):
+    """Yield a ZIP archive of ``(name, bytes)`` pairs as it is built, without seeking."""
+    import zipfile
+
+    sink = _ZipChunks()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+        for name, data in files:
+            archive.writestr(name, data)
+            yield sink.drain()
+    yield sink.drain()
+
+
+@app.route('/in-hoa-don/<int:dat_id>/pdf')
+@login_required
+@permission_required('payments.invoices')
+def tai_hoa_don_pdf(dat_id):
+    dp = DatPhong.query.get_or_404(dat_id)
+    dich_vu_su_dung = SuDungDichVu.query.filter_by(datphong_id=dp.id, trang_thai='da_thanh_toan').options(
+        joinedload(SuDungDichVu.dichvu)
+    ).all()
+    try:
+        pdf, key = invoice_pdfs.render(dp, dich_vu_su_dung)
+    except RuntimeError as exc:
+        flash(str(exc), 'danger')
+        return redirect(url_for('in_hoa_don', dat_id=dat_id))
+    response = send_file(io.BytesIO(pdf), mimetype='application/pdf', as_attachment=True,
+                         download_name=f'hoa_don_{dp.id}.pdf')
+    if invoice_pdfs.cacheable(dp):
+        response.set_etag(key)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        response.make_conditional(request)
+    return response
+
+
+@app.route('/xuat-pdf-hoa-don')
 @login_required
 @permission_required('payments.export')
-def xuat_excel_hoa_don():
-    from io import BytesIO
-    import pandas as pd
-    from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
-    from openpyxl.utils import get_column_letter
-    from openpyxl.chart import PieChart, BarChart, Reference, Series
-    
-    # Lấy dữ liệu giống như quan_li_hoa_don
-    query = DatPhong.query.filter(
-        db.or_(
-            DatPhong.trang_thai == 'da_thanh_toan',
-            db.and_(DatPhong.trang_thai == 'huy', DatPhong.tong_thanh_toan > 0)
-        )
-    )
-    search_kh, search_phong = request.args.get('khach_hang', ''), request.args.get('phong', '')
-    tu_ngay_str, den_ngay_str = request.args.get('tu_ngay', ''), request.args.get('den_ngay', '')
-    if search_kh:
-        query = query.join(KhachHang).filter(db.or_(KhachHang.ho_ten.ilike(f'%{search_kh}%'), KhachHang.cmnd.ilike(f'%{search_kh}%')))
-    if search_phong:
-        query = query.join(Phong).filter(Phong.ten.ilike(f'%{search_phong}%'))
-    if tu_ngay_str:
-        query = query.filter(DatPhong.thuc_te_tra >= datetime.strptime(tu_ngay_str, '%Y-%m-%d'))
-    if den_ngay_str:
-        query = query.filter(DatPhong.thuc_te_tra <= datetime.strptime(den_ngay_str, '%Y-%m-%d').replace(hour=23, minute=59, second=59))
-    ds_hoa_don = query.order_by(DatPhong.thuc_te_tra.desc()).all()
-    
-    # Tạo dữ liệu cho Excel
-    data = []
-    for d in ds_hoa_don:
-        trang_thai = 'Đã thanh toán' if d.trang_thai == 'da_thanh_toan' else 'Hủy (mất cọc)'
-        data.append({
-            'Mã HĐ': d.id,
-            'Khách hàng': f"{d.khachhang.ho_ten} ({d.khachhang.cmnd})",
-            'Phòng': d.phong.ten,
-            'Ngày hoàn tất': d.thuc_te_tra.strftime('%d/%m/%Y %H:%M') if d.thuc_te_tra else '',
-            'Trạng thái': trang_thai,
-            'Tiền phòng (VNĐ)': d.tien_phong,
-            'Tiền dịch vụ (VNĐ)': d.tien_dv,
-            'Phí phạt (VNĐ)': d.tien_phat,
-            'Tổng cộng (VNĐ)': d.tong_thanh_toan
-        })
-    
-    # Tạo DataFrame
-    df = pd.DataFrame(data)
-    
-    # Tính toán thống kê cho biểu đồ
-    tong_da_thanh_toan = len([d for d in ds_hoa_don if d.trang_thai == 'da_thanh_toan'])
-    tong_huy_mat_coc = len([d for d in ds_hoa_don if d.trang_thai == 'huy'])
-    
-    tong_tien_phong = sum(d.tien_phong for d in ds_hoa_don)
-    tong_tien_dv = sum(d.tien_dv for d in ds_hoa_don)
-    tong_tien_phat = sum(d.tien_phat for d in ds_hoa_don)
-    tong_doanh_thu = sum(d.tong_thanh_toan for d in ds_hoa_don)
-    
-    # Tạo file Excel trong memory
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        # Sheet dữ liệu chính
-        df.to_excel(writer, sheet_name='Danh sách hóa đơn', index=False, startrow=4)
-        worksheet = writer.sheets['Danh sách hóa đơn']
-        
-        # Thêm tiêu đề và thông tin
-        now = datetime.now()
-        worksheet['A1'] = f'DANH SÁCH HÓA ĐƠN CHI TIẾT'
-        worksheet['A2'] = f'Khách sạn PTIT - Báo cáo hóa đơn'
-        worksheet['A3'] = f'Ngày xuất báo cáo: {now.strftime("%d/%m/%Y %H:%M:%S")}'
-        worksheet['A4'] = f'Tổng số hóa đơn: {len(ds_hoa_don)}'
-        
-        # Styling tiêu đề
-        title_font = Font(size=16, bold=True, color="2F7D5A")
-        subtitle_font = Font(size=12, italic=True, color="666666")
-        header_font = Font(bold=True, color="FFFFFF")
-        
-        worksheet['A1'].font = title_font
-        worksheet['A2'].font = subtitle_font
-        worksheet['A3'].font = Font(size=10, color="888888")
-        worksheet['A4'].font = Font(size=10, color="666666")
-        
-        # Merge cells cho tiêu đề
-        worksheet.merge_cells('A1:I1')
-        worksheet.merge_cells('A2:I2')
-        worksheet.merge_cells('A3:I3')
-        worksheet.merge_cells('A4:I4')
-        
-        # Căn chỉnh tiêu đề
-        worksheet['A1'].alignment = Alignment(horizontal='center')
-        worksheet['A2'].alignment = Alignment(horizontal='center')
-        worksheet['A3'].alignment = Alignment(horizontal='right')
-        worksheet['A4'].alignment = Alignment(horizontal='right')
-        
-        # Styling header của bảng
-        header_fill = PatternFill(start_color="2F7D5A", end_color="2F7D5A", fill_type="solid")
-        thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-        
-        for col_num in range(1, 10):  # A đến I
-            cell = worksheet.cell(row=5, column=col_num)
-            cell.font = header_font
-            cell.fill = header_fill
-            cell.border = thin_border
-            cell.alignment = Alignment(horizontal='center', vertical='center')
-        
-        # Styling dữ liệu
-        data_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-        currency_alignment = Alignment(horizontal='right')
-        center_alignment = Alignment(horizontal='center')
-        left_alignment = Alignment(horizontal='left')
-        
-        for row_num in range(6, len(df) + 6):  # Dữ liệu từ row 6
-            # Cột Mã HĐ (A) - căn giữa
-            worksheet.cell(row=row_num, column=1).alignment = center_alignment
-            worksheet.cell(row=row_num, column=1).border = data_border
-            
-            # Cột Khách hàng (B) - căn trái
-            worksheet.cell(row=row_num, column=2).alignment = left_alignment
-            worksheet.cell(row=row_num, column=2).border = data_border
-            
-            # Cột Phòng (C) - căn giữa
-            worksheet.cell(row=row_num, column=3).alignment = center_alignment
-            worksheet.cell(row=row_num, column=3).border = data_border
-            
-            # Cột Ngày hoàn tất (D) - căn giữa
-            worksheet.cell(row=row_num, column=4).alignment = center_alignment
-            worksheet.cell(row=row_num, column=4).border = data_border
-            
-            # Cột Trạng thái (E) - căn giữa
-            worksheet.cell(row=row_num, column=5).alignment = center_alignment
-            worksheet.cell(row=row_num, column=5).border = data_border
-            
-            # Các cột tiền tệ (F-I) - căn phải, format số
-            for col_num in range(6, 10):
-                cell = worksheet.cell(row=row_num, column=col_num)
-                cell.alignment = currency_alignment
-                cell.border = data_border
-                if cell.value and isinstance(cell.value, (int, float)) and cell.value > 0:
-                    cell.number_format = '#,##0'
-        
-        # Căn chỉnh tự động độ rộng cột
-        for col_num, column in enumerate(worksheet.columns, 1):
-            max_length = 0
-            column_letter = get_column_letter(col_num)
-            
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            
-            # Điều chỉnh độ rộng tối ưu
-            if col_num == 1:  # Mã HĐ
-                adjusted_width = max(max_length + 2, 8)
-            elif col_num == 2:  # Khách hàng
-                adjusted_width = max(max_length + 2, 25)
-            elif col_num == 3:  # Phòng
-                adjusted_width = max(max_length + 2, 10)
-            elif col_num == 4:  # Ngày
-                adjusted_width = max(max_length + 2, 18)
-            elif col_num == 5:  # Trạng thái
-                adjusted_width = max(max_length + 2, 15)
-            else:  # Các cột tiền
-                adjusted_width = max(max_length + 4, 18)
-            
-            worksheet.column_dimensions[column_letter].width = min(adjusted_width, 35)
-        
-        # Tạo sheet biểu đồ
-        chart_sheet = writer.book.create_sheet('Biểu đồ thống kê')
-        
-        # Biểu đồ tròn cho trạng thái hóa đơn
-        pie_chart = PieChart()
-        pie_chart.title = "Tỷ lệ trạng thái hóa đơn"
-        pie_chart.height = 10
-        pie_chart.width = 15
-        
-        # Dữ liệu cho biểu đồ tròn
-        pie_data = [
-            ['Trạng thái', 'Số lượng'],
-            ['Đã thanh toán', tong_da_thanh_toan],
-            ['Hủy (mất cọc)', tong_huy_mat_coc]
-        ]
-        
-        # Ghi dữ liệu cho biểu đồ
-        for row_num, row_data in enumerate(pie_data, 1):
-            for col_num, value in enumerate(row_data, 1):
-                chart_sheet.cell(row=row_num, column=col_num, value=value)
-        
-        pie_cats = Reference(chart_sheet, min_col=1, min_row=2, max_row=3)
-        pie_vals = Reference(chart_sheet, min_col=2, min_row=2, max_row=3)
-        pie_chart.add_data(pie_vals, titles_from_data=True)
-        pie_chart.set_categories(pie_cats)
-        pie_chart.style = 10
-        
-        chart_sheet.add_chart(pie_chart, "A1")
-        
-        # Biểu đồ cột cho phân loại doanh thu
-        bar_chart = BarChart()
-        bar_chart.title = "Phân loại doanh thu"
-        bar_chart.y_axis.title = 'Doanh thu (VNĐ)'
-        bar_chart.x_axis.title = 'Loại thu nhập'
-        bar_chart.height = 10
-        bar_chart.width = 15
-        
-        # Dữ liệu cho biểu đồ cột
-        bar_data = [
-            ['Loại thu nhập', 'Số tiền'],
-            ['Tiền phòng', tong_tien_phong],
-            ['Tiền dịch vụ', tong_tien_dv],
-            ['Phí phạt', tong_tien_phat]
-        ]
-        
-        # Ghi dữ liệu cho biểu đồ cột
-        for row_num, row_data in enumerate(bar_data, 1):
-            for col_num, value in enumerate(row_data, 1):
-                chart_sheet.cell(row=row_num, column=col_num+3, value=value)  # Bắt đầu từ cột E
-        
-        bar_cats = Reference(chart_sheet, min_col=5, min_row=2, max_row=4)
-        bar_vals = Reference(chart_sheet, min_col=6, min_row=2, max_row=4)
-        bar_chart.add_data(bar_vals, titles_from_data=True)
-        bar_chart.set_categories(bar_cats)
-        bar_chart.style = 11
-        
-        chart_sheet.add_chart(bar_chart, "H1")
-        
-        # Tạo sheet tóm tắt
-        summary_sheet = writer.book.create_sheet('Tóm tắt')
-        
-        # Thêm thông tin tóm tắt
-        summary_data = [
-            ['BÁO CÁO TÓM TẮT HÓA ĐƠN', ''],
-            [f'Ngày xuất báo cáo:', now.strftime('%d/%m/%Y %H:%M:%S')],
-            [f'Tổng số hóa đơn:', len(ds_hoa_don)],
-            ['', ''],
-            ['THỐNG KÊ TRẠNG THÁI', ''],
-            ['Đã thanh toán:', f'{tong_da_thanh_toan} hóa đơn'],
-            ['Hủy (mất cọc):', f'{tong_huy_mat_coc} hóa đơn'],
-            ['', ''],
-            ['THỐNG KÊ DOANH THU', ''],
-            ['Tiền phòng:', f"{tong_tien_phong:,} VNĐ"],
-            ['Tiền dịch vụ:', f"{tong_tien_dv:,} VNĐ"],
-            ['Phí phạt:', f"{tong_tien_phat:,} VNĐ"],
-            ['TỔNG DOANH THU:', f"{tong_doanh_thu:,} VNĐ"],
-        ]
-        
-        # Ghi dữ liệu tóm tắt
-        for row_num, row_data in enumerate(summary_data, 1):
-            for col_num, value in enumerate(row_data, 1):
-                cell = summary_sheet.cell(row=row_num, column=col_num, value=value)
-                if row_num in [1, 5, 9]:  # Header sections
-                    cell.font = Font(size=12, bold=True, color="2F7D5A")
-                elif row_num == 12:  # Tổng doanh thu
-                    cell.font = Font(size=12, bold=True, color="FF6B35")
-        
-        # Căn chỉnh cột trong sheet tóm tắt
-        summary_sheet.column_dimensions['A'].width = 25
-        summary_sheet.column_dimensions['B'].width = 30
-    
-    output.seek(0)
-    
-    # Tạo response với file Excel
-    filename = f"Danh sách hóa đơn_{now.strftime('%Y%m%d_%H%M%S')}.xlsx"
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name=filename
+def xuat_pdf_hoa_don():
+    """Tất cả hóa đơn trong khoảng ngày thanh toán thành một file ZIP, tạo dần và gửi dần."""
+    if not request.args.get('tu_ngay') or not request.args.get('den_ngay'):
+        flash('Chọn khoảng ngày thanh toán (từ ngày, đến ngày) trước khi xuất PDF hàng loạt.', 'warning')
+        return redirect(url_for('quan_li_hoa_don', **request.args))
+
+    # Đơn hủy mất cọc chỉ có phiếu cọc (in_hoa_don_coc), không có hóa đơn lưu trú để in
+    bookings = invoice_list_query(request.args).filter(DatPhong.trang_thai == 'da_thanh_toan').options(
+        joinedload(DatPhong.khachhang),
+        joinedload(DatPhong.phong).joinedload(Phong.loai),
+        joinedload(DatPhong.voucher),
+    ).order_by(DatPhong.thuc_te_tra, DatPhong.id).all()
+    if not bookings:
+        flash('Không có hóa đơn nào trong khoảng ngày đã chọn.', 'info')
+        return redirect(url_for('quan_li_hoa_don', **request.args))
+
+    services = defaultdict(list)
+    for row in SuDungDichVu.query.options(joinedload(SuDungDichVu.dichvu)).filter(
+        SuDungDichVu.datphong_id.in_([dp.id for dp in bookings]),
+        SuDungDichVu.trang_thai == 'da_thanh_toan',
+    ):
+        services[row.datphong_id].append(row)
+
+    try:
+        rendered = invoice_pdfs.render_many(bookings, services)
+    except RuntimeError as exc:
+        flash(str(exc), 'danger')
+        return redirect(url_for('quan_li_hoa_don', **request.args))
+    files = ((f"hoa_don_{dp.id}_{(dp.thuc_te_tra or dp.ngay_tra):%Y%m%d}.pdf", pdf) for dp, pdf in rendered)
+    filename = f"hoa_don_{request.args['tu_ngay']}_{request.args['den_ngay']}.zip"
+    return app.response_class(
+        stream_zip(files),
+        mimetype='application/zip',
+        headers={'Content-Disposition': f'attachment; filename={filename}'},
     )
 
-@app.route('/xuat-excel-khach-hang')
-@login_required
-@permission_required('customers.export')
-def xuat_excel_khach_hang():
-    from io import BytesIO
-    import pandas as pd
-    from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
-    from openpyxl.utils import get_column_letter
-    
-    # Lấy tất cả dữ liệu khách hàng
-    ds_khach = DatPhong.query.order_by(DatPhong.ngay_nhan.asc()).all()
-    
-    # Tạo dữ liệu cho Excel
-    data = []
-    for dp in ds_khach:
-        # Lấy danh sách dịch vụ sử dụng
-        dich_vu_su_dung = SuDungDichVu.query.filter_by(datphong_id=dp.id).all()
-        dich_vu_str = '; '.join([f"{sd.dichvu.ten} (SL: {sd.so_luong}, Thời gian: {sd.thoi_gian.strftime('%d/%m/%Y %H:%M') if sd.thoi_gian else ''})" for sd in dich_vu_su_dung]) if dich_vu_su_dung else 'Không sử dụng dịch vụ'
-        
-        trang_thai = 'Đã nhận' if dp.trang_thai == 'nhan' else ('Đã thanh toán' if dp.trang_thai == 'da_thanh_toan' else ('Hủy' if dp.trang_thai == 'huy' else 'Chưa nhận'))
-        
-        data.append({
-            'STT': len(data) + 1,
-            'Mã đặt phòng': dp.id,
-            'Họ tên': dp.khachhang.ho_ten if dp.khachhang else '',
-            'CMND': dp.khachhang.cmnd if dp.khachhang else '',
-            'SĐT': dp.khachhang.sdt if dp.khachhang else '',
-            'Email': dp.khachhang.email if dp.khachhang else '',
-            'Địa chỉ': dp.khachhang.dia_chi if dp.khachhang else '',
-            'Phòng': dp.phong.ten,
-            'Loại phòng': dp.phong.loai.ten if dp.phong.loai else '',
-            'Hình thức thuê': 'Theo ngày' if dp.hinh_thuc_thue == 'ngay' else 'Theo giờ',
-            'Ngày đặt nhận': dp.ngay_nhan.strftime('%d/%m/%Y %H:%M') if dp.ngay_nhan else '',
-            'Ngày đặt trả': dp.ngay_tra.strftime('%d/%m/%Y %H:%M') if dp.ngay_tra else '',
-            'Thực tế nhận': dp.thuc_te_nhan.strftime('%d/%m/%Y %H:%M') if dp.thuc_te_nhan else '',
-            'Thực tế trả': dp.thuc_te_tra.strftime('%d/%m/%Y %H:%M') if dp.thuc_te_tra else '',
-            'Số đêm': dp.so_dem,
-            'Trạng thái': trang_thai,
-            'Nhân viên check-in': dp.nhanvien.ten if dp.nhanvien else '',
-            'Tiền phòng (VNĐ)': dp.tien_phong,
-            'Tiền dịch vụ (VNĐ)': dp.tien_dv,
-            'Tiền phạt (VNĐ)': dp.tien_phat,
-            'Tiền cọc (VNĐ)': dp.tien_coc,
-            'Tổng thanh toán (VNĐ)': dp.tong_thanh_toan,
-            'Phương thức thanh toán': dp.phuong_thuc_thanh_toan or '',
-            'Phương thức cọc': dp.phuong_thuc_coc or '',
-            'Cọc đã thanh toán': 'Có' if dp.coc_da_thanh_toan else 'Không',
-            'Dịch vụ sử dụng': dich_vu_str,
-            'Thời gian tạo': dp.created_at.strftime('%d/%m/%Y %H:%M') if dp.created_at else ''
-        })
-    
-    # Tạo DataFrame
-    df = pd.DataFrame(data)
-    
-    # Tạo file Excel trong memory
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        # Sheet dữ liệu chính
-        df.to_excel(writer, sheet_name='Danh sách khách hàng', index=False, startrow=3)
-        worksheet = writer.sheets['Danh sách khách hàng']
-        
-        # Thêm tiêu đề
-        now = datetime.now()
-        worksheet['A1'] = f'DANH SÁCH KHÁCH HÀNG'
-        worksheet['A2'] = f'Khách sạn PTIT - Báo cáo khách hàng'
-        worksheet['A3'] = f'Ngày xuất báo cáo: {now.strftime("%d/%m/%Y %H:%M:%S")}'
-        
-        # Styling tiêu đề
-        title_font = Font(size=16, bold=True, color="2F7D5A")
-        subtitle_font = Font(size=12, italic=True, color="666666")
-        
-        worksheet['A1'].font = title_font
-        worksheet['A2'].font = subtitle_font
-        worksheet['A3'].font = Font(size=10, color="888888")
-        
-        # Merge cells
-        worksheet.merge_cells('A1:Y1')
-        worksheet.merge_cells('A2:Y2')
-        worksheet.merge_cells('A3:Y3')
-        
-        # Căn chỉnh
-        worksheet['A1'].alignment = Alignment(horizontal='center')
-        worksheet['A2'].alignment = Alignment(horizontal='center')
-        worksheet['A3'].alignment = Alignment(horizontal='right')
-        
-        # Header styling
-        header_fill = PatternFill(start_color="2F7D5A", end_color="2F7D5A", fill_type="solid")
-        header_font = Font(bold=True, color="FFFFFF")
-        for cell in worksheet[4]:
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal='center')
-        
-        # Border cho toàn bộ bảng
-        thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-        for row in worksheet.iter_rows(min_row=4, max_row=len(data)+4, min_col=1, max_col=len(df.columns)):
-            for cell in row:
-                cell.border = thin_border
-        
-        # Auto-adjust column widths
-        for col_num, column in enumerate(worksheet.columns, 1):
-            max_length = 0
-            column_letter = get_column_letter(col_num)
-            
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            
-            adjusted_width = max(max_length + 2, 10)
-            worksheet.column_dimensions[column_letter].width = min(adjusted_width, 50)
-    
-    output.seek(0)
-    
-    # Tạo response với file Excel
-    filename = f"Danh sách khách hàng_{now.strftime('%Y%m%d_%H%M%S')}.xlsx"
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name=filename
+EXPORT_BATCH_SIZE = 1000
+
+
+def stream_query(query, batch_size=EXPORT_BATCH_SIZE):
+    """Iterate ``query`` through a server-side cursor, ``batch_size`` rows at a time.
+
+    The connection is busy until the iteration ends, so rows must not trigger
+    lazy loads: eager-load their many-to-one relationships with joinedload.
+    """
+    return query.yield_per(batch_size)
+
+
+def xlsx_response(book, filename):
+    """Chunked download of a StreamingWorkbook; the workbook is saved while the response is sent."""
+    ascii_name = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+    return app.response_class(
+        book.iter_bytes(),
+        mimetype=XLSX_MIMETYPE,
+        headers={'Content-Disposition': f"attachment; filename=\"{ascii_name}\"; filename*=UTF-8''{quote(filename)}"},
+    )
+
+
+def _excel_dt(value, fmt='%d/%m/%Y %H:%M'):
+    return value.strftime(fmt) if value else ''
+
+
+@app.route('/xuat-excel-hoa-don')
+@login_required
+@permission_required('payments.export')
+def xuat_excel_hoa_don():
+    from openpyxl.chart import PieChart, BarChart, Reference
+
+    # Lấy dữ liệu giống như quan_li_hoa_don
+    query = invoice_list_query(request.args)
+
+    # Số liệu tóm tắt/biểu đồ tính bằng một câu GROUP BY, không cần giữ các dòng
+    totals = defaultdict(int)
+    for trang_thai, so_hd, tien_phong, tien_dv, tien_phat, tong in query.order_by(None).with_entities(
+        DatPhong.trang_thai,
+        func.count(DatPhong.id),
+        func.coalesce(func.sum(DatPhong.tien_phong), 0),
+        func.coalesce(func.sum(DatPhong.tien_dv), 0),
+        func.coalesce(func.sum(DatPhong.tien_phat), 0),
+        func.coalesce(func.sum(DatPhong.tong_thanh_toan), 0),
+    ).group_by(DatPhong.trang_thai):
+        totals[trang_thai] += so_hd
+        totals['so_hoa_don'] += so_hd
+        totals['tien_phong'] += int(tien_phong)
+        totals['tien_dv'] += int(tien_dv)
+        totals['tien_phat'] += int(tien_phat)
+        totals['tong'] += int(tong)
+
+    rows = (
+        (
+            d.id,
+            f"{d.khachhang.ho_ten} ({d.khachhang.cmnd})",
+            d.phong.ten,
+            _excel_dt(d.thuc_te_tra),
+            'Đã thanh toán' if d.trang_thai == 'da_thanh_toan' else 'Hủy (mất cọc)',
+            d.tien_phong,
+            d.tien_dv,
+            d.tien_phat,
+            d.tong_thanh_toan,
+        )
+        for d in stream_query(
+            query.options(joinedload(DatPhong.khachhang), joinedload(DatPhong.phong))
+            .order_by(DatPhong.thuc_te_tra.desc(), DatPhong.id.desc())
+        )
+    )
+
+    now = datetime.now()
+    book = StreamingWorkbook()
+    book.add_table(
+        'Danh sách hóa đơn',
+        [
+            'DANH SÁCH HÓA ĐƠN CHI TIẾT',
+            'Khách sạn PTIT - Báo cáo hóa đơn',
+            f'Ngày xuất báo cáo: {now.strftime("%d/%m/%Y %H:%M:%S")}',
+            f'Tổng số hóa đơn: {totals["so_hoa_don"]}',
+        ],
+        [
+            ExcelColumn('Mã HĐ', 10, 'center'),
+            ExcelColumn('Khách hàng', 35),
+            ExcelColumn('Phòng', 12, 'center'),
+            ExcelColumn('Ngày hoàn tất', 18, 'center'),
+            ExcelColumn('Trạng thái', 16, 'center'),
+            ExcelColumn('Tiền phòng (VNĐ)', 20, 'money'),
+            ExcelColumn('Tiền dịch vụ (VNĐ)', 20, 'money'),
+            ExcelColumn('Phí phạt (VNĐ)', 18, 'money'),
+            ExcelColumn('Tổng cộng (VNĐ)', 20, 'money'),
+        ],
+        rows,
+    )
+
+    # Sheet biểu đồ: dữ liệu nguồn ở A1:B3 (trạng thái) và D1:E4 (loại thu nhập)
+    chart_sheet = book.add_sheet('Biểu đồ thống kê')
+    chart_rows = [
+        ['Trạng thái', 'Số lượng', None, 'Loại thu nhập', 'Số tiền'],
+        ['Đã thanh toán', totals['da_thanh_toan'], None, 'Tiền phòng', totals['tien_phong']],
+        ['Hủy (mất cọc)', totals['huy'], None, 'Tiền dịch vụ', totals['tien_dv']],
+        [None, None, None, 'Phí phạt', totals['tien_phat']],
+    ]
+    for row in chart_rows:
+        chart_sheet.append(row)
+
+    pie_chart = PieChart()
+    pie_chart.title = "Tỷ lệ trạng thái hóa đơn"
+    pie_chart.height = 10
+    pie_chart.width = 15
+    pie_chart.add_data(Reference(chart_sheet, min_col=2, min_row=2, max_row=3), titles_from_data=True)
+    pie_chart.set_categories(Reference(chart_sheet, min_col=1, min_row=2, max_row=3))
+    pie_chart.style = 10
+    chart_sheet.add_chart(pie_chart, "A6")
+
+    bar_chart = BarChart()
+    bar_chart.title = "Phân loại doanh thu"
+    bar_chart.y_axis.title = 'Doanh thu (VNĐ)'
+    bar_chart.x_axis.title = 'Loại thu nhập'
+    bar_chart.height = 10
+    bar_chart.width = 15
+    bar_chart.add_data(Reference(chart_sheet, min_col=5, min_row=2, max_row=4), titles_from_data=True)
+    bar_chart.set_categories(Reference(chart_sheet, min_col=4, min_row=2, max_row=4))
+    bar_chart.style = 11
+    chart_sheet.add_chart(bar_chart, "H6")
+
+    book.add_key_values('Tóm tắt', [
+        ('BÁO CÁO TÓM TẮT HÓA ĐƠN', '', 'section'),
+        ('Ngày xuất báo cáo:', now.strftime('%d/%m/%Y %H:%M:%S')),
+        ('Tổng số hóa đơn:', totals['so_hoa_don']),
+        ('', ''),
+        ('THỐNG KÊ TRẠNG THÁI', '', 'section'),
+        ('Đã thanh toán:', f"{totals['da_thanh_toan']} hóa đơn"),
+        ('Hủy (mất cọc):', f"{totals['huy']} hóa đơn"),
+        ('', ''),
+        ('THỐNG KÊ DOANH THU', '', 'section'),
+        ('Tiền phòng:', f"{totals['tien_phong']:,} VNĐ"),
+        ('Tiền dịch vụ:', f"{totals['tien_dv']:,} VNĐ"),
+        ('Phí phạt:', f"{totals['tien_phat']:,} VNĐ"),
+        ('TỔNG DOANH THU:', f"{totals['tong']:,} VNĐ", 'highlight'),
+    ])
+
+    return xlsx_response(book, f"Danh sách hóa đơn_{now.strftime('%Y%m%d_%H%M%S')}.xlsx")
+
+CUSTOMER_EXPORT_COLUMNS = [
+    ExcelColumn('STT', 8, 'center'),
+    ExcelColumn('Mã đặt phòng', 14, 'center'),
+    ExcelColumn('Họ tên', 25),
+    ExcelColumn('CMND', 16),
+    ExcelColumn('SĐT', 14),
+    ExcelColumn('Email', 28),
+    ExcelColumn('Địa chỉ', 35),
+    ExcelColumn('Phòng', 10, 'center'),
+    ExcelColumn('Loại phòng', 14),
+    ExcelColumn('Hình thức thuê', 15),
+    ExcelColumn('Ngày đặt nhận', 18, 'center'),
+    ExcelColumn('Ngày đặt trả', 18, 'center'),
+    ExcelColumn('Thực tế nhận', 18, 'center'),
+    ExcelColumn('Thực tế trả', 18, 'center'),
+    ExcelColumn('Số đêm', 10, 'integer'),
+    ExcelColumn('Trạng thái', 15, 'center'),
+    ExcelColumn('Nhân viên check-in', 20),
+    ExcelColumn('Tiền phòng (VNĐ)', 18, 'money'),
+    ExcelColumn('Tiền dịch vụ (VNĐ)', 18, 'money'),
+    ExcelColumn('Tiền phạt (VNĐ)', 18, 'money'),
+    ExcelColumn('Tiền cọc (VNĐ)', 18, 'money'),
+    ExcelColumn('Tổng thanh toán (VNĐ)', 20, 'money'),
+    ExcelColumn('Phương thức thanh toán', 20),
+    ExcelColumn('Phương thức cọc', 16),
+    ExcelColumn('Cọc đã thanh toán', 16, 'center'),
+    ExcelColumn('Dịch vụ sử dụng', 50),
+    ExcelColumn('Thời gian tạo', 18, 'center'),
+]
+
+
+def iter_bookings_with_services(limit=None):
+    """Yield ``(booking, services)`` ordered by (ngay_nhan, id) using two queries in total.
+
+    Bookings come with their customer, room, room type and staff member from
+    one joined query on a server-side cursor. Their service rows (DichVu name
+    included) stream in the same order on a second connection and are merged
+    in, so the query count does not grow with the number of bookings.
+    """
+    order = (DatPhong.ngay_nhan, DatPhong.id)
+    booking_query = DatPhong.query.options(
+        joinedload(DatPhong.khachhang),
+        joinedload(DatPhong.phong).joinedload(Phong.loai),
+        joinedload(DatPhong.nhanvien),
+    ).order_by(*order)
+    bookings = DatPhong.__table__
+    if limit is not None:
+        booking_query = booking_query.limit(limit)
+        bookings = db.select(DatPhong.id, DatPhong.ngay_nhan).order_by(*order).limit(limit).subquery()
+    service_stmt = (
+        db.select(
+            bookings.c.ngay_nhan.label('booking_ngay_nhan'),
+            bookings.c.id.label('booking_id'),
+            DichVu.ten,
+            SuDungDichVu.so_luong,
+            SuDungDichVu.thoi_gian,
+        )
+        .select_from(SuDungDichVu)
+        .join(bookings, bookings.c.id == SuDungDichVu.datphong_id)
+        .join(DichVu, DichVu.id == SuDungDichVu.dichvu_id)
+        .order_by(bookings.c.ngay_nhan, bookings.c.id, SuDungDichVu.id)
+    )
+    # Cursor của session đang bận với danh sách booking nên dịch vụ đi kết nối riêng
+    with db.engine.connect() as connection:
+        services = iter(connection.execution_options(
+            stream_results=True, max_row_buffer=EXPORT_BATCH_SIZE
+        ).execute(service_stmt))
+        pending = next(services, None)
+        for dp in stream_query(booking_query):
+            key = (dp.ngay_nhan, dp.id)
+            rows = []
+            # Bỏ qua dịch vụ của booking không còn trong danh sách (thêm/xóa giữa hai câu truy vấn)
+            while pending is not None and (pending.booking_ngay_nhan, pending.booking_id) <= key:
+                if pending.booking_id == dp.id:
+                    rows.append(pending)
+                pending = next(services, None)
+            yield dp, rows
+
+
+def customer_export_row(stt, dp, dich_vu_su_dung):
+    """One row of the customer export; ``dich_vu_su_dung`` rows have ten, so_luong and thoi_gian."""
+    dich_vu_str = '; '.join([f"{sd.ten} (SL: {sd.so_luong}, Thời gian: {sd.thoi_gian.strftime('%d/%m/%Y %H:%M') if sd.thoi_gian else ''})" for sd in dich_vu_su_dung]) if dich_vu_su_dung else 'Không sử dụng dịch vụ'
+    trang_thai = 'Đã nhận' if dp.trang_thai == 'nhan' else ('Đã thanh toán' if dp.trang_thai == 'da_thanh_toan' else ('Hủy' if dp.trang_thai == 'huy' else 'Chưa nhận'))
+    kh = dp.khachhang
+    return (
+        stt,
+        dp.id,
+        kh.ho_ten if kh else '',
+        kh.cmnd if kh else '',
+        kh.sdt if kh else '',
+        kh.email if kh else '',
+        kh.dia_chi if kh else '',
+        dp.phong.ten,
+        dp.phong.loai.ten if dp.phong.loai else '',
+        'Theo ngày' if dp.hinh_thuc_thue == 'ngay' else 'Theo giờ',
+        _excel_dt(dp.ngay_nhan),
+        _excel_dt(dp.ngay_tra),
+        _excel_dt(dp.thuc_te_nhan),
+        _excel_dt(dp.thuc_te_tra),
+        dp.so_dem,
+        trang_thai,
+        dp.nhanvien.ten if dp.nhanvien else '',
+        dp.tien_phong,
+        dp.tien_dv,
+        dp.tien_phat,
+        dp.tien_coc,
+        dp.tong_thanh_toan,
+        dp.phuong_thuc_thanh_toan or '',
+        dp.phuong_thuc_coc or '',
+        'Có' if dp.coc_da_thanh_toan else 'Không',
+        dich_vu_str,
+        _excel_dt(dp.created_at),
+    )
+
+
+@app.route('/xuat-excel-khach-hang')
+@login_required
+@permission_required('customers.export')
+def xuat_excel_khach_hang():
+    rows = (
+        customer_export_row(stt, dp, services)
+        for stt, (dp, services) in enumerate(iter_bookings_with_services(), 1)
     )
 
+    now = datetime.now()
+    book = StreamingWorkbook()
+    book.add_table(
+        'Danh sách khách hàng',
+        [
+            'DANH SÁCH KHÁCH HÀNG',
+            'Khách sạn PTIT - Báo cáo khách hàng',
+            f'Ngày xuất báo cáo: {now.strftime("%d/%m/%Y %H:%M:%S")}',
+        ],
+        CUSTOMER_EXPORT_COLUMNS,
+        rows,
+    )
+    return xlsx_response(book, f"Danh sách khách hàng_{now.strftime('%Y%m%d_%H%M%S')}.xlsx")
+
 @app.route('/xuat-excel-lich-su-email')
 @login_required
 @permission_required('email.logs')
 def xuat_excel_lich_su_email():
-    from io import BytesIO
-    import pandas as pd
-    from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
-    from openpyxl.utils import get_column_letter
-    
     # Lấy dữ liệu lịch sử email với filter
     status_filter = request.args.get('status', '')
-    query = EmailLog.query
-    
+    query = EmailLog.query.options(joinedload(EmailLog.sender), joinedload(EmailLog.customer))
+
     if status_filter:
         query = query.filter_by(status=status_filter)
-    
-    # Lấy tất cả (không phân trang)
-    logs = query.order_by(EmailLog.sent_at.desc()).all()
-    
-    # Tạo dữ liệu cho Excel
-    data = []
-    for log in logs:
-        data.append({
-            'STT': len(data) + 1,
-            'ID': log.id,
-            'Email người nhận': log.recipient_email,
-            'Tên người nhận': log.recipient_name or '',
-            'Mẫu email': log.template_key or '',
-            'Tiêu đề': log.subject,
-            'Trạng thái': 'Thành công' if log.status == 'success' else ('Thất bại' if log.status == 'failed' else 'Đang chờ'),
-            'Lỗi': log.error_message or '',
-            'Thời gian gửi': log.sent_at.strftime('%d/%m/%Y %H:%M:%S') if log.sent_at else '',
-            'Người gửi': log.sender.ten if log.sender else '',
-            'Mã đặt phòng': log.datphong_id or '',
-            'Tên khách hàng': log.customer.ho_ten if log.customer else '',
-            'CMND khách hàng': log.customer.cmnd if log.customer else ''
-        })
-    
-    # Tạo DataFrame
-    df = pd.DataFrame(data)
-    
-    # Tạo file Excel trong memory
-    output = BytesIO()
-    with pd.ExcelWriter(output, engine='openpyxl') as writer:
-        # Sheet dữ liệu chính
-        df.to_excel(writer, sheet_name='Lịch sử email', index=False, startrow=3)
-        worksheet = writer.sheets['Lịch sử email']
-        
-        # Thêm tiêu đề
-        now = datetime.now()
-        worksheet['A1'] = f'LỊCH SỬ GỬI EMAIL'
-        worksheet['A2'] = f'Khách sạn PTIT - Báo cáo lịch sử email'
-        worksheet['A3'] = f'Ngày xuất báo cáo: {now.strftime("%d/%m/%Y %H:%M:%S")}'
-        
-        # Styling tiêu đề
-        title_font = Font(size=16, bold=True, color="2F7D5A")
-        subtitle_font = Font(size=12, italic=True, color="666666")
-        
-        worksheet['A1'].font = title_font
-        worksheet['A2'].font = subtitle_font
-        worksheet['A3'].font = Font(size=10, color="888888")
-        
-        # Merge cells
-        worksheet.merge_cells('A1:L1')
-        worksheet.merge_cells('A2:L2')
-        worksheet.merge_cells('A3:L3')
-        
-        # Căn chỉnh
-        worksheet['A1'].alignment = Alignment(horizontal='center')
-        worksheet['A2'].alignment = Alignment(horizontal='center')
-        worksheet['A3'].alignment = Alignment(horizontal='right')
-        
-        # Header styling
-        header_fill = PatternFill(start_color="2F7D5A", end_color="2F7D5A", fill_type="solid")
-        header_font = Font(bold=True, color="FFFFFF")
-        for cell in worksheet[4]:
-            cell.fill = header_fill
-            cell.font = header_font
-            cell.alignment = Alignment(horizontal='center')
-        
-        # Border cho toàn bộ bảng
-        thin_border = Border(left=Side(style='thin'), right=Side(style='thin'), top=Side(style='thin'), bottom=Side(style='thin'))
-        for row in worksheet.iter_rows(min_row=4, max_row=len(data)+4, min_col=1, max_col=len(df.columns)):
-            for cell in row:
-                cell.border = thin_border
-        
-        # Auto-adjust column widths
-        for col_num, column in enumerate(worksheet.columns, 1):
-            max_length = 0
-            column_letter = get_column_letter(col_num)
-            
-            for cell in column:
-                try:
-                    if len(str(cell.value)) > max_length:
-                        max_length = len(str(cell.value))
-                except:
-                    pass
-            
-            adjusted_width = max(max_length + 2, 10)
-            worksheet.column_dimensions[column_letter].width = min(adjusted_width, 50)
-    
-    output.seek(0)
-    
-    # Tạo response với file Excel
-    filename = f"lich_su_email_{now.strftime('%Y%m%d_%H%M%S')}.xlsx"
-    return send_file(
-        output,
-        mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
-        as_attachment=True,
-        download_name=filename
+
+    # Lấy tất cả (không phân trang), đọc dần qua server-side cursor
+    rows = (
+        (
+            stt,
+            log.id,
+            log.recipient_email,
+            log.recipient_name or '',
+            log.template_key or '',
+            log.subject,
+            'Thành công' if log.status == 'success' else ('Thất bại' if log.status == 'failed' else 'Đang chờ'),
+            log.error_message or '',
+            _excel_dt(log.sent_at, '%d/%m/%Y %H:%M:%S'),
+            log.sender.ten if log.sender else '',
+            log.datphong_id or '',
+            log.customer.ho_ten if log.customer else '',
+            log.customer.cmnd if log.customer else '',
+        )
+        for stt, log in enumerate(stream_query(query.order_by(EmailLog.sent_at.desc(), EmailLog.id.desc())), 1)
+    )
+
+    now = datetime.now()
+    book = StreamingWorkbook()
+    book.add_table(
+        'Lịch sử email',
+        [
+            'LỊCH SỬ GỬI EMAIL',
+            'Khách sạn PTIT - Báo cáo lịch sử email',
+            f'Ngày xuất báo cáo: {now.strftime("%d/%m/%Y %H:%M:%S")}',
+        ],
+        [
+            ExcelColumn('STT', 8, 'center'),
+            ExcelColumn('ID', 8, 'center'),
+            ExcelColumn('Email người nhận', 30),
+            ExcelColumn('Tên người nhận', 22),
+            ExcelColumn('Mẫu email', 22),
+            ExcelColumn('Tiêu đề', 45),
+            ExcelColumn('Trạng thái', 14, 'center'),
+            ExcelColumn('Lỗi', 40),
+            ExcelColumn('Thời gian gửi', 20, 'center'),
+            ExcelColumn('Người gửi', 20),
+            ExcelColumn('Mã đặt phòng', 14, 'center'),
+            ExcelColumn('Tên khách hàng', 25),
+            ExcelColumn('CMND khách hàng', 18),
+        ],
+        rows,
     )
+    return xlsx_response(book, f"lich_su_email_{now.strftime('%Y%m%d_%H%M%S')}.xlsx")
 
 @app.route('/quan-li-dich-vu', methods=['GET', 'POST'])
 @login_required
@@ -8872,20 +10353,21 @@ def xoa_phong(phong_id):
 @login_required
 @permission_required('analytics.revenue')
 def xuat_bao_cao_doanh_thu(nam):
+    import pandas as pd
     from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
     from openpyxl.chart import BarChart, Reference, Series
     from openpyxl.drawing.image import Image
     from openpyxl.utils import get_column_letter
     
     query = db.session.query(
-        extract('month', DatPhong.thuc_te_tra).label('thang'),
-        func.sum(DatPhong.tien_phong).label('tien_phong'),
-        func.sum(DatPhong.tien_dv).label('tien_dv'),
-        func.sum(DatPhong.tien_phat).label('tien_phat'),
-        func.sum(DatPhong.tong_thanh_toan).label('tong_thanh_toan')
+        extract('month', RevenueDaily.ngay).label('thang'),
+        func.sum(RevenueDaily.tien_phong).label('tien_phong'),
+        func.sum(RevenueDaily.tien_dv).label('tien_dv'),
+        func.sum(RevenueDaily.tien_phat).label('tien_phat'),
+        func.sum(RevenueDaily.tong_thanh_toan).label('tong_thanh_toan')
     ).filter(
-        DatPhong.trang_thai == 'da_thanh_toan',
-        extract('year', DatPhong.thuc_te_tra) == nam
+        RevenueDaily.trang_thai == 'da_thanh_toan',
+        *revenue_daily_range(date(nam, 1, 1), date(nam + 1, 1, 1))
     ).group_by('thang').order_by('thang')
     
     engine = db.session.get_bind()
@@ -9137,11 +10619,11 @@ def api_public_send_message():
     msg = persist_message(dp.id, 'khach', noi_dung)
     payload = serialize_message(msg)
 
-    socketio.emit('new_message_from_guest', {
+    emit_to_staff('new_message_from_guest', {
         'datphong_id': dp.id,
         'phong': dp.phong.ten,
         **payload
-    })
+    }, 'communications.chat')
     return jsonify({'status': 'success'})
 
 @app.route('/api/tin-nhan/gui', methods=['POST'])
@@ -9154,16 +10636,7 @@ def api_send_message():
     if not datphong_id or not noi_dung:
         return jsonify({'status': 'error', 'message': 'Thiếu thông tin'}), 400
 
-    msg = persist_message(datphong_id, 'nhanvien', noi_dung, user_id=current_user.id)
-    payload = serialize_message(msg)
-    
-    dp = DatPhong.query.get(datphong_id)
-    if dp and dp.chat_token:
-        socketio.emit('new_message_from_staff', {
-            **payload,
-            'nguoi_gui': 'staff'
-        }, to=dp.chat_token)
-
+    persist_message(datphong_id, 'nhanvien', noi_dung, user_id=current_user.id)
     return jsonify({'status': 'success'})
 
 
@@ -9185,11 +10658,11 @@ def api_public_send_file():
 
     msg = persist_message(dp.id, 'khach', payload)
     data = serialize_message(msg)
-    socketio.emit('new_message_from_guest', {
+    emit_to_staff('new_message_from_guest', {
         'datphong_id': dp.id,
         'phong': dp.phong.ten,
         **data
-    })
+    }, 'communications.chat')
     return jsonify({'status': 'success', 'message': data})
 
 
@@ -9213,13 +10686,6 @@ def api_send_file():
 
     msg = persist_message(dp.id, 'nhanvien', payload, user_id=current_user.id)
     data = serialize_message(msg)
-
-    if dp.chat_token:
-        socketio.emit('new_message_from_staff', {
-            **data,
-            'nguoi_gui': 'staff'
-        }, to=dp.chat_token)
-
     return jsonify({'status': 'success', 'message': data})
 
 @app.route('/api/public/tin-nhan/<token>')
@@ -9235,8 +10701,10 @@ def api_public_get_messages(token):
 @permission_required('communications.chat')
 def api_get_messages(datphong_id):
     messages = TinNhan.query.filter_by(datphong_id=datphong_id).order_by(TinNhan.thoi_gian.asc()).all()
-    TinNhan.query.filter_by(datphong_id=datphong_id, nguoi_gui='khach', trang_thai='chua_doc').update({'trang_thai': 'da_doc'})
+    marked = TinNhan.query.filter_by(datphong_id=datphong_id, nguoi_gui='khach', trang_thai='chua_doc').update({'trang_thai': 'da_doc'})
     db.session.commit()
+    if marked:
+        refresh_badge_counts()
 
     return jsonify([serialize_message(m) for m in messages])
 
@@ -9245,29 +10713,14 @@ def api_get_messages(datphong_id):
 @permission_required('bookings.manage_online')
 def api_pending_online_count():
     """API tra ve so dat phong online dang cho xac nhan."""
-    count = DatPhong.query.join(
-        TinNhan,
-        db.and_(
-            TinNhan.datphong_id == DatPhong.id,
-            TinNhan.nguoi_gui == 'khach',
-            TinNhan.noi_dung == ONLINE_DEPOSIT_REQUEST_MESSAGE
-        )
-    ).filter(
-        DatPhong.trang_thai == 'cho_xac_nhan'
-    ).distinct().count()
-    return jsonify({'count': count})
+    return jsonify({'count': get_badge_counts()['pending_online']})
 
 @app.route('/api/tin-nhan/dem-chua-doc')
 @login_required
 @permission_required('communications.chat')
 def api_dem_tin_nhan_chua_doc():
     """API để đếm số tin nhắn chưa đọc từ khách"""
-    unread_count = TinNhan.query.join(DatPhong).filter(
-        TinNhan.trang_thai == 'chua_doc',
-        TinNhan.nguoi_gui == 'khach',
-        DatPhong.trang_thai == 'nhan'
-    ).count()
-    return jsonify({'count': unread_count})
+    return jsonify({'count': get_badge_counts()['unread_messages']})
 
 
 @app.route('/api/public/dich-vu/menu/<token>')
@@ -9385,11 +10838,11 @@ def api_public_order_service():
         message_text += f" Ghi chú: {note}."
     msg = persist_message(dp.id, 'khach', message_text)
     payload = serialize_message(msg)
-    socketio.emit('new_message_from_guest', {
+    emit_to_staff('new_message_from_guest', {
         'datphong_id': dp.id,
         'phong': dp.phong.ten,
         **payload
-    })
+    }, 'communications.chat')
 
     description = quote(f"DV {dp.id} {dp.khachhang.ho_ten}")
     qr_code_url = (f"https://img.vietqr.io/image/{BANK_ID}-{BANK_ACCOUNT_NO}-compact2.png"
@@ -9432,20 +10885,20 @@ def api_public_request_confirmation(service_id):
         msg_text = f"🔔 Khách yêu cầu xác nhận thanh toán: {service.dichvu.ten} x{service.so_luong} = {vnd(service.dichvu.gia * service.so_luong)}"
         msg = persist_message(dp.id, 'he_thong', msg_text)
         payload = serialize_message(msg)
-        socketio.emit('new_message_from_guest', {
+        emit_to_staff('new_message_from_guest', {
             'datphong_id': dp.id,
             'phong': dp.phong.ten,
             **payload
-        })
+        }, 'communications.chat')
         
         # Gửi thông báo realtime cho khách hàng
         if dp.chat_token:
-            socketio.emit('order_status_updated', {
+            emit_to_booking('order_status_updated', {
                 'service_id': service.id,
                 'ten': service.dichvu.ten,
                 'trang_thai': 'cho_xac_nhan',
                 'message': f'Yêu cầu xác nhận "{service.dichvu.ten}" đã được gửi. Vui lòng chờ nhân viên kiểm tra.'
-            }, to=dp.chat_token)
+            }, dp.chat_token)
         
         return jsonify({
             'status': 'success',
@@ -9525,18 +10978,18 @@ def api_public_request_confirmation_multiple():
         msg_text = f"🔔 Khách yêu cầu xác nhận thanh toán: {items_text} = {vnd(total_amount)}"
         msg = persist_message(dp.id, 'he_thong', msg_text)
         payload = serialize_message(msg)
-        socketio.emit('new_message_from_guest', {
+        emit_to_staff('new_message_from_guest', {
             'datphong_id': dp.id,
             'phong': dp.phong.ten,
             **payload
-        })
+        }, 'communications.chat')
         
         # Gửi thông báo realtime cho khách hàng
         if dp.chat_token:
-            socketio.emit('order_status_updated', {
+            emit_to_booking('order_status_updated', {
                 'service_ids': [s.id for s in services_to_confirm],
                 'message': f'Yêu cầu xác nhận đơn hàng đã được gửi. Vui lòng chờ nhân viên kiểm tra.'
-            }, to=dp.chat_token)
+            }, dp.chat_token)
         
         return jsonify({
             'status': 'success',
@@ -9563,90 +11016,123 @@ def api_phong_theo_loai(loai_id):
 
 
 
-def compute_available_rooms(loai_id, ngay_nhan, ngay_tra):
-    """Return list of room availability dictionaries for the given range."""
-    # Lấy thời gian timeout từ cấu hình
-    timeout_setting = HeThongCauHinh.query.filter_by(key='payment_timeout_minutes').first()
-    timeout_minutes = int(timeout_setting.value) if timeout_setting and timeout_setting.value else 5
-    timeout_seconds = timeout_minutes * 60
-    
-    phongs = Phong.query.filter_by(loai_id=loai_id).all()
-    result = []
-    for p in phongs:
-        # First, get all overlapping bookings
-        overlaps = DatPhong.query.filter(
-            DatPhong.phong_id == p.id,
-            DatPhong.trang_thai.in_(BOOKING_BLOCKING_STATUSES),
-            ~db.or_(DatPhong.ngay_tra <= ngay_nhan, DatPhong.ngay_nhan >= ngay_tra)
-        ).all()
-        
-        # Filter out expired cho_xac_nhan bookings
-        valid_overlaps = []
-        for overlap in overlaps:
-            if overlap.trang_thai == 'cho_xac_nhan':
-                # Check if booking has active payment session or is within 5 minutes
-                is_valid = False
-                if overlap.payment_token:
-                    session = PaymentSession.query.filter_by(token=overlap.payment_token).first()
-                    if session and not payment_session_expired(session.created_at):
-                        is_valid = True
-                else:
-                    # No payment session yet, check if booking is within 5 minutes
-                    if not payment_session_expired(overlap.created_at):
-                        is_valid = True
-                
-                if is_valid:
-                    valid_overlaps.append(overlap)
-                else:
-                    # Mark expired cho_xac_nhan as cancelled
-                    overlap.trang_thai = 'huy'
-                    db.session.commit()
+class RoomAvailabilityIndex:
+    """In-memory interval index of blocking bookings, one sorted list per room.
+
+    Everything is loaded up front with a fixed number of set-based queries
+    (rooms, overlapping bookings, payment sessions of pending holds), so
+    overlap checks for any range inside the loaded window cost no round trip.
+    """
+
+    def __init__(self, rooms, bookings, session_started, ttl, now):
+        self.now = now
+        self.ttl = ttl
+        self.rooms_by_type = defaultdict(list)
+        for room in rooms:
+            self.rooms_by_type[room.loai_id].append(room)
+        # Lapsed holds no longer block the room; cancelling them is left to
+        # expire_lapsed_holds, so building the index never writes.
+        self._intervals = defaultdict(list)
+        for booking in bookings:
+            remaining = None
+            if booking.trang_thai == 'cho_xac_nhan':
+                remaining = hold_remaining_seconds(booking, session_started, ttl, now)
+                if remaining is None:
+                    continue
+            self._intervals[booking.phong_id].append((booking, remaining))
+        # Bookings arrive sorted by ngay_nhan; keep the starts and the running
+        # maximum of ends so both sides of the overlap test are a bisect.
+        self._starts = {}
+        self._max_ends = {}
+        for phong_id, intervals in self._intervals.items():
+            starts, max_ends = [], []
+            running = None
+            for booking, _ in intervals:
+                starts.append(booking.ngay_nhan)
+                running = booking.ngay_tra if running is None else max(running, booking.ngay_tra)
+                max_ends.append(running)
+            self._starts[phong_id] = starts
+            self._max_ends[phong_id] = max_ends
+
+    @classmethod
+    def load(cls, loai_ids, window_start, window_end, now=None):
+        now = now or datetime.now()
+        ttl = get_payment_session_ttl()
+        loai_ids = list(loai_ids)
+        rooms = Phong.query.filter(Phong.loai_id.in_(loai_ids)).order_by(Phong.id).all() if loai_ids else []
+        bookings = []
+        if rooms:
+            bookings = (
+                db.session.query(
+                    DatPhong.id,
+                    DatPhong.phong_id,
+                    DatPhong.ngay_nhan,
+                    DatPhong.ngay_tra,
+                    DatPhong.trang_thai,
+                    DatPhong.payment_token,
+                    DatPhong.created_at,
+                )
+                .join(Phong, DatPhong.phong_id == Phong.id)
+                .filter(
+                    Phong.loai_id.in_(loai_ids),
+                    DatPhong.trang_thai.in_(BOOKING_BLOCKING_STATUSES),
+                    DatPhong.ngay_tra > window_start,
+                    DatPhong.ngay_nhan < window_end,
+                )
+                .order_by(DatPhong.phong_id, DatPhong.ngay_nhan, DatPhong.id)
+                .all()
+            )
+        return cls(rooms, bookings, load_hold_session_starts(bookings), ttl, now)
+
+    def first_overlap(self, phong_id, ngay_nhan, ngay_tra):
+        """Return ``(booking, hold_remaining_seconds)`` of the earliest overlap, or None."""
+        intervals = self._intervals.get(phong_id)
+        if not intervals:
+            return None
+        upper = bisect_left(self._starts[phong_id], ngay_tra)
+        first = bisect_right(self._max_ends[phong_id], ngay_nhan)
+        if first < upper:
+            return intervals[first]
+        return None
+
+    def rooms_for(self, loai_id, ngay_nhan, ngay_tra):
+        result = []
+        for p in self.rooms_by_type.get(loai_id, []):
+            hit = self.first_overlap(p.id, ngay_nhan, ngay_tra)
+            if hit is None:
+                is_available = True
+                reason = ''
+                status = 'trong'
             else:
-                valid_overlaps.append(overlap)
-        
-        overlap = valid_overlaps[0] if valid_overlaps else None
-        
-        if overlap:
-            if overlap.trang_thai == 'cho_xac_nhan':
-                # Phòng đang chờ thanh toán
+                overlap, remaining_time = hit
                 is_available = False
-                # Tính thời gian còn lại
-                remaining_time = None
-                if overlap.payment_token:
-                    session = PaymentSession.query.filter_by(token=overlap.payment_token).first()
-                    if session and not payment_session_expired(session.created_at):
-                        remaining_time = max(0, timeout_seconds - (datetime.now() - session.created_at).total_seconds())
-                        print(f"DEBUG: Payment session found, remaining_time: {remaining_time}")
-                else:
-                    # No payment session yet, check if booking is within timeout
-                    if not payment_session_expired(overlap.created_at):
-                        remaining_time = max(0, timeout_seconds - (datetime.now() - overlap.created_at).total_seconds())
-                
-                if remaining_time and remaining_time > 0:
-                    minutes = int(remaining_time // 60)
-                    seconds = int(remaining_time % 60)
-                    reason = f"Phòng đang chờ thanh toán ({minutes}:{seconds:02d} còn lại) từ {fmt_dt(overlap.ngay_nhan)} đến {fmt_dt(overlap.ngay_tra)}"
+                if overlap.trang_thai == 'cho_xac_nhan':
+                    # Phòng đang chờ thanh toán
+                    if remaining_time and remaining_time > 0:
+                        minutes = int(remaining_time // 60)
+                        seconds = int(remaining_time % 60)
+                        reason = f"Phòng đang chờ thanh toán ({minutes}:{seconds:02d} còn lại) từ {fmt_dt(overlap.ngay_nhan)} đến {fmt_dt(overlap.ngay_tra)}"
+                    else:
+                        reason = f"Phòng đang chờ thanh toán từ {fmt_dt(overlap.ngay_nhan)} đến {fmt_dt(overlap.ngay_tra)}"
+                    status = 'cho_thanh_toan'
                 else:
-                    reason = f"Phòng đang chờ thanh toán từ {fmt_dt(overlap.ngay_nhan)} đến {fmt_dt(overlap.ngay_tra)}"
-                status = 'cho_thanh_toan'
-            else:
-                # Phòng đã được đặt hoặc đang ở
-                is_available = False
-                reason = f"Phòng đã được giữ từ {fmt_dt(overlap.ngay_nhan)} đến {fmt_dt(overlap.ngay_tra)}"
-                status = 'da_dat'
-        else:
-            is_available = True
-            reason = ''
-            status = 'trong'
-            
-        result.append({
-            'id': p.id,
-            'ten': p.ten,
-            'trang_thai': status,  # Thay đổi: trả về trạng thái computed thay vì p.trang_thai
-            'available': is_available,
-            'reason': reason
-        })
-    return result
+                    # Phòng đã được đặt hoặc đang ở
+                    reason = f"Phòng đã được giữ từ {fmt_dt(overlap.ngay_nhan)} đến {fmt_dt(overlap.ngay_tra)}"
+                    status = 'da_dat'
+            result.append({
+                'id': p.id,
+                'ten': p.ten,
+                'trang_thai': status,  # trạng thái computed thay vì p.trang_thai
+                'available': is_available,
+                'reason': reason
+            })
+        return result
+
+
+def compute_available_rooms(loai_id, ngay_nhan, ngay_tra):
+    """Return list of room availability dictionaries for the given range."""
+    index = RoomAvailabilityIndex.load([loai_id], ngay_nhan, ngay_tra)
+    return index.rooms_for(loai_id, ngay_nhan, ngay_tra)
 
 @app.route('/api/phong-trong-theo-ngay', methods=['POST'])
 @login_required
@@ -9716,6 +11202,131 @@ def api_public_phong_trong():
         app.logger.exception('Lỗi API phong-trong công khai: %s', exc)
         return jsonify({'error': 'Lỗi máy chủ'}), 500
 
+AVAILABILITY_BATCH_MAX_QUERIES = 2000
+AVAILABILITY_GRID_MAX_NIGHTS = 62
+AVAILABILITY_GRID_CHECKIN = '14:00'
+AVAILABILITY_GRID_CHECKOUT = '12:00'
+
+
+def compute_availability_batch(queries):
+    """Answer many ``(loai_id, ngay_nhan, ngay_tra)`` lookups from one scan of datphong."""
+    if not queries:
+        return []
+    window_start = min(q[1] for q in queries)
+    window_end = max(q[2] for q in queries)
+    index = RoomAvailabilityIndex.load({q[0] for q in queries}, window_start, window_end)
+    results = []
+    for loai_id, ngay_nhan, ngay_tra in queries:
+        rooms = index.rooms_for(loai_id, ngay_nhan, ngay_tra)
+        results.append({
+            'loai_id': loai_id,
+            'ngay_nhan': ngay_nhan.isoformat(),
+            'ngay_tra': ngay_tra.isoformat(),
+            'so_phong_trong': sum(1 for r in rooms if r['available']),
+            'tong_phong': len(rooms),
+            'rooms': rooms,
+        })
+    return results
+
+
+def build_availability_grid_queries(tu_ngay, so_dem, loai_ids, gio_nhan=None, gio_tra=None):
+    """Expand "next N nights for these room types" into one lookup per (type, night)."""
+    gio_nhan = datetime.strptime(gio_nhan or AVAILABILITY_GRID_CHECKIN, '%H:%M').time()
+    gio_tra = datetime.strptime(gio_tra or AVAILABILITY_GRID_CHECKOUT, '%H:%M').time()
+    queries = []
+    for loai_id in loai_ids:
+        for offset in range(so_dem):
+            night = tu_ngay + timedelta(days=offset)
+            queries.append((
+                loai_id,
+                datetime.combine(night, gio_nhan),
+                datetime.combine(night + timedelta(days=1), gio_tra),
+            ))
+    return queries
+
+
+def _availability_batch_response(data):
+    """Shared body of the staff and public batch availability endpoints."""
+    grid = data.get('grid')
+    if grid:
+        tu_ngay = date.fromisoformat(grid.get('tu_ngay') or date.today().isoformat())
+        so_dem = int(grid.get('so_dem') or 30)
+        if so_dem < 1 or so_dem > AVAILABILITY_GRID_MAX_NIGHTS:
+            return jsonify({'error': f'Số đêm phải từ 1 đến {AVAILABILITY_GRID_MAX_NIGHTS}'}), 400
+        loai_ids = grid.get('loai_ids')
+        if loai_ids:
+            loai_ids = [int(x) for x in loai_ids]
+        else:
+            loai_ids = [row.id for row in db.session.query(LoaiPhong.id).order_by(LoaiPhong.id).all()]
+        queries = build_availability_grid_queries(
+            tu_ngay, so_dem, loai_ids, grid.get('gio_nhan'), grid.get('gio_tra')
+        )
+        if len(queries) > AVAILABILITY_BATCH_MAX_QUERIES:
+            return jsonify({'error': 'Lưới tra cứu quá lớn, vui lòng thu hẹp phạm vi'}), 400
+        results = compute_availability_batch(queries)
+        matrix = defaultdict(list)
+        for item in results:
+            matrix[item['loai_id']].append({
+                'ngay': item['ngay_nhan'][:10],
+                'so_phong_trong': item['so_phong_trong'],
+                'tong_phong': item['tong_phong'],
+                'phong_trong': [r['id'] for r in item['rooms'] if r['available']],
+            })
+        return jsonify({
+            'tu_ngay': tu_ngay.isoformat(),
+            'so_dem': so_dem,
+            'loai_phong': [{'loai_id': loai_id, 'ngay': matrix.get(loai_id, [])} for loai_id in loai_ids],
+        })
+
+    raw_queries = data.get('queries') or []
+    if not raw_queries:
+        return jsonify({'error': 'Thiếu danh sách tra cứu (queries) hoặc lưới ngày (grid)'}), 400
+    if len(raw_queries) > AVAILABILITY_BATCH_MAX_QUERIES:
+        return jsonify({'error': 'Quá nhiều yêu cầu tra cứu trong một lần'}), 400
+    queries = []
+    for item in raw_queries:
+        if isinstance(item, dict):
+            loai_id, ngay_nhan_str, ngay_tra_str = item.get('loai_id'), item.get('ngay_nhan'), item.get('ngay_tra')
+        else:
+            loai_id, ngay_nhan_str, ngay_tra_str = item
+        if not ngay_nhan_str or not ngay_tra_str:
+            return jsonify({'error': 'Thiếu thông tin ngày nhận hoặc ngày trả'}), 400
+        ngay_nhan = datetime.fromisoformat(ngay_nhan_str.replace('Z', '+00:00'))
+        ngay_tra = datetime.fromisoformat(ngay_tra_str.replace('Z', '+00:00'))
+        if ngay_tra <= ngay_nhan:
+            return jsonify({'error': 'Ngày trả phải sau ngày nhận'}), 400
+        queries.append((int(loai_id), ngay_nhan, ngay_tra))
+    return jsonify({'ket_qua': compute_availability_batch(queries)})
+
+
+@app.route('/api/phong-trong-hang-loat', methods=['POST'])
+@login_required
+def api_phong_trong_hang_loat():
+    """
+    API kiểm tra phòng trống cho nhiều loại phòng / nhiều khoảng thời gian trong một lần gọi
+    Input: {queries: [{loai_id, ngay_nhan, ngay_tra}, ...]}
+           hoặc {grid: {tu_ngay: 'YYYY-MM-DD', so_dem: 30, loai_ids: [..], gio_nhan: 'HH:MM', gio_tra: 'HH:MM'}}
+    Output: Ma trận phòng trống, tính từ một lần quét bảng datphong
+    """
+    try:
+        return _availability_batch_response(request.get_json(silent=True) or {})
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': f'Định dạng dữ liệu không hợp lệ: {str(e)}'}), 400
+    except Exception as e:
+        return jsonify({'error': f'Lỗi server: {str(e)}'}), 500
+
+
+@app.route('/api/public/phong-trong-hang-loat', methods=['POST'])
+def api_public_phong_trong_hang_loat():
+    """Public batch availability API for the online booking page."""
+    try:
+        return _availability_batch_response(request.get_json(silent=True) or {})
+    except (TypeError, ValueError) as exc:
+        return jsonify({'error': f'Định dạng dữ liệu không hợp lệ: {exc}'}), 400
+    except Exception as exc:
+        app.logger.exception('Lỗi API phong-trong-hang-loat công khai: %s', exc)
+        return jsonify({'error': 'Lỗi máy chủ'}), 500
+
 @app.route('/api/public/validate-voucher', methods=['POST'])
 def api_public_validate_voucher():
     """API public để validate mã voucher cho đặt phòng online (không cần đăng nhập)."""
@@ -9777,16 +11388,28 @@ def api_confirm_service_payment(service_id):
         
         # Cập nhật trạng thái thành ĐÃ THANH TOÁN (xác nhận cuối cùng)
         service.trang_thai = 'da_thanh_toan'
+        completed_tokens = []
+        remaining = SuDungDichVu.query.filter(
+            SuDungDichVu.datphong_id == service.datphong_id,
+            SuDungDichVu.trang_thai.in_(['chua_thanh_toan', 'cho_xac_nhan'])
+        ).count()
+        if remaining == 0:
+            # Trang QR của khách đang chờ phải chuyển sang hóa đơn thay vì hết hạn
+            completed_tokens = complete_payment_sessions(
+                'service', service.datphong_id, lambda token: url_for('in_hoa_don_dv', token=token)
+            )
         db.session.commit()
+        for token in completed_tokens:
+            push_payment_status(token)
         
         # Gửi thông báo qua Socket.IO cho khách hàng
         dp = service.datphong
         if dp and dp.chat_token:
-            socketio.emit('payment_confirmed', {
+            emit_to_booking('payment_confirmed', {
                 'service_id': service.id,
                 'ten': service.dichvu.ten,
                 'message': f'Đã xác nhận thanh toán cho dịch vụ "{service.dichvu.ten}"'
-            }, to=dp.chat_token)
+            }, dp.chat_token)
         
         return jsonify({
             'status': 'success',
@@ -9842,20 +11465,20 @@ def api_cancel_payment_request(service_id):
             msg_text = f"❌ Nhân viên đã hủy yêu cầu xác nhận thanh toán: {service.dichvu.ten}. Vui lòng thanh toán lại hoặc liên hệ nhân viên."
             msg = persist_message(dp.id, 'he_thong', msg_text)
             payload = serialize_message(msg)
-            socketio.emit('new_message_from_guest', {
+            emit_to_staff('new_message_from_guest', {
                 'datphong_id': dp.id,
                 'phong': dp.phong.ten,
                 **payload
-            })
+            }, 'communications.chat')
             
             # Gửi thông báo realtime cho khách hàng
             if dp.chat_token:
-                socketio.emit('order_status_updated', {
+                emit_to_booking('order_status_updated', {
                     'service_id': service.id,
                     'ten': service.dichvu.ten,
                     'trang_thai': 'chua_thanh_toan',
                     'message': f'Yêu cầu xác nhận "{service.dichvu.ten}" đã bị hủy. Vui lòng thanh toán lại.'
-                }, to=dp.chat_token)
+                }, dp.chat_token)
         
         return jsonify({
             'status': 'success',
@@ -9924,19 +11547,19 @@ def api_cancel_payment_request_multiple():
             msg_text = f"❌ Nhân viên đã hủy yêu cầu xác nhận thanh toán: {items_text}. Vui lòng thanh toán lại hoặc liên hệ nhân viên."
             msg = persist_message(dp.id, 'he_thong', msg_text)
             payload = serialize_message(msg)
-            socketio.emit('new_message_from_guest', {
+            emit_to_staff('new_message_from_guest', {
                 'datphong_id': dp.id,
                 'phong': dp.phong.ten,
                 **payload
-            })
+            }, 'communications.chat')
             
             # Gửi thông báo realtime cho khách hàng
             if dp.chat_token:
-                socketio.emit('order_status_updated', {
+                emit_to_booking('order_status_updated', {
                     'service_ids': [s.id for s in services_to_cancel],
                     'trang_thai': 'chua_thanh_toan',
                     'message': f'Yêu cầu xác nhận đơn hàng đã bị hủy. Vui lòng thanh toán lại.'
-                }, to=dp.chat_token)
+                }, dp.chat_token)
         
         return jsonify({
             'status': 'success',
@@ -10061,17 +11684,17 @@ def api_public_cancel_order():
             msg_text = f"🚫 Khách đã hủy đơn hàng: {items_text}"
             msg = persist_message(dp.id, 'he_thong', msg_text)
             payload = serialize_message(msg)
-            socketio.emit('new_message_from_guest', {
+            emit_to_staff('new_message_from_guest', {
                 'datphong_id': dp.id,
                 'phong': dp.phong.ten,
                 **payload
-            })
+            }, 'communications.chat')
             
             # Thông báo cho staff reload orders
-            socketio.emit('order_cancelled', {
+            emit_to_staff('order_cancelled', {
                 'datphong_id': dp.id,
                 'service_ids': [s.id for s in services_to_cancel]
-            }, to='staff-dashboard')
+            }, 'communications.chat')
         
         return jsonify({
             'status': 'success',
@@ -10253,6 +11876,7 @@ def them_dich_vu():
 @app.route('/export-luong/<int:nhanvien_id>')
 @login_required
 def export_luong_nhan_vien(nhanvien_id):
+    import pandas as pd
     from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
     from openpyxl.utils import get_column_letter
     
@@ -10284,33 +11908,15 @@ def export_luong_nhan_vien(nhanvien_id):
     daily_rate = compute_daily_rate(base_salary) if salary_mode == SALARY_MODE_DAILY else 0
     
     # Tính doanh thu tháng
-    month_revenue = db.session.query(func.coalesce(func.sum(DatPhong.tong_thanh_toan), 0)).filter(
-        DatPhong.nhanvien_id == nhanvien_id,
-        DatPhong.trang_thai == 'da_thanh_toan',
-        DatPhong.thuc_te_tra >= start_month,
-        DatPhong.thuc_te_tra < next_month
-    ).scalar() or 0
+    revenues = staff_revenue(start_month, next_month)
+    month_revenue = revenues.get(nhanvien_id, 0)
     
     # Tính thưởng doanh thu
     tiers = LuongThuongCauHinh.query.order_by(LuongThuongCauHinh.moc_duoi.asc()).all()
     bonus, rate = tinh_thuong_doanh_thu(month_revenue, tiers)
     
     # Tính thưởng top
-    # First get all revenues per employee, then find the max
-    revenue_subquery = db.session.query(
-        func.coalesce(func.sum(DatPhong.tong_thanh_toan), 0).label('revenue')
-    ).filter(
-        DatPhong.nhanvien_id.isnot(None),
-        DatPhong.trang_thai == 'da_thanh_toan',
-        DatPhong.thuc_te_tra >= start_month,
-        DatPhong.thuc_te_tra < next_month
-    ).group_by(DatPhong.nhanvien_id).subquery()
-    
-    top_revenue = db.session.query(func.max(revenue_subquery.c.revenue)).scalar() or 0
-    
-    top_bonus = 0
-    if top_revenue and month_revenue == top_revenue:
-        top_bonus = get_top_bonus()
+    top_bonus = get_top_bonus() if nhanvien_id in top_revenue_staff_ids(revenues) else 0
     
     total_salary = base_effective + actual_allowance + bonus + top_bonus
 
@@ -10435,6 +12041,7 @@ def export_luong_nhan_vien(nhanvien_id):
 @app.route('/export-luong-all')
 @login_required
 def export_luong_all():
+    import pandas as pd
     from openpyxl.styles import Font, PatternFill, Border, Side, Alignment
     from openpyxl.utils import get_column_letter
     
@@ -10451,20 +12058,8 @@ def export_luong_all():
     salary_mode = get_salary_mode()
 
     # Tính doanh thu cho tất cả nhân viên
-    revenues = {}
-    revenue_rows = db.session.query(
-        DatPhong.nhanvien_id,
-        func.coalesce(func.sum(DatPhong.tong_thanh_toan), 0).label('doanh_thu')
-    ).filter(
-        DatPhong.nhanvien_id.isnot(None),
-        DatPhong.trang_thai == 'da_thanh_toan',
-        DatPhong.thuc_te_tra >= start_month,
-        DatPhong.thuc_te_tra < next_month
-    ).group_by(DatPhong.nhanvien_id).all()
-    
-    for row in revenue_rows:
-        revenues[row.nhanvien_id] = row.doanh_thu
-    
+    revenues = staff_revenue(start_month, next_month)
+
     # Tính top revenue
     top_revenue = max(revenues.values()) if revenues else 0
     top_bonus = get_top_bonus()
@@ -10653,14 +12248,24 @@ def export_luong_all():
 @socketio.on('connect')
 def handle_connect():
     print('Client connected')
+    if current_user.is_authenticated and not getattr(current_user, 'is_customer', False):
+        for room in staff_socket_rooms_for(current_user):
+            join_room(room)
 
 @socketio.on('join_chat_room')
 def handle_join_room(data):
-    token = data.get('token')
-    if token:
-        join_room(token)
+    token = (data or {}).get('token')
+    # Chỉ cho vào phòng của một phiên chat có thật, không cho đoán tên phòng khác
+    if token and DatPhong.query.filter_by(chat_token=token).first():
+        join_room(booking_socket_room(token))
         print(f'Client joined room: {token}')
 
+@socketio.on('subscribe_payment')
+def handle_subscribe_payment(data):
+    token = (data or {}).get('token')
+    if token and len(token) <= 64:
+        join_room(payment_socket_room(token))
+
 # ========================= ERROR HANDLERS =========================
 @app.errorhandler(404)
 def handle_not_found(error):
@@ -10681,5 +12286,5 @@ if __name__ == "__main__":
     try:
         socketio.run(app, host="0.0.0.0", port=int(os.environ.get("PORT", 5000)), debug=True, allow_unsafe_werkzeug=True)
     finally:
-        scheduler.shutdown()
+        shutdown_scheduler()
 
@@ -0,0 +1,102 @@
+"""Đo số câu SQL, thời gian và bộ nhớ của dữ liệu xuất Excel khách hàng theo số booking.
+
+    python bench_customer_export.py                      # 100, 1000 booking và toàn bộ
+    python bench_customer_export.py --sizes 500 5000 --legacy
+
+Chạy trên CSDL đang cấu hình (chỉ đọc). Mỗi cỡ lấy N booking đầu tiên theo
+(ngay_nhan, id) và dựng đủ các dòng như route /xuat-excel-khach-hang, không
+ghi file. --legacy đo thêm cách cũ (một truy vấn dịch vụ và các lazy load cho
+từng booking) để so sánh. Thoát với mã 1 nếu số câu SQL của cách mới thay đổi
+theo số booking.
+"""
+import argparse
+import os
+import sys
+import time
+import tracemalloc
+from collections import namedtuple
+
+os.environ.setdefault('SCHEDULER_MODE', 'external')
+os.environ.setdefault('AUTO_MIGRATE', '0')
+
+from sqlalchemy import event  # noqa: E402
+
+from app import (  # noqa: E402
+    app, db, DatPhong, SuDungDichVu, customer_export_row, iter_bookings_with_services,
+)
+
+
+class QueryCounter:
+    def __init__(self, engine):
+        self.count = 0
+        event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        self.count += 1
+
+
+def batched_rows(limit):
+    for stt, (dp, services) in enumerate(iter_bookings_with_services(limit), 1):
+        yield customer_export_row(stt, dp, services)
+
+
+ServiceRow = namedtuple('ServiceRow', 'ten so_luong thoi_gian')
+
+
+def legacy_rows(limit):
+    """The pre-batching loader: one service query per booking plus lazy loads."""
+    query = DatPhong.query.order_by(DatPhong.ngay_nhan, DatPhong.id)
+    if limit is not None:
+        query = query.limit(limit)
+    for stt, dp in enumerate(query.all(), 1):
+        services = [
+            ServiceRow(sd.dichvu.ten, sd.so_luong, sd.thoi_gian)
+            for sd in SuDungDichVu.query.filter_by(datphong_id=dp.id).all()
+        ]
+        yield customer_export_row(stt, dp, services)
+
+
+def measure(counter, make_rows, limit):
+    db.session.remove()
+    before = counter.count
+    tracemalloc.start()
+    started = time.perf_counter()
+    rows = 0
+    for _ in make_rows(limit):
+        rows += 1
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return rows, counter.count - before, elapsed, peak
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='*', default=[100, 1000], help='số booking mỗi lần đo')
+    parser.add_argument('--no-all', action='store_true', help='không đo toàn bộ bảng datphong')
+    parser.add_argument('--legacy', action='store_true', help='đo thêm cách tải cũ (N+1)')
+    args = parser.parse_args(argv)
+
+    limits = list(args.sizes) + ([] if args.no_all else [None])
+    modes = [('batched', batched_rows)] + ([('legacy', legacy_rows)] if args.legacy else [])
+
+    with app.app_context():
+        counter = QueryCounter(db.engine)
+        print(f"{'mode':<9}{'limit':>8}{'rows':>9}{'queries':>9}{'seconds':>10}{'peak MB':>9}")
+        batched_counts = set()
+        for limit in limits:
+            for name, make_rows in modes:
+                rows, queries, elapsed, peak = measure(counter, make_rows, limit)
+                if name == 'batched':
+                    batched_counts.add(queries)
+                label = 'all' if limit is None else limit
+                print(f"{name:<9}{label:>8}{rows:>9}{queries:>9}{elapsed:>10.3f}{peak / 1024 / 1024:>9.1f}")
+
+    if len(batched_counts) > 1:
+        print(f"Số câu SQL thay đổi theo số booking: {sorted(batched_counts)}")
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,122 @@
+"""Đo chi phí khởi động một worker web: thời gian import, module nặng, bộ nhớ RSS.
+
+    python boot_report.py                        # import app như một worker web
+    python boot_report.py --top 30 --budget-ms 1500
+    python boot_report.py --with-exports         # nạp thêm thư viện xuất file để so sánh RSS
+
+`import app` chạy trong tiến trình con với `-X importtime` (SCHEDULER_MODE=external,
+AUTO_MIGRATE=0 như worker web production) nên số đo không lẫn module của tiến trình đo.
+Thoát với mã 1 nếu vượt --budget-ms hoặc worker web nạp sẵn một thư viện nặng.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+from collections import defaultdict
+
+# Chỉ được nạp khi cần (route xuất file, vẽ QR/PDF, tiến trình chạy job nền)
+HEAVY_MODULES = ('pandas', 'numpy', 'openpyxl', 'reportlab', 'qrcode', 'PIL', 'apscheduler')
+
+PROBE = r'''
+import json, sys, time
+started = time.perf_counter()
+import app  # noqa: F401
+import_ms = (time.perf_counter() - started) * 1000
+heavy_loaded = sorted(m for m in HEAVY if m in sys.modules)
+def read_rss_kb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1])
+    except OSError:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+rss_app = read_rss_kb()
+rss_exports = None
+if WITH_EXPORTS:
+    import pandas, openpyxl, qrcode  # noqa: F401
+    import reportlab.pdfgen.canvas  # noqa: F401
+    rss_exports = read_rss_kb()
+print(json.dumps({
+    'import_ms': import_ms,
+    'rss_kb': rss_app,
+    'rss_exports_kb': rss_exports,
+    'heavy_loaded': heavy_loaded,
+}))
+'''
+
+
+def parse_importtime(stderr):
+    """Cộng thời gian 'self' của từng module theo package gốc."""
+    per_package = defaultdict(lambda: [0, 0])
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        parts = line[len('import time:'):].split('|')
+        if len(parts) != 3:
+            continue
+        self_us, _, name = parts
+        root = name.strip().split('.')[0]
+        per_package[root][0] += int(self_us.strip())
+        per_package[root][1] += 1
+    return per_package
+
+
+def run_probe(with_exports):
+    env = dict(os.environ)
+    env.setdefault('SCHEDULER_MODE', 'external')
+    env.setdefault('AUTO_MIGRATE', '0')
+    code = PROBE.replace('WITH_EXPORTS', repr(with_exports)).replace('HEAVY', repr(HEAVY_MODULES))
+    proc = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        env=env,
+        capture_output=True,
+        text=True,
+    )
+    result_line = next((line for line in reversed(proc.stdout.splitlines()) if line.startswith('{')), None)
+    if proc.returncode or not result_line:
+        tail = '\n'.join(line for line in proc.stderr.splitlines() if not line.startswith('import time:'))
+        raise SystemExit(f"import app thất bại (mã {proc.returncode}):\n{tail[-2000:]}")
+    return json.loads(result_line), parse_importtime(proc.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--top', type=int, default=20, help='số package tốn thời gian nhất cần in')
+    parser.add_argument('--budget-ms', type=float, default=None, help='ngân sách thời gian import app')
+    parser.add_argument('--with-exports', action='store_true', help='đo thêm RSS khi đã nạp thư viện xuất file')
+    parser.add_argument('--memory-mb', type=int, default=None, help='RAM dành cho worker web để ước số worker')
+    args = parser.parse_args(argv)
+
+    result, per_package = run_probe(args.with_exports)
+    total_us = sum(value[0] for value in per_package.values())
+
+    print(f"{'package':<28}{'self ms':>10}{'modules':>9}{'share':>8}")
+    ranked = sorted(per_package.items(), key=lambda item: item[1][0], reverse=True)
+    for name, (self_us, count) in ranked[:args.top]:
+        share = self_us / total_us * 100 if total_us else 0
+        print(f"{name:<28}{self_us / 1000:>10.1f}{count:>9}{share:>7.1f}%")
+    print()
+    print(f"import app: {result['import_ms']:.0f} ms (importtime cộng dồn {total_us / 1000:.0f} ms)")
+    rss_mb = result['rss_kb'] / 1024 if result['rss_kb'] else 0
+    print(f"RSS mỗi worker web sau khi import: {rss_mb:.1f} MB")
+    if result['rss_exports_kb']:
+        print(f"RSS khi đã nạp pandas/openpyxl/reportlab/qrcode: {result['rss_exports_kb'] / 1024:.1f} MB")
+    if args.memory_mb and rss_mb:
+        print(f"Ước tính số worker trong {args.memory_mb} MB: {int(args.memory_mb // rss_mb)}")
+
+    failed = False
+    if result['heavy_loaded']:
+        print(f"Thư viện nặng bị nạp ngay khi import: {', '.join(result['heavy_loaded'])}")
+        failed = True
+    if args.budget_ms is not None and result['import_ms'] > args.budget_ms:
+        print(f"Vượt ngân sách: {result['import_ms']:.0f} ms > {args.budget_ms:.0f} ms")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
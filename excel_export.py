@@ -0,0 +1,120 @@
+"""Xuất Excel dạng luồng: bộ nhớ không tăng theo số dòng.
+
+Workbook dùng chế độ write-only của openpyxl: mỗi dòng được ghi ngay xuống file
+tạm của sheet thay vì giữ cả bảng ô trong RAM, kiểu ô là các named style đăng
+ký một lần. Sau khi save(), file .xlsx được trả về từng khúc (iter_bytes) để
+response HTTP gửi dần rồi xóa file tạm.
+
+    book = StreamingWorkbook()
+    book.add_table('Lịch sử email', ['LỊCH SỬ GỬI EMAIL'], columns, rows)
+    return Response(book.iter_bytes(), mimetype=XLSX_MIMETYPE)
+"""
+import os
+import tempfile
+from collections import namedtuple
+
+XLSX_MIMETYPE = 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+BRAND_COLOR = '2F7D5A'
+
+# header, độ rộng cột, named style của ô dữ liệu (text, center, money, integer)
+Column = namedtuple('Column', 'header width style')
+Column.__new__.__defaults__ = (15, 'text')
+
+
+def _named_styles():
+    from openpyxl.styles import Alignment, Border, Font, NamedStyle, PatternFill, Side
+
+    thin = Side(style='thin')
+    border = Border(left=thin, right=thin, top=thin, bottom=thin)
+    styles = [
+        NamedStyle('title', font=Font(size=16, bold=True, color=BRAND_COLOR)),
+        NamedStyle('subtitle', font=Font(size=12, italic=True, color='666666')),
+        NamedStyle('note', font=Font(size=10, color='888888')),
+        NamedStyle('section', font=Font(size=12, bold=True, color=BRAND_COLOR)),
+        NamedStyle('highlight', font=Font(size=12, bold=True, color='FF6B35')),
+        NamedStyle(
+            'header',
+            font=Font(bold=True, color='FFFFFF'),
+            fill=PatternFill(start_color=BRAND_COLOR, end_color=BRAND_COLOR, fill_type='solid'),
+            border=border,
+            alignment=Alignment(horizontal='center', vertical='center'),
+        ),
+        NamedStyle('text', border=border, alignment=Alignment(horizontal='left')),
+        NamedStyle('center', border=border, alignment=Alignment(horizontal='center')),
+        NamedStyle('integer', border=border, alignment=Alignment(horizontal='right')),
+        NamedStyle('money', border=border, alignment=Alignment(horizontal='right'), number_format='#,##0'),
+    ]
+    return styles
+
+
+class StreamingWorkbook:
+    """openpyxl write-only workbook with the report styles registered once."""
+
+    def __init__(self):
+        from openpyxl import Workbook
+
+        self.workbook = Workbook(write_only=True)
+        for style in _named_styles():
+            self.workbook.add_named_style(style)
+
+    def cell(self, sheet, value, style):
+        from openpyxl.cell import WriteOnlyCell
+
+        cell = WriteOnlyCell(sheet, value=value)
+        cell.style = style
+        return cell
+
+    def add_sheet(self, title):
+        return self.workbook.create_sheet(title)
+
+    def add_table(self, title, heading_lines, columns, rows):
+        """Write a sheet of ``heading_lines`` then a bordered table; ``rows`` is consumed lazily.
+
+        Returns ``(sheet, row_count)``.
+        """
+        from openpyxl.utils import get_column_letter
+
+        sheet = self.add_sheet(title)
+        # Write-only: độ rộng cột phải đặt trước dòng đầu tiên
+        for index, column in enumerate(columns, 1):
+            sheet.column_dimensions[get_column_letter(index)].width = column.width
+        heading_styles = ('title', 'subtitle')
+        for index, line in enumerate(heading_lines):
+            sheet.append([self.cell(sheet, line, heading_styles[index] if index < len(heading_styles) else 'note')])
+        sheet.append([self.cell(sheet, column.header, 'header') for column in columns])
+
+        styles = [column.style for column in columns]
+        count = 0
+        for row in rows:
+            sheet.append([self.cell(sheet, value, style) for value, style in zip(row, styles)])
+            count += 1
+        return sheet, count
+
+    def add_key_values(self, title, rows, widths=(25, 30)):
+        """Summary sheet: ``rows`` are ``(label, value)`` or ``(label, value, style)``."""
+        sheet = self.add_sheet(title)
+        sheet.column_dimensions['A'].width = widths[0]
+        sheet.column_dimensions['B'].width = widths[1]
+        for row in rows:
+            label, value = row[0], row[1]
+            style = row[2] if len(row) > 2 else None
+            if style:
+                sheet.append([self.cell(sheet, label, style), self.cell(sheet, value, style)])
+            else:
+                sheet.append([label, value])
+        return sheet
+
+    def iter_bytes(self, chunk_size=64 * 1024):
+        """Save to a temporary file and yield it in chunks; the file is removed afterwards."""
+        handle = tempfile.NamedTemporaryFile(suffix='.xlsx', delete=False)
+        try:
+            handle.close()
+            self.workbook.save(handle.name)
+            with open(handle.name, 'rb') as stream:
+                while True:
+                    chunk = stream.read(chunk_size)
+                    if not chunk:
+                        break
+                    yield chunk
+        finally:
+            os.unlink(handle.name)
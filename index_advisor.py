@@ -0,0 +1,351 @@
+"""Chạy EXPLAIN cho các truy vấn nóng của app.py và báo bảng nào bị quét toàn bộ.
+
+    python index_advisor.py                    # CSDL đang cấu hình (MYSQL_*), chỉ đọc
+    MYSQL_DB=khachsan_advisor python index_advisor.py --seed 50000
+
+Mỗi mục trong CATALOGUE dựng đúng câu truy vấn mà route/job tương ứng chạy (cùng
+model, cùng điều kiện) rồi EXPLAIN trên MySQL. Dòng kế hoạch có type ALL (quét
+bảng) hoặc index (quét hết index) với ước lượng từ --min-rows dòng trở lên bị
+đánh dấu, và lệnh thoát với mã 1 để bắt lỗi hồi quy khi thêm truy vấn mới.
+
+Plan trên bảng gần trống không có ý nghĩa (MySQL chọn quét bảng), nên hãy chạy
+trên bản sao dữ liệu thật hoặc dùng --seed N: tạo N booking giả cùng tin nhắn,
+dịch vụ, email, chấm công, phiên thanh toán rồi ANALYZE TABLE. --seed chỉ chạy
+trên CSDL chưa có booking nào (mới import schema_internet.sql + migration).
+"""
+import argparse
+import os
+import random
+import sys
+import time
+from collections import namedtuple
+from datetime import datetime, timedelta
+
+os.environ.setdefault('SCHEDULER_MODE', 'external')
+
+from sqlalchemy import func, text  # noqa: E402
+
+from app import (  # noqa: E402
+    app, db, Attendance, BookingDeadline, DatPhong, DichVu, EmailLog, KhachHang, NguoiDung,
+    PaymentSession, Phong, RevenueDaily, RevenueReport, SuDungDichVu, TinNhan,
+    BOOKING_BLOCKING_STATUSES, invoice_list_query, rebuild_revenue_daily, revenue_daily_range,
+)
+
+Shape = namedtuple('Shape', 'name source build')
+
+SEED_TABLES = ('khachhang', 'datphong', 'tinnhan', 'sudungdv', 'email_log', 'attendance', 'payment_session',
+               'revenue_daily')
+
+
+def _period():
+    """Tháng trước, như báo cáo và bảng lương thường đọc."""
+    end = datetime.now().replace(day=1, hour=0, minute=0, second=0, microsecond=0)
+    start = (end - timedelta(days=1)).replace(day=1)
+    return start, end
+
+
+def _booking_overlap():
+    start = datetime.now() + timedelta(days=3)
+    return DatPhong.query.filter(
+        DatPhong.phong_id == 1,
+        DatPhong.trang_thai.in_(BOOKING_BLOCKING_STATUSES),
+        ~db.or_(DatPhong.ngay_tra <= start, DatPhong.ngay_nhan >= start + timedelta(days=2))
+    ).limit(1)
+
+
+def _room_map_window():
+    now = datetime.now()
+    return db.session.query(DatPhong.id, DatPhong.phong_id, DatPhong.ngay_nhan, DatPhong.ngay_tra).join(
+        Phong, DatPhong.phong_id == Phong.id
+    ).filter(
+        Phong.loai_id.in_([1, 2]),
+        DatPhong.trang_thai.in_(BOOKING_BLOCKING_STATUSES),
+        DatPhong.ngay_tra > now,
+        DatPhong.ngay_nhan < now + timedelta(days=14),
+    ).order_by(DatPhong.phong_id, DatPhong.ngay_nhan, DatPhong.id)
+
+
+def _invoice_list():
+    start, end = _period()
+    return invoice_list_query({
+        'tu_ngay': start.strftime('%Y-%m-%d'),
+        'den_ngay': (end - timedelta(days=1)).strftime('%Y-%m-%d'),
+    }).order_by(DatPhong.thuc_te_tra.desc())
+
+
+def _revenue_detail_page():
+    start, end = _period()
+    return DatPhong.query.filter(*RevenueReport(start, end).filters()).order_by(
+        DatPhong.thuc_te_tra.asc(), DatPhong.id
+    ).limit(50)
+
+
+def _revenue_top_customers():
+    start, end = _period()
+    total = func.coalesce(func.sum(DatPhong.tong_thanh_toan), 0)
+    return db.session.query(KhachHang.id, KhachHang.ho_ten, total, func.count(DatPhong.id)).join(
+        DatPhong, DatPhong.khachhang_id == KhachHang.id
+    ).filter(*RevenueReport(start, end).filters()).group_by(KhachHang.id, KhachHang.ho_ten).order_by(
+        total.desc()
+    ).limit(5)
+
+
+def _revenue_daily_month():
+    start, end = _period()
+    return db.session.query(func.sum(RevenueDaily.tong_thanh_toan)).filter(*revenue_daily_range(start, end))
+
+
+def _staff_revenue():
+    start, end = _period()
+    return db.session.query(RevenueDaily.nhanvien_id, func.sum(RevenueDaily.tong_thanh_toan)).filter(
+        RevenueDaily.trang_thai == 'da_thanh_toan',
+        RevenueDaily.nhanvien_id != 0,
+        *revenue_daily_range(start, end)
+    ).group_by(RevenueDaily.nhanvien_id)
+
+
+def _no_show_candidates():
+    return db.session.query(DatPhong.id, DatPhong.phong_id).filter(
+        DatPhong.trang_thai == 'dat',
+        DatPhong.thuc_te_nhan.is_(None)
+    )
+
+
+def _unread_badge():
+    return db.session.query(func.count(TinNhan.id)).join(DatPhong, TinNhan.datphong_id == DatPhong.id).filter(
+        TinNhan.trang_thai == 'chua_doc',
+        TinNhan.nguoi_gui == 'khach',
+        DatPhong.trang_thai == 'nhan'
+    )
+
+
+def _mark_messages_read():
+    return TinNhan.query.filter_by(datphong_id=1, nguoi_gui='khach', trang_thai='chua_doc')
+
+
+def _paid_services():
+    return SuDungDichVu.query.filter_by(datphong_id=1, trang_thai='da_thanh_toan')
+
+
+def _deadline_queue():
+    return BookingDeadline.query.filter(BookingDeadline.due_at <= datetime.now()).order_by(
+        BookingDeadline.due_at
+    ).limit(200)
+
+
+def _payment_session_sweep():
+    return db.session.query(PaymentSession.id).filter(PaymentSession.expires_at < datetime.now())
+
+
+def _payment_session_pending():
+    return PaymentSession.query.filter(
+        PaymentSession.status == 'pending',
+        PaymentSession.expires_at > datetime.now()
+    )
+
+
+def _email_history():
+    return EmailLog.query.order_by(EmailLog.sent_at.desc()).limit(50)
+
+
+def _email_history_failed():
+    return EmailLog.query.filter_by(status='failed').order_by(EmailLog.sent_at.desc()).limit(50)
+
+
+def _email_outbox():
+    return EmailLog.query.filter(
+        EmailLog.status == 'pending',
+        EmailLog.next_attempt_at <= datetime.now()
+    ).order_by(EmailLog.next_attempt_at, EmailLog.id).limit(20)
+
+
+def _attendance_work_days():
+    start, end = _period()
+    return db.session.query(func.count(Attendance.id)).filter(
+        Attendance.user_id == 1,
+        Attendance.status == 'approved',
+        Attendance.checkin_time >= start,
+        Attendance.checkin_time < end
+    )
+
+
+CATALOGUE = [
+    Shape('booking_overlap', 'dat_phong, gia hạn, xử lý booking chờ', _booking_overlap),
+    Shape('room_map_window', 'sơ đồ phòng theo khoảng ngày', _room_map_window),
+    Shape('invoice_list', 'quan_li_hoa_don, xuat_pdf_hoa_don', _invoice_list),
+    Shape('revenue_detail_page', 'thong_ke_doanh_thu (bảng chi tiết)', _revenue_detail_page),
+    Shape('revenue_top_customers', 'thong_ke_doanh_thu (top khách)', _revenue_top_customers),
+    Shape('revenue_daily_month', 'thong_ke_doanh_thu, xuat_bao_cao_doanh_thu', _revenue_daily_month),
+    Shape('staff_revenue', 'luong_thuong, export_luong_all', _staff_revenue),
+    Shape('no_show_candidates', 'expire_no_shows', _no_show_candidates),
+    Shape('unread_badge', 'compute_badge_counts, dashboard', _unread_badge),
+    Shape('mark_messages_read', 'đánh dấu tin khách đã đọc', _mark_messages_read),
+    Shape('paid_services', 'in_hoa_don, gửi hóa đơn', _paid_services),
+    Shape('deadline_queue', 'run_due_deadlines', _deadline_queue),
+    Shape('payment_session_sweep', 'cleanup_expired_data', _payment_session_sweep),
+    Shape('payment_session_pending', 'PaymentSessionRepository.pending', _payment_session_pending),
+    Shape('email_history', 'lich_su_email', _email_history),
+    Shape('email_history_failed', 'lich_su_email?status=failed', _email_history_failed),
+    Shape('email_outbox', 'email_outbox', _email_outbox),
+    Shape('attendance_work_days', 'luong_thuong, build_salary_settings_context', _attendance_work_days),
+]
+
+
+def explain(connection, query):
+    statement = getattr(query, 'statement', query)
+    sql = str(statement.compile(dialect=connection.dialect, compile_kwargs={'literal_binds': True}))
+    return [dict(row._mapping) for row in connection.exec_driver_sql('EXPLAIN ' + sql)]
+
+
+def full_scans(plan, min_rows):
+    """Các dòng kế hoạch quét cả bảng (ALL) hoặc cả index (index) trên ít nhất ``min_rows`` dòng."""
+    return [
+        row for row in plan
+        if row.get('type') in ('ALL', 'index') and row.get('table') and (row.get('rows') or 0) >= min_rows
+    ]
+
+
+def seed(connection, bookings, rng):
+    """Thêm ``bookings`` booking giả trải đều 3 năm cùng dữ liệu đi kèm."""
+    if connection.execute(text('SELECT COUNT(*) FROM datphong')).scalar():
+        raise SystemExit('--seed chỉ chạy trên CSDL chưa có booking (bản sao mới import schema_internet.sql).')
+    rooms = [row for row in connection.execute(db.select(Phong.id, Phong.loai_id))]
+    staff_ids = list(connection.execute(db.select(NguoiDung.id)).scalars())
+    service_ids = list(connection.execute(db.select(DichVu.id)).scalars())
+    if not rooms or not staff_ids or not service_ids:
+        raise SystemExit('Cần có sẵn phòng, nhân viên và dịch vụ (dữ liệu mẫu của schema_internet.sql).')
+
+    def insert(table, rows, batch=1000):
+        for start in range(0, len(rows), batch):
+            connection.execute(table.insert(), rows[start:start + batch])
+
+    now = datetime.now().replace(microsecond=0)
+    customers = max(1, bookings // 5)
+    first_customer = (connection.execute(text('SELECT COALESCE(MAX(id), 0) FROM khachhang')).scalar() or 0) + 1
+    insert(KhachHang.__table__, [
+        {'ho_ten': f'Khách seed {i}', 'cmnd': f'SEED{i:09d}', 'sdt': f'09{i:08d}', 'email': f'seed{i}@example.com'}
+        for i in range(customers)
+    ])
+
+    statuses = ['da_thanh_toan'] * 80 + ['huy'] * 8 + ['huy_timeout'] * 4 + ['dat'] * 4 + ['nhan'] * 3 + ['waiting']
+    rows = []
+    for i in range(bookings):
+        ngay_nhan = now - timedelta(days=rng.randint(-30, 3 * 365), hours=rng.randint(0, 23))
+        ngay_tra = ngay_nhan + timedelta(days=rng.randint(1, 5))
+        trang_thai = rng.choice(statuses)
+        room = rng.choice(rooms)
+        tien_phong = rng.randint(5, 50) * 100000
+        tien_dv = rng.randint(0, 10) * 50000
+        paid = trang_thai == 'da_thanh_toan'
+        rows.append({
+            'khachhang_id': first_customer + rng.randrange(customers),
+            'phong_id': room.id,
+            'nhanvien_id': rng.choice(staff_ids),
+            'ngay_nhan': ngay_nhan,
+            'ngay_tra': ngay_tra,
+            'thuc_te_tra': ngay_tra if trang_thai in ('da_thanh_toan', 'huy', 'huy_timeout') else None,
+            'trang_thai': trang_thai,
+            'tien_phong': tien_phong if paid else 0,
+            'tien_dv': tien_dv if paid else 0,
+            'tien_phat': 0,
+            'tien_coc': 0,
+            'tong_thanh_toan': tien_phong + tien_dv if paid else (200000 if trang_thai == 'huy' else 0),
+            'created_at': ngay_nhan - timedelta(days=rng.randint(0, 20)),
+        })
+    insert(DatPhong.__table__, rows)
+    booking_ids = list(connection.execute(db.select(DatPhong.id)).scalars())
+
+    insert(TinNhan.__table__, [
+        {
+            'datphong_id': dat_id,
+            'nguoi_gui': rng.choice(('khach', 'he_thong')),
+            'noi_dung': 'Tin nhắn seed',
+            'thoi_gian': now - timedelta(minutes=rng.randint(0, 3 * 365 * 24 * 60)),
+            'trang_thai': rng.choice(('da_doc', 'da_doc', 'da_doc', 'chua_doc')),
+        }
+        for dat_id in booking_ids for _ in range(2)
+    ])
+    insert(SuDungDichVu.__table__, [
+        {
+            'datphong_id': dat_id,
+            'dichvu_id': rng.choice(service_ids),
+            'so_luong': rng.randint(1, 3),
+            'thoi_gian': now - timedelta(days=rng.randint(0, 3 * 365)),
+            'trang_thai': rng.choice(('da_thanh_toan', 'da_thanh_toan', 'chua_thanh_toan')),
+        }
+        for dat_id in booking_ids
+    ])
+    insert(EmailLog.__table__, [
+        {
+            'recipient_email': f'seed{i}@example.com',
+            'subject': 'Email seed',
+            'status': rng.choice(('success', 'success', 'success', 'failed')),
+            'sent_at': now - timedelta(minutes=rng.randint(0, 3 * 365 * 24 * 60)),
+            'attempts': 1,
+        }
+        for i in range(bookings // 2)
+    ])
+    insert(Attendance.__table__, [
+        {
+            'user_id': user_id,
+            'checkin_time': now - timedelta(days=day, hours=rng.randint(0, 3)),
+            'status': rng.choice(('approved', 'approved', 'approved', 'pending', 'rejected')),
+        }
+        for user_id in staff_ids for day in range(3 * 365)
+    ])
+    insert(PaymentSession.__table__, [
+        {
+            'token': f'seed{i:032d}',
+            'kind': 'room',
+            'payload': '{}',
+            'created_at': now - timedelta(minutes=i),
+            'expires_at': now - timedelta(minutes=i) + timedelta(minutes=5),
+            'status': 'completed' if i % 3 else 'pending',
+        }
+        for i in range(max(1, bookings // 10))
+    ])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--seed', type=int, metavar='N', help='tạo N booking giả trước khi EXPLAIN (CSDL trống)')
+    parser.add_argument('--min-rows', type=int, default=1000, help='chỉ báo quét toàn bộ từ số dòng ước lượng này')
+    parser.add_argument('--only', nargs='*', help='chỉ chạy các truy vấn có tên này')
+    parser.add_argument('--verbose', action='store_true', help='in toàn bộ kế hoạch của mỗi truy vấn')
+    args = parser.parse_args(argv)
+
+    shapes = [shape for shape in CATALOGUE if not args.only or shape.name in args.only]
+    with app.app_context():
+        if args.seed:
+            started = time.perf_counter()
+            with db.engine.begin() as connection:
+                seed(connection, args.seed, random.Random(42))
+            rebuild_revenue_daily()
+            # ANALYZE tự commit nên chạy sau khi đã ghi xong dữ liệu giả
+            with db.engine.connect() as connection:
+                connection.exec_driver_sql('ANALYZE TABLE ' + ', '.join(SEED_TABLES))
+            print(f"Đã seed {args.seed} booking trong {time.perf_counter() - started:.1f}s")
+
+        flagged = 0
+        with db.engine.connect() as connection:
+            print(f"{'query':<26}{'table':<18}{'type':<8}{'key':<44}{'rows':>10}")
+            for shape in shapes:
+                plan = explain(connection, shape.build())
+                scans = full_scans(plan, args.min_rows)
+                for row in (plan if args.verbose or scans else plan[:1]):
+                    mark = '  <-- quét toàn bộ' if row in scans else ''
+                    print(f"{shape.name:<26}{str(row.get('table')):<18}{str(row.get('type')):<8}"
+                          f"{str(row.get('key')):<44}{row.get('rows') or 0:>10}{mark}")
+                if scans:
+                    flagged += 1
+                    print(f"{'':<26}nguồn: {shape.source}")
+
+    if flagged:
+        print(f"{flagged}/{len(shapes)} truy vấn quét toàn bộ bảng")
+        return 1
+    print(f"{len(shapes)} truy vấn đều dùng index")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,99 @@
+"""Vẽ PDF hóa đơn từ danh sách lệnh setFont/textLine đã ghi sẵn.
+
+Module chỉ phụ thuộc reportlab (không import app) để có thể chạy trong tiến
+trình con: render_batch() chia việc cho nhiều `python invoice_pdf.py --worker`,
+mỗi tiến trình nhận các hóa đơn qua stdin (JSON), ghi từng file PDF vào thư mục
+tạm và báo số thứ tự qua stdout, nhờ vậy web worker chỉ chờ I/O khi xuất hàng
+loạt hóa đơn cuối tháng.
+"""
+import io
+import json
+import math
+import os
+import subprocess
+import sys
+import tempfile
+
+
+def render_invoice_pdf(ops):
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
+    buffer = io.BytesIO()
+    pdf = canvas.Canvas(buffer, pagesize=A4)
+    width, height = A4
+    text = pdf.beginText(40, height - 50)
+    for op in ops:
+        if op[0] == 'font':
+            text.setFont(op[1], op[2])
+        else:
+            text.textLine(op[1])
+    pdf.drawText(text)
+    pdf.showPage()
+    pdf.save()
+
+    buffer.seek(0)
+    return buffer.read()
+
+
+def render_batch(jobs, processes=2):
+    """Yield the PDF bytes of ``jobs`` (lists of ops) in order.
+
+    Jobs are split into ``processes`` contiguous chunks rendered in parallel;
+    the first chunk streams out while the others are still being drawn.
+    """
+    if not jobs:
+        return
+    processes = max(1, min(processes, len(jobs)))
+    size = math.ceil(len(jobs) / processes)
+    chunks = [jobs[start:start + size] for start in range(0, len(jobs), size)]
+    with tempfile.TemporaryDirectory(prefix='invoice_pdf_') as workdir:
+        workers = []
+        try:
+            for index, chunk in enumerate(chunks):
+                outdir = os.path.join(workdir, str(index))
+                os.mkdir(outdir)
+                proc = subprocess.Popen(
+                    [sys.executable, os.path.abspath(__file__), '--worker', outdir],
+                    stdin=subprocess.PIPE,
+                    stdout=subprocess.PIPE,
+                )
+                proc.stdin.write(json.dumps(chunk).encode('utf-8'))
+                proc.stdin.close()
+                workers.append((proc, outdir, len(chunk)))
+
+            for proc, outdir, count in workers:
+                done = 0
+                for line in proc.stdout:
+                    path = os.path.join(outdir, f'{int(line)}.pdf')
+                    with open(path, 'rb') as handle:
+                        data = handle.read()
+                    os.remove(path)
+                    done += 1
+                    yield data
+                if proc.wait() != 0 or done != count:
+                    raise RuntimeError(f'Tiến trình vẽ PDF dừng bất thường (mã {proc.returncode}, {done}/{count} hóa đơn).')
+        finally:
+            for proc, _, _ in workers:
+                if proc.poll() is None:
+                    proc.kill()
+                    proc.wait()
+                proc.stdout.close()
+
+
+def _worker(outdir):
+    jobs = json.loads(sys.stdin.buffer.read())
+    for index, ops in enumerate(jobs):
+        path = os.path.join(outdir, f'{index}.pdf')
+        with open(path + '.tmp', 'wb') as handle:
+            handle.write(render_invoice_pdf(ops))
+        os.replace(path + '.tmp', path)
+        sys.stdout.write(f'{index}\n')
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 3 and sys.argv[1] == '--worker':
+        _worker(sys.argv[2])
+    else:
+        sys.exit('Dùng nội bộ: python invoice_pdf.py --worker <thư mục>')
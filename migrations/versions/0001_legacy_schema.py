@@ -0,0 +1,71 @@
+"""Cột và bảng trước đây được ensure_tables_exist() thêm lúc khởi động
+
+Revision ID: 0001_legacy_schema
+Revises:
+Create Date: 2026-10-17 09:00:00
+
+Áp dụng trên CSDL đã import schema_internet.sql. Mọi bước đều kiểm tra trước
+nên chạy được cả trên CSDL đã được vá dần bởi cơ chế dò schema cũ.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0001_legacy_schema'
+down_revision = None
+branch_labels = None
+depends_on = None
+
+
+LEGACY_COLUMNS = [
+    ('nguoidung', sa.Column('role_id', sa.Integer(), nullable=True)),
+    ('khachhang', sa.Column('email', sa.String(120))),
+    ('khachhang', sa.Column('mat_khau_hash', sa.String(255))),
+    ('khachhang', sa.Column('diem_tich_luy', sa.Integer(), server_default='0')),
+    ('khachhang', sa.Column('ngay_dang_ky', sa.DateTime(), nullable=True)),
+    ('khachhang', sa.Column('ngay_cap_nhat', sa.DateTime(), nullable=True)),
+    ('khachhang', sa.Column('lan_dang_nhap_cuoi', sa.DateTime(), nullable=True)),
+    ('khachhang', sa.Column('trang_thai_tai_khoan', sa.String(20), server_default='hoat_dong')),
+    ('khachhang', sa.Column('deleted_at', sa.DateTime(), nullable=True)),
+    ('khachhang', sa.Column('deleted_reason', sa.String(255), nullable=True)),
+    ('khachhang', sa.Column('deleted_by', sa.Integer(), nullable=True)),
+    ('datphong', sa.Column('created_at', sa.DateTime(), server_default=sa.text('CURRENT_TIMESTAMP'))),
+    ('datphong', sa.Column('diem_loyalty_da_cong', sa.Integer(), server_default='0')),
+]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if not inspector.has_table('nguoidung'):
+        raise RuntimeError('Chưa có bảng gốc: import schema_internet.sql trước khi chạy migration.')
+
+    columns = {}
+    for table, column in LEGACY_COLUMNS:
+        if table not in columns:
+            columns[table] = {col['name'] for col in inspector.get_columns(table)}
+        if column.name not in columns[table]:
+            op.add_column(table, column)
+
+    discount_column = next(
+        (col for col in inspector.get_columns('voucher') if col['name'] == 'discount_percent'), None
+    )
+    if discount_column and discount_column['type'].__class__.__name__.lower() in {'integer', 'smallinteger', 'bigint'}:
+        op.alter_column('voucher', 'discount_percent', type_=sa.Float(), server_default='10')
+
+    if not inspector.has_table('payment_session'):
+        op.create_table(
+            'payment_session',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('token', sa.String(64), nullable=False),
+            sa.Column('kind', sa.String(20), nullable=False),
+            sa.Column('payload', sa.Text()),
+            sa.Column('created_at', sa.DateTime()),
+        )
+        op.create_index('ix_payment_session_token', 'payment_session', ['token'], unique=True)
+
+
+def downgrade():
+    # Các cột cũ đã có trong schema_internet.sql nên chỉ bỏ bảng phát sinh lúc chạy
+    op.drop_index('ix_payment_session_token', table_name='payment_session')
+    op.drop_table('payment_session')
@@ -0,0 +1,62 @@
+"""Hàng đợi hạn đặt phòng, bộ đếm dashboard và outbox email
+
+Revision ID: 0002_background_jobs
+Revises: 0001_legacy_schema
+Create Date: 2026-10-17 09:05:00
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = '0002_background_jobs'
+down_revision = '0001_legacy_schema'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+
+    if not inspector.has_table('booking_deadline'):
+        op.create_table(
+            'booking_deadline',
+            sa.Column('id', sa.Integer(), primary_key=True),
+            sa.Column('datphong_id', sa.Integer(), sa.ForeignKey('datphong.id', ondelete='CASCADE'), nullable=False),
+            sa.Column('kind', sa.String(20), nullable=False),
+            sa.Column('due_at', sa.DateTime(), nullable=False),
+            sa.Column('created_at', sa.DateTime()),
+            sa.UniqueConstraint('datphong_id', 'kind', name='uq_booking_deadline'),
+        )
+        op.create_index('ix_booking_deadline_due_at', 'booking_deadline', ['due_at'])
+
+    if not inspector.has_table('dashboard_counter'):
+        op.create_table(
+            'dashboard_counter',
+            sa.Column('key', sa.String(64), primary_key=True),
+            sa.Column('value', sa.Integer(), nullable=False, server_default='0'),
+        )
+
+    email_log_columns = {col['name'] for col in inspector.get_columns('email_log')}
+    if 'attempts' not in email_log_columns:
+        op.add_column('email_log', sa.Column('attempts', sa.Integer(), server_default='0'))
+        op.add_column('email_log', sa.Column('next_attempt_at', sa.DateTime(), nullable=True))
+        op.add_column('email_log', sa.Column('attachments', sa.Text().with_variant(mysql.LONGTEXT(), 'mysql'), nullable=True))
+        op.create_index('ix_email_log_outbox', 'email_log', ['status', 'next_attempt_at'])
+        # Dòng 'pending' cũ là email bị kẹt khi còn gửi đồng bộ; không gửi lại thư đã quá hạn
+        op.execute(
+            "UPDATE email_log SET status = 'failed', error_message = 'Gửi bị gián đoạn trước khi có outbox' "
+            "WHERE status = 'pending'"
+        )
+
+
+def downgrade():
+    op.drop_index('ix_email_log_outbox', table_name='email_log')
+    op.drop_column('email_log', 'attachments')
+    op.drop_column('email_log', 'next_attempt_at')
+    op.drop_column('email_log', 'attempts')
+    op.drop_table('dashboard_counter')
+    op.drop_index('ix_booking_deadline_due_at', table_name='booking_deadline')
+    op.drop_table('booking_deadline')
@@ -0,0 +1,68 @@
+"""Cột dat_id, expires_at, status cho payment_session
+
+Revision ID: 0003_payment_session_columns
+Revises: 0002_background_jobs
+Create Date: 2026-10-17 10:00:00
+
+"""
+import json
+from datetime import timedelta
+
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0003_payment_session_columns'
+down_revision = '0002_background_jobs'
+branch_labels = None
+depends_on = None
+
+
+def _timeout_minutes(bind):
+    value = bind.execute(
+        sa.text("SELECT value FROM hethongcauhinh WHERE `key` = 'payment_timeout_minutes'")
+    ).scalar()
+    try:
+        minutes = int(value)
+    except (TypeError, ValueError):
+        return 5
+    return minutes if 1 <= minutes <= 60 else 5
+
+
+def upgrade():
+    bind = op.get_bind()
+    columns = {col['name'] for col in sa.inspect(bind).get_columns('payment_session')}
+    if 'dat_id' in columns:
+        return
+    op.add_column('payment_session', sa.Column('dat_id', sa.Integer(), nullable=True))
+    op.add_column('payment_session', sa.Column('expires_at', sa.DateTime(), nullable=True))
+    op.add_column('payment_session', sa.Column('status', sa.String(20), nullable=False, server_default='pending'))
+    op.create_index('ix_payment_session_dat_id', 'payment_session', ['dat_id'])
+    op.create_index('ix_payment_session_expires_at', 'payment_session', ['expires_at'])
+
+    # Phiên thanh toán chỉ sống vài phút nên bảng nhỏ; điền cột mới từ payload
+    ttl = timedelta(minutes=_timeout_minutes(bind))
+    rows = bind.execute(sa.text('SELECT id, payload, created_at FROM payment_session')).fetchall()
+    for row_id, payload, created_at in rows:
+        try:
+            data = json.loads(payload) if payload else {}
+        except ValueError:
+            data = {}
+        bind.execute(
+            sa.text('UPDATE payment_session SET dat_id = :dat_id, expires_at = :expires_at, status = :status WHERE id = :id'),
+            {
+                'id': row_id,
+                'dat_id': data.get('dat_id'),
+                'expires_at': created_at + ttl if created_at else None,
+                'status': 'completed' if data.get('completed') else 'pending',
+            },
+        )
+
+
+def downgrade():
+    op.drop_index('ix_payment_session_expires_at', table_name='payment_session')
+    op.drop_index('ix_payment_session_dat_id', table_name='payment_session')
+    op.drop_column('payment_session', 'status')
+    op.drop_column('payment_session', 'expires_at')
+    op.drop_column('payment_session', 'dat_id')
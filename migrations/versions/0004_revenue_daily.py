@@ -0,0 +1,59 @@
+"""Bảng revenue_daily: doanh thu cộng dồn theo ngày, loại phòng, phòng, nhân viên
+
+Revision ID: 0004_revenue_daily
+Revises: 0003_payment_session_columns
+Create Date: 2026-10-17 11:00:00
+
+Dữ liệu cũ được nạp bằng một câu INSERT ... SELECT; sau đó app tự cộng thêm khi
+booking được thanh toán hoặc bị hủy mất cọc. `flask --app app rebuild-revenue`
+dựng lại bảng bất cứ lúc nào.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0004_revenue_daily'
+down_revision = '0003_payment_session_columns'
+branch_labels = None
+depends_on = None
+
+
+BACKFILL = """
+INSERT INTO revenue_daily
+    (ngay, loai_id, phong_id, nhanvien_id, trang_thai, so_booking,
+     tien_phong, tien_dv, tien_phat, tien_coc, tong_thanh_toan)
+SELECT DATE(d.thuc_te_tra), p.loai_id, d.phong_id, COALESCE(d.nhanvien_id, 0), d.trang_thai, COUNT(*),
+       COALESCE(SUM(d.tien_phong), 0), COALESCE(SUM(d.tien_dv), 0), COALESCE(SUM(d.tien_phat), 0),
+       COALESCE(SUM(d.tien_coc), 0), COALESCE(SUM(d.tong_thanh_toan), 0)
+FROM datphong d
+JOIN phong p ON p.id = d.phong_id
+WHERE d.thuc_te_tra IS NOT NULL
+  AND (d.trang_thai = 'da_thanh_toan' OR (d.trang_thai = 'huy' AND d.tong_thanh_toan > 0))
+GROUP BY DATE(d.thuc_te_tra), p.loai_id, d.phong_id, COALESCE(d.nhanvien_id, 0), d.trang_thai
+"""
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    if inspector.has_table('revenue_daily'):
+        return
+    op.create_table(
+        'revenue_daily',
+        sa.Column('ngay', sa.Date(), primary_key=True),
+        sa.Column('loai_id', sa.Integer(), primary_key=True, autoincrement=False),
+        sa.Column('phong_id', sa.Integer(), primary_key=True, autoincrement=False),
+        sa.Column('nhanvien_id', sa.Integer(), primary_key=True, autoincrement=False),
+        sa.Column('trang_thai', sa.String(20), primary_key=True),
+        sa.Column('so_booking', sa.Integer(), nullable=False, server_default='0'),
+        sa.Column('tien_phong', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('tien_dv', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('tien_phat', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('tien_coc', sa.BigInteger(), nullable=False, server_default='0'),
+        sa.Column('tong_thanh_toan', sa.BigInteger(), nullable=False, server_default='0'),
+    )
+    op.execute(BACKFILL)
+
+
+def downgrade():
+    op.drop_table('revenue_daily')
@@ -0,0 +1,42 @@
+"""Index ghép cho các truy vấn nóng (kết quả của index_advisor.py)
+
+Revision ID: 0005_hot_query_indexes
+Revises: 0004_revenue_daily
+Create Date: 2026-10-17 12:00:00
+
+Chạy lại `python index_advisor.py` sau khi thêm truy vấn mới để xem còn bảng
+nào bị quét toàn bộ.
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0005_hot_query_indexes'
+down_revision = '0004_revenue_daily'
+branch_labels = None
+depends_on = None
+
+
+INDEXES = [
+    ('datphong', 'ix_datphong_phong_trang_thai_ngay', ['phong_id', 'trang_thai', 'ngay_nhan', 'ngay_tra']),
+    ('datphong', 'ix_datphong_trang_thai_thuc_te_tra', ['trang_thai', 'thuc_te_tra']),
+    ('tinnhan', 'ix_tinnhan_datphong_nguoi_gui_trang_thai', ['datphong_id', 'nguoi_gui', 'trang_thai']),
+    ('sudungdv', 'ix_sudungdv_datphong_trang_thai', ['datphong_id', 'trang_thai']),
+    ('email_log', 'ix_email_log_status_sent_at', ['status', 'sent_at']),
+    ('email_log', 'ix_email_log_sent_at', ['sent_at']),
+    ('attendance', 'ix_attendance_user_status_checkin', ['user_id', 'status', 'checkin_time']),
+]
+
+
+def upgrade():
+    inspector = sa.inspect(op.get_bind())
+    for table, name, columns in INDEXES:
+        existing = {index['name'] for index in inspector.get_indexes(table)}
+        if name not in existing:
+            op.create_index(name, table, columns)
+
+
+def downgrade():
+    for table, name, _ in reversed(INDEXES):
+        op.drop_index(name, table_name=table)
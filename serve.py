@@ -0,0 +1,34 @@
+"""Điểm chạy production: Flask-SocketIO trên event loop gevent thay cho Werkzeug dev server.
+
+Mỗi kết nối websocket (chat khách, tab nhân viên) chỉ là một greenlet nên một
+tiến trình giữ được hàng nghìn kết nối rảnh. monkey.patch_all() phải chạy trước
+mọi import khác để PyMySQL, smtplib và APScheduler dùng socket/thread hợp tác;
+phần vẽ PDF/QR nặng CPU được app.run_blocking đẩy sang thread pool.
+
+    python serve.py                      # HOST/PORT lấy từ biến môi trường
+    gunicorn -k geventwebsocket.gunicorn.workers.GeventWebSocketWorker -w 1 serve:app
+
+Chạy nhiều worker thì cần SOCKETIO_MESSAGE_QUEUE và sticky session (xem README).
+"""
+from gevent import monkey
+
+monkey.patch_all()
+
+import os  # noqa: E402
+
+os.environ.setdefault('SOCKETIO_ASYNC_MODE', 'gevent')
+
+from app import app, socketio, shutdown_scheduler  # noqa: E402
+
+
+def main():
+    host = os.environ.get('HOST', '0.0.0.0')
+    port = int(os.environ.get('PORT', 5000))
+    try:
+        socketio.run(app, host=host, port=port)
+    finally:
+        shutdown_scheduler()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,357 @@
+"""Kho key-value có TTL cho phiên thanh toán: hết hạn là tự biến mất, không cần job dọn.
+
+    PAYMENT_SESSION_STORE=memory                    # trong tiến trình, một tiến trình duy nhất
+    PAYMENT_SESSION_STORE=kv://127.0.0.1:6391       # nhiều worker/node dùng chung
+    PAYMENT_SESSION_STORE=redis://10.0.0.5:6379/0   # Redis thật, cùng giao thức
+
+Trên máy không có Redis, chạy `python session_store.py` (mặc định 127.0.0.1:6391)
+rồi trỏ mọi worker web vào kv://host:port. Máy chủ nói giao thức RESP nhưng chỉ
+hiểu đúng các lệnh mà RespStore dùng: PING, SET .. PX, GET, MGET, DEL, SADD,
+SREM, SMEMBERS, PEXPIRE, SELECT. Dữ liệu chỉ nằm trong RAM.
+"""
+import heapq
+import socket
+import socketserver
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+DEFAULT_STORE_ADDRESS = ('127.0.0.1', 6391)
+
+
+def parse_store_url(url):
+    parsed = urlparse(url)
+    db_index = (parsed.path or '/').strip('/')
+    return (
+        parsed.hostname or DEFAULT_STORE_ADDRESS[0],
+        parsed.port or DEFAULT_STORE_ADDRESS[1],
+        int(db_index) if db_index.isdigit() else 0,
+    )
+
+
+class MemoryStore:
+    """Thread-safe in-process store with per-key TTL.
+
+    Expired keys are dropped lazily: every call first pops the keys whose
+    deadline has passed from a heap, so no background sweep is needed.
+    """
+
+    def __init__(self, clock=time.monotonic):
+        self._clock = clock
+        self._data = {}  # key -> [value, deadline or None]
+        self._deadlines = []  # heap of (deadline, key)
+        self._lock = threading.Lock()
+
+    def _expire(self, now):
+        heap = self._deadlines
+        while heap and heap[0][0] <= now:
+            deadline, key = heapq.heappop(heap)
+            entry = self._data.get(key)
+            # Key có thể đã được ghi lại với hạn mới sau khi đẩy mốc này vào heap
+            if entry is not None and entry[1] == deadline:
+                del self._data[key]
+
+    def _set_deadline(self, key, entry, ttl, now):
+        entry[1] = now + ttl if ttl is not None else None
+        if entry[1] is not None:
+            heapq.heappush(self._deadlines, (entry[1], key))
+
+    def ping(self):
+        return True
+
+    def set(self, key, value, ttl=None):
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            entry = [value, None]
+            self._data[key] = entry
+            self._set_deadline(key, entry, ttl, now)
+
+    def get(self, key):
+        with self._lock:
+            self._expire(self._clock())
+            entry = self._data.get(key)
+            return entry[0] if entry is not None and isinstance(entry[0], str) else None
+
+    def mget(self, keys):
+        with self._lock:
+            self._expire(self._clock())
+            values = []
+            for key in keys:
+                entry = self._data.get(key)
+                values.append(entry[0] if entry is not None and isinstance(entry[0], str) else None)
+            return values
+
+    def delete(self, *keys):
+        with self._lock:
+            self._expire(self._clock())
+            return sum(1 for key in keys if self._data.pop(key, None) is not None)
+
+    def sadd(self, key, *members):
+        with self._lock:
+            self._expire(self._clock())
+            entry = self._data.get(key)
+            if entry is None or not isinstance(entry[0], set):
+                entry = self._data[key] = [set(), None]
+            before = len(entry[0])
+            entry[0].update(members)
+            return len(entry[0]) - before
+
+    def srem(self, key, *members):
+        with self._lock:
+            self._expire(self._clock())
+            entry = self._data.get(key)
+            if entry is None or not isinstance(entry[0], set):
+                return 0
+            before = len(entry[0])
+            entry[0].difference_update(members)
+            if not entry[0]:
+                del self._data[key]
+            return before - len(entry[0])
+
+    def smembers(self, key):
+        with self._lock:
+            self._expire(self._clock())
+            entry = self._data.get(key)
+            return set(entry[0]) if entry is not None and isinstance(entry[0], set) else set()
+
+    def expire(self, key, ttl):
+        with self._lock:
+            now = self._clock()
+            self._expire(now)
+            entry = self._data.get(key)
+            if entry is None:
+                return False
+            self._set_deadline(key, entry, ttl, now)
+            return True
+
+    def __len__(self):
+        with self._lock:
+            self._expire(self._clock())
+            return len(self._data)
+
+
+class RespError(Exception):
+    pass
+
+
+class RespStore:
+    """Same interface as MemoryStore over RESP, for Redis or the kv server below."""
+
+    def __init__(self, url='kv://127.0.0.1:6391', timeout=5):
+        host, port, self.db_index = parse_store_url(url)
+        self.address = (host, port)
+        self.timeout = timeout
+        self._sock = None
+        self._reader = None
+        self._lock = threading.Lock()
+
+    def _connect(self):
+        sock = socket.create_connection(self.address, timeout=self.timeout)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self._sock, self._reader = sock, sock.makefile('rb')
+        if self.db_index:
+            self._roundtrip(('SELECT', self.db_index))
+
+    def _close(self):
+        for handle in (self._reader, self._sock):
+            if handle is not None:
+                try:
+                    handle.close()
+                except OSError:
+                    pass
+        self._sock = self._reader = None
+
+    def _roundtrip(self, args):
+        self._sock.sendall(encode_command(args))
+        return read_reply(self._reader)
+
+    def command(self, *args):
+        with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._sock is None:
+                        self._connect()
+                    reply = self._roundtrip(args)
+                except (OSError, EOFError):
+                    self._close()
+                    if attempt:
+                        raise
+                    continue
+                if isinstance(reply, RespError):
+                    raise reply
+                return reply
+
+    def ping(self):
+        return self.command('PING') == 'PONG'
+
+    def set(self, key, value, ttl=None):
+        if ttl is None:
+            self.command('SET', key, value)
+        else:
+            self.command('SET', key, value, 'PX', max(1, int(ttl * 1000)))
+
+    def get(self, key):
+        value = self.command('GET', key)
+        return value.decode('utf-8') if value is not None else None
+
+    def mget(self, keys):
+        if not keys:
+            return []
+        return [value.decode('utf-8') if value is not None else None for value in self.command('MGET', *keys)]
+
+    def delete(self, *keys):
+        return self.command('DEL', *keys) if keys else 0
+
+    def sadd(self, key, *members):
+        return self.command('SADD', key, *members) if members else 0
+
+    def srem(self, key, *members):
+        return self.command('SREM', key, *members) if members else 0
+
+    def smembers(self, key):
+        return {member.decode('utf-8') for member in self.command('SMEMBERS', key)}
+
+    def expire(self, key, ttl):
+        return bool(self.command('PEXPIRE', key, max(1, int(ttl * 1000))))
+
+
+def encode_command(args):
+    parts = [f'*{len(args)}\r\n'.encode()]
+    for arg in args:
+        data = arg if isinstance(arg, bytes) else str(arg).encode('utf-8')
+        parts.append(f'${len(data)}\r\n'.encode() + data + b'\r\n')
+    return b''.join(parts)
+
+
+def _read_line(stream):
+    line = stream.readline()
+    if not line.endswith(b'\r\n'):
+        raise EOFError('connection closed')
+    return line[:-2]
+
+
+def read_reply(stream):
+    line = _read_line(stream)
+    prefix, rest = line[:1], line[1:]
+    if prefix == b'+':
+        return rest.decode('utf-8')
+    if prefix == b'-':
+        return RespError(rest.decode('utf-8'))
+    if prefix == b':':
+        return int(rest)
+    if prefix == b'$':
+        length = int(rest)
+        if length < 0:
+            return None
+        data = stream.read(length + 2)
+        if len(data) != length + 2:
+            raise EOFError('connection closed')
+        return data[:-2]
+    if prefix == b'*':
+        count = int(rest)
+        return None if count < 0 else [read_reply(stream) for _ in range(count)]
+    raise EOFError(f'unexpected reply {line[:20]!r}')
+
+
+def open_store(url):
+    """``memory`` -> MemoryStore; ``kv://`` or ``redis://`` -> RespStore."""
+    if url == 'memory':
+        return MemoryStore()
+    if urlparse(url).scheme in ('kv', 'redis'):
+        return RespStore(url)
+    raise ValueError(f'Kho phiên không hỗ trợ: {url}')
+
+
+class _RespHandler(socketserver.StreamRequestHandler):
+    def reply(self, value):
+        if value is None:
+            data = b'$-1\r\n'
+        elif isinstance(value, bool):
+            data = b':1\r\n' if value else b':0\r\n'
+        elif isinstance(value, int):
+            data = f':{value}\r\n'.encode()
+        elif isinstance(value, RespError):
+            data = f'-{value}\r\n'.encode()
+        elif isinstance(value, (list, set)):
+            data = f'*{len(value)}\r\n'.encode()
+            data += b''.join(
+                b'$-1\r\n' if item is None else f'${len(item.encode())}\r\n'.encode() + item.encode() + b'\r\n'
+                for item in value
+            )
+        elif value == 'OK' or value == 'PONG':
+            data = f'+{value}\r\n'.encode()
+        else:
+            encoded = value.encode('utf-8')
+            data = f'${len(encoded)}\r\n'.encode() + encoded + b'\r\n'
+        self.wfile.write(data)
+
+    def handle(self):
+        store = self.server.store
+        while True:
+            try:
+                args = read_reply(self.rfile)
+            except (EOFError, ValueError, OSError):
+                return
+            if not isinstance(args, list) or not args:
+                self.reply(RespError('ERR protocol error'))
+                continue
+            args = [arg.decode('utf-8') for arg in args]
+            name, params = args[0].upper(), args[1:]
+            try:
+                if name == 'PING':
+                    self.reply('PONG')
+                elif name == 'SELECT':
+                    self.reply('OK')
+                elif name == 'SET':
+                    ttl = None
+                    if len(params) == 4 and params[2].upper() == 'PX':
+                        ttl = int(params[3]) / 1000
+                    store.set(params[0], params[1], ttl)
+                    self.reply('OK')
+                elif name == 'GET':
+                    self.reply(store.get(params[0]))
+                elif name == 'MGET':
+                    self.reply(store.mget(params))
+                elif name == 'DEL':
+                    self.reply(store.delete(*params))
+                elif name == 'SADD':
+                    self.reply(store.sadd(params[0], *params[1:]))
+                elif name == 'SREM':
+                    self.reply(store.srem(params[0], *params[1:]))
+                elif name == 'SMEMBERS':
+                    self.reply(store.smembers(params[0]))
+                elif name == 'PEXPIRE':
+                    self.reply(store.expire(params[0], int(params[1]) / 1000))
+                else:
+                    self.reply(RespError(f'ERR unknown command {name}'))
+            except (IndexError, ValueError):
+                self.reply(RespError(f'ERR wrong arguments for {name}'))
+            self.wfile.flush()
+
+
+class KvServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=DEFAULT_STORE_ADDRESS):
+        self.store = MemoryStore()
+        super().__init__(address, _RespHandler)
+
+
+def main(argv):
+    address = DEFAULT_STORE_ADDRESS
+    if len(argv) > 1:
+        host, _, port = argv[1].rpartition(':')
+        address = (host or DEFAULT_STORE_ADDRESS[0], int(port))
+    with KvServer(address) as server:
+        print(f"session_store listening on {address[0]}:{address[1]}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,133 @@
+"""Máy chủ SMTP giả cho dev/test: nhận mọi thư và lưu thành file .eml, không gửi đi đâu.
+
+    python smtp_sink.py                     # 127.0.0.1:1025, lưu vào ./mail_sink
+    python smtp_sink.py 0.0.0.0:2525 /tmp/mail
+
+Trong Cài đặt > SMTP đặt host/port tương ứng, tắt TLS/SSL. Mọi tài khoản
+đăng nhập (AUTH PLAIN/LOGIN) đều được chấp nhận; một phiên nhận được nhiều
+thư nên kiểm tra được cả việc outbox dùng lại kết nối.
+"""
+import os
+import socketserver
+import sys
+import threading
+import time
+
+DEFAULT_SINK_ADDRESS = ('127.0.0.1', 1025)
+DEFAULT_SINK_DIR = 'mail_sink'
+
+
+class _SmtpHandler(socketserver.StreamRequestHandler):
+    def reply(self, line):
+        self.wfile.write((line + '\r\n').encode('utf-8'))
+        self.wfile.flush()
+
+    def read_line(self):
+        raw = self.rfile.readline()
+        if not raw:
+            return None
+        return raw.decode('utf-8', 'replace').rstrip('\r\n')
+
+    def read_data(self):
+        lines = []
+        while True:
+            raw = self.rfile.readline()
+            if not raw:
+                return None
+            if raw in (b'.\r\n', b'.\n'):
+                return b''.join(lines)
+            # Bỏ dấu chấm đệm (dot-stuffing) theo RFC 5321
+            lines.append(raw[1:] if raw.startswith(b'..') else raw)
+
+    def handle(self):
+        sender, recipients = None, []
+        self.reply(f'220 {self.server.hostname} smtp_sink ready')
+        while True:
+            line = self.read_line()
+            if line is None:
+                return
+            verb, _, arg = line.partition(' ')
+            verb = verb.upper()
+            if verb in ('HELO', 'EHLO'):
+                if verb == 'EHLO':
+                    self.reply(f'250-{self.server.hostname}')
+                    self.reply('250-8BITMIME')
+                    self.reply('250 AUTH PLAIN LOGIN')
+                else:
+                    self.reply(f'250 {self.server.hostname}')
+            elif verb == 'AUTH':
+                if arg.upper().startswith('LOGIN'):
+                    self.reply('334 VXNlcm5hbWU6')
+                    self.read_line()
+                    self.reply('334 UGFzc3dvcmQ6')
+                    self.read_line()
+                self.reply('235 Authentication successful')
+            elif verb == 'MAIL':
+                sender, recipients = arg.partition(':')[2].strip(), []
+                self.reply('250 OK')
+            elif verb == 'RCPT':
+                recipients.append(arg.partition(':')[2].strip())
+                self.reply('250 OK')
+            elif verb == 'DATA':
+                if not recipients:
+                    self.reply('503 RCPT first')
+                    continue
+                self.reply('354 End data with <CR><LF>.<CR><LF>')
+                data = self.read_data()
+                if data is None:
+                    return
+                path = self.server.store(sender, recipients, data)
+                self.reply(f'250 OK queued as {os.path.basename(path)}')
+                sender, recipients = None, []
+            elif verb == 'RSET':
+                sender, recipients = None, []
+                self.reply('250 OK')
+            elif verb == 'NOOP':
+                self.reply('250 OK')
+            elif verb == 'QUIT':
+                self.reply('221 Bye')
+                return
+            else:
+                self.reply('502 Command not implemented')
+
+
+class SmtpSink(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=DEFAULT_SINK_ADDRESS, directory=DEFAULT_SINK_DIR):
+        self.hostname = 'smtp-sink.local'
+        self.directory = directory
+        self.count = 0
+        self.lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        super().__init__(address, _SmtpHandler)
+
+    def store(self, sender, recipients, data):
+        with self.lock:
+            self.count += 1
+            name = f"{time.strftime('%Y%m%d-%H%M%S')}-{self.count:05d}.eml"
+        path = os.path.join(self.directory, name)
+        with open(path, 'wb') as handle:
+            handle.write(f"X-Sink-From: {sender}\r\nX-Sink-To: {', '.join(recipients)}\r\n".encode('utf-8'))
+            handle.write(data)
+        print(f"{name}: {sender} -> {', '.join(recipients)}")
+        return path
+
+
+def main(argv):
+    address = DEFAULT_SINK_ADDRESS
+    if len(argv) > 1:
+        host, _, port = argv[1].rpartition(':')
+        address = (host or DEFAULT_SINK_ADDRESS[0], int(port))
+    directory = argv[2] if len(argv) > 2 else DEFAULT_SINK_DIR
+    with SmtpSink(address, directory) as server:
+        print(f"smtp_sink listening on {address[0]}:{address[1]}, saving to {directory}/")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main(sys.argv)
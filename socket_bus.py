@@ -0,0 +1,113 @@
+"""Bus sự kiện Socket.IO giữa nhiều tiến trình cho môi trường dev/test.
+
+Production nên dùng Redis/RabbitMQ/Kafka qua SOCKETIO_MESSAGE_QUEUE. Trên một
+máy không có broker, chạy `python socket_bus.py` (mặc định 127.0.0.1:6390) rồi
+đặt SOCKETIO_MESSAGE_QUEUE=localbus://127.0.0.1:6390 cho mọi worker web.
+Broker chỉ chuyển tiếp nguyên dòng JSON nhận được tới mọi kết nối, kể cả bên gửi.
+"""
+import json
+import socket
+import socketserver
+import sys
+import threading
+import time
+from urllib.parse import urlparse
+
+import socketio
+
+DEFAULT_BUS_ADDRESS = ('127.0.0.1', 6390)
+
+
+def parse_bus_url(url):
+    parsed = urlparse(url)
+    return parsed.hostname or DEFAULT_BUS_ADDRESS[0], parsed.port or DEFAULT_BUS_ADDRESS[1]
+
+
+class LocalBusManager(socketio.PubSubManager):
+    """Client manager that relays emits through the socket_bus broker, like RedisManager does through Redis."""
+    name = 'localbus'
+
+    def __init__(self, url='localbus://127.0.0.1:6390', channel='flask-socketio', write_only=False, logger=None):
+        self.address = parse_bus_url(url)
+        self._send_sock = None
+        self._send_lock = threading.Lock()
+        super().__init__(channel=channel, write_only=write_only, logger=logger)
+
+    def _connect(self):
+        return socket.create_connection(self.address, timeout=5)
+
+    def _publish(self, data):
+        line = (json.dumps({'channel': self.channel, 'data': data}) + '\n').encode('utf-8')
+        with self._send_lock:
+            for attempt in range(2):
+                try:
+                    if self._send_sock is None:
+                        self._send_sock = self._connect()
+                    self._send_sock.sendall(line)
+                    return
+                except OSError:
+                    if self._send_sock is not None:
+                        self._send_sock.close()
+                    self._send_sock = None
+                    if attempt:
+                        raise
+
+    def _listen(self):
+        while True:
+            try:
+                conn = self._connect()
+                conn.settimeout(None)
+                with conn, conn.makefile('rb') as stream:
+                    for raw in stream:
+                        try:
+                            message = json.loads(raw)
+                        except ValueError:
+                            continue
+                        if message.get('channel') == self.channel:
+                            yield message.get('data')
+            except OSError as exc:
+                self._get_logger().warning('socket_bus unavailable (%s), retrying', exc)
+            time.sleep(1)
+
+
+class _BusHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        with self.server.lock:
+            self.server.clients.add(self.wfile)
+        try:
+            for line in self.rfile:
+                # Giữ khóa khi ghi để các dòng từ nhiều kết nối không chen vào nhau
+                with self.server.lock:
+                    for wfile in list(self.server.clients):
+                        try:
+                            wfile.write(line)
+                            wfile.flush()
+                        except OSError:
+                            self.server.clients.discard(wfile)
+        finally:
+            with self.server.lock:
+                self.server.clients.discard(self.wfile)
+
+
+class BusServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address=DEFAULT_BUS_ADDRESS):
+        self.clients = set()
+        self.lock = threading.Lock()
+        super().__init__(address, _BusHandler)
+
+
+def main(argv):
+    address = parse_bus_url(f"localbus://{argv[1]}") if len(argv) > 1 else DEFAULT_BUS_ADDRESS
+    with BusServer(address) as server:
+        print(f"socket_bus listening on {address[0]}:{address[1]}")
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+if __name__ == '__main__':
+    main(sys.argv)
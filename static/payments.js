@@ -57,6 +57,56 @@ function pollPaymentStatus(url, onCompleted, onExpired) {
     poll();
 }
 
+// Chờ kết quả thanh toán qua Socket.IO (phòng payment:<token>); chỉ gọi status_url
+// khi vừa kết nối/kết nối lại. Không có Socket.IO thì quay về polling.
+function subscribePaymentStatus(url, token, onCompleted, onExpired) {
+    if (typeof io !== 'function' || !token) {
+        pollPaymentStatus(url, onCompleted, onExpired);
+        return;
+    }
+
+    let settled = false;
+    const socket = io();
+
+    const handle = (data) => {
+        if (settled || !data) return;
+        if (data.status === 'completed') {
+            settled = true;
+            if (typeof onCompleted === 'function') {
+                onCompleted(data);
+            }
+        } else if (data.status === 'expired') {
+            settled = true;
+            if (typeof onExpired === 'function') {
+                onExpired();
+            }
+        } else if (data.status === 'invalid') {
+            settled = true;
+            if (typeof onExpired === 'function') {
+                onExpired('invalid');
+            }
+        }
+        if (settled) {
+            socket.off('payment_status', onPush);
+        }
+    };
+
+    const onPush = (data) => {
+        if (data && data.token === token) {
+            handle(data);
+        }
+    };
+
+    socket.on('payment_status', onPush);
+    socket.on('connect', () => {
+        socket.emit('subscribe_payment', { token: token });
+        fetch(url, { cache: 'no-store' })
+            .then((res) => res.json())
+            .then(handle)
+            .catch(() => {});
+    });
+}
+
 function copyToClipboard(text, noticeElement) {
     if (!navigator.clipboard) {
         const textarea = document.createElement('textarea');
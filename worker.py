@@ -0,0 +1,42 @@
+"""Tiến trình chạy job nền (hủy giữ chỗ, hủy không đến, dọn dữ liệu hết hạn, gửi email outbox).
+
+Dùng khi triển khai nhiều worker web: đặt SCHEDULER_MODE=external cho các
+tiến trình web rồi chạy riêng `python worker.py`. Có thể chạy nhiều worker để
+dự phòng; lease trong bảng hethongcauhinh đảm bảo chỉ một tiến trình chạy job.
+"""
+import os
+import signal
+import sys
+import threading
+
+os.environ['SCHEDULER_MODE'] = 'embedded'
+
+if os.getenv('PAYMENT_SESSION_STORE', '').strip() == 'memory':
+    # Worker không thấy phiên QR trong RAM của tiến trình web và sẽ hủy nhầm mọi giữ chỗ
+    sys.exit('worker.py cần PAYMENT_SESSION_STORE dùng chung với tiến trình web (sql, kv:// hoặc redis://)')
+
+from app import app, scheduler, email_outbox, shutdown_scheduler, SCHEDULER_INSTANCE_ID  # noqa: E402
+
+
+def main():
+    stop = threading.Event()
+
+    def handle_signal(signum, frame):
+        stop.set()
+
+    signal.signal(signal.SIGTERM, handle_signal)
+    signal.signal(signal.SIGINT, handle_signal)
+
+    if not scheduler.running:
+        scheduler.start()
+    email_outbox.start()
+    app.logger.info(f"Scheduler worker {SCHEDULER_INSTANCE_ID} đang chạy")
+    try:
+        while not stop.is_set():
+            stop.wait(1)
+    finally:
+        shutdown_scheduler()
+
+
+if __name__ == '__main__':
+    main()